@@ -0,0 +1,291 @@
+"""
+Load test of the jukebox bottle API against a synthetic fleet.
+
+The deployments factory is replaced by a `SimFleet` of `--users` users with 1 to `--deployments` deployments of
+1 to `--max-nodes` nodes each, the users store by an in-memory one, and the explorer and Stellar calls go to the
+simulated grid. Requests are routed by the bottle app and served by the route handlers concurrently; the auth
+decorators are bypassed (their session checks are not what is measured) and every request runs as a random
+user of the fleet.
+
+Endpoints: GET /api/allowed, GET /api/deployments/<type>, GET /api/wallet, POST /api/deployments/cancel and
+POST /api/node/cancel, picked with the `--mix` weights.
+
+Reports per endpoint: p50/p95/p99 latency, throughput, errors, and store reads (deployments and users) and grid
+calls per request.
+
+Usage:
+    python benchmarks/api_load.py [--users 2000] [--max-nodes 50] [--requests 2000] [--concurrency 50]
+    python benchmarks/api_load.py --users 500,2000,5000      # compare how the handlers degrade with fleet size
+"""
+from gevent import monkey
+
+monkey.patch_all()  # bottle's request/response are thread locals, they have to be greenlet locals here
+
+import argparse  # noqa: E402
+import io  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import random  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+from collections import Counter, defaultdict  # noqa: E402
+from contextlib import ExitStack  # noqa: E402
+from types import SimpleNamespace  # noqa: E402
+from unittest import mock  # noqa: E402
+
+from gevent.pool import Pool  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from simulator import FarmSpec, Latency, SimFleet, SimulatedGrid, install  # noqa: E402
+
+EXPLORER_URL = "https://explorer.testnet.grid.tf/api/v1"
+SOLUTION_TYPES = ["dash", "digibyte", "presearch", "casperlabs", "ubuntu"]
+PROFILE = (1, 1024, 10 * 1024)
+DEFAULT_MIX = "allowed=3,deployments=5,wallet=3,cancel_deployment=1,cancel_node=1"
+
+
+class UserStore:
+    def __init__(self):
+        """In-memory stand-in for `StoredFactory(UserEntry)`, counting reads"""
+        self.entries = {}
+        self.reads = Counter()
+
+    def add(self, tname):
+        name = f"jukebox_{tname[: -len('.3bot')]}"
+        self.entries[name] = SimpleNamespace(
+            instance_name=name, tname=tname, explorer_url=EXPLORER_URL, has_agreed=True, save=lambda: None
+        )
+
+    def list_all(self):
+        self.reads["users.list_all"] += 1
+        return list(self.entries)
+
+    def get(self, name):
+        self.reads["users.get"] += 1
+        return self.entries[name]
+
+
+def populate(fleet, users, args, rng):
+    fleet_users = []
+    for index in range(args.users):
+        tname = f"user{index}.3bot"
+        identity_name = f"jukebox_user{index}"
+        users.add(tname)
+        deployments = []
+        for number in range(rng.randint(1, args.deployments)):
+            solution_type = rng.choice(SOLUTION_TYPES)
+            fleet.add_synthetic(
+                identity_name,
+                f"deployment{number}",
+                nodes=rng.randint(1, args.max_nodes),
+                solution_type=solution_type,
+                expire_in=60 * 60 * 24 * rng.choice([1, 30]),
+                auto_extend=rng.random() < 0.5,
+                profile=PROFILE,
+            )
+            deployments.append((solution_type, f"deployment{number}"))
+        fleet_users.append(SimpleNamespace(tname=tname, identity_name=identity_name, deployments=deployments))
+    return fleet_users
+
+
+def farm_spec(args):
+    containers = args.users * (args.deployments + 1) // 2 * (args.max_nodes + 1) // 2
+    return FarmSpec(nodes=containers // 200 + 10, cru=256, mru=1024, hru=256 * 200, public_ip_ratio=0.5)
+
+
+def make_request(kind, user, rng):
+    """Get (method, path, body) of a request of `kind` by `user`, None if the user has nothing to cancel"""
+    if kind == "allowed":
+        return "GET", "/api/allowed", None
+    if kind == "wallet":
+        return "GET", "/api/wallet", None
+    if not user.deployments:
+        return None
+    solution_type, deployment_name = rng.choice(user.deployments)
+    if kind == "deployments":
+        return "GET", f"/api/deployments/{solution_type}", None
+    body = {"name": deployment_name, "solution_type": solution_type}
+    if kind == "cancel_deployment":
+        user.deployments.remove((solution_type, deployment_name))
+        return "POST", "/api/deployments/cancel", body
+    if kind == "cancel_node":
+        from jumpscale.loader import j
+
+        deployment = j.sals.jukebox.find(
+            identity_name=user.identity_name, deployment_name=deployment_name, solution_type=solution_type
+        )
+        if not deployment or not deployment.nodes:
+            return None
+        body["wid"] = rng.choice(deployment.nodes).wid
+        return "POST", "/api/node/cancel", body
+    raise ValueError(f"Unknown request kind {kind}")
+
+
+def environ_for(method, path, body, user):
+    payload = json.dumps(body).encode() if body is not None else b""
+    return {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "QUERY_STRING": "",
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(payload),
+        "CONTENT_LENGTH": str(len(payload)),
+        "CONTENT_TYPE": "application/json",
+        "HTTP_ACCEPT_ENCODING": "gzip",
+        "beaker.session": {"authorized": True, "username": user.tname, "email": f"{user.tname}@example.com"},
+    }
+
+
+def serve(app, environ):
+    """Route and serve a request with the undecorated handler, consuming the response body
+
+    Returns:
+        int: http status
+    """
+    import bottle
+
+    route, route_args = app.router.match(environ)
+    bottle.request.bind(environ)
+    bottle.response.bind()
+    try:
+        result = route.get_undecorated_callback()(**route_args)
+    except bottle.HTTPResponse as e:
+        result = e
+    status = result.status_code if isinstance(result, bottle.HTTPResponse) else 200
+    body = result.body if isinstance(result, bottle.HTTPResponse) else result
+    if body is not None and not isinstance(body, (bytes, str)):
+        for _ in body:
+            pass
+    return status
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)] if values else 0
+
+
+def run(args, mix):
+    from jumpscale.loader import j
+    from jumpscale.packages.jukebox.bottle import jukebox as api
+
+    rng = random.Random(args.seed)
+    grid = SimulatedGrid(
+        farms={"freefarm": farm_spec(args)}, latency={"default": Latency(median=args.latency)}, seed=args.seed
+    )
+    fleet = SimFleet(grid)
+    users = UserStore()
+    identity = SimpleNamespace(explorer=SimpleNamespace(url=EXPLORER_URL))
+
+    def get_user_info():
+        session = api.request.environ["beaker.session"]
+        return json.dumps({"username": session["username"], "email": session["email"]})
+
+    with install(grid, fleet=fleet), ExitStack() as stack:
+        stack.enter_context(mock.patch.object(api, "StoredFactory", lambda model: users))
+        stack.enter_context(mock.patch.object(api, "get_user_info", get_user_info))
+        stack.enter_context(mock.patch.object(type(j.core.identity), "me", property(lambda self: identity)))
+        stack.enter_context(mock.patch.object(j.core.identity, "find", lambda name: SimpleNamespace(name=name)))
+
+        start = time.monotonic()
+        fleet_users = populate(fleet, users, args, rng)
+        nodes = sum(len(deployment.nodes) for deployment in fleet.deployments.values())
+        print(
+            f"fleet: {args.users} users, {len(fleet.deployments)} deployments, {nodes} nodes "
+            f"({time.monotonic() - start:.1f}s to build)",
+            file=sys.stderr,
+        )
+        grid.calls.clear()
+        fleet.reads.clear()
+
+        kinds, weights = zip(*mix.items())
+        latencies = defaultdict(list)
+        statuses = defaultdict(Counter)
+        reads = defaultdict(Counter)
+        calls = defaultdict(Counter)
+
+        def one_request(_):
+            user = rng.choice(fleet_users)
+            kind = rng.choices(kinds, weights)[0]
+            request = make_request(kind, user, rng)
+            if not request:
+                return
+            reads_before = fleet.reads + users.reads
+            calls_before = Counter(grid.calls)
+            request_start = time.monotonic()
+            try:
+                status = serve(api.app, environ_for(*request, user))
+            except Exception:
+                status = 500
+            latencies[kind].append(time.monotonic() - request_start)
+            statuses[kind][status] += 1
+            # reads and calls of concurrent requests overlap, the per request averages are approximate
+            reads[kind].update((fleet.reads + users.reads) - reads_before)
+            calls[kind].update(Counter(grid.calls) - calls_before)
+
+        start = time.monotonic()
+        for _ in Pool(args.concurrency).imap_unordered(one_request, range(args.requests)):
+            pass
+        elapsed = time.monotonic() - start
+
+    report = {"users": args.users, "deployments": len(fleet.deployments), "nodes": nodes, "endpoints": {}}
+    report["throughput"] = round(sum(len(values) for values in latencies.values()) / elapsed, 2)
+    for kind in kinds:
+        count = len(latencies[kind])
+        if not count:
+            continue
+        report["endpoints"][kind] = {
+            "requests": count,
+            "errors": sum(number for status, number in statuses[kind].items() if status >= 400),
+            "p50_ms": round(percentile(latencies[kind], 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies[kind], 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies[kind], 99) * 1000, 2),
+            "store_reads_per_request": {name: round(value / count, 2) for name, value in reads[kind].items()},
+            "grid_calls_per_request": {name: round(value / count, 2) for name, value in calls[kind].items()},
+        }
+    return report
+
+
+def print_report(report):
+    print(f"\n{report['users']} users, {report['deployments']} deployments, {report['nodes']} nodes")
+    print(f"throughput: {report['throughput']} requests/s")
+    print(
+        f"{'endpoint':<20}{'requests':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        "  store reads/request"
+    )
+    for kind, stats in report["endpoints"].items():
+        store_reads = ", ".join(f"{name} {value}" for name, value in stats["store_reads_per_request"].items())
+        print(
+            f"{kind:<20}{stats['requests']:>10}{stats['errors']:>8}"
+            f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}  {store_reads or '-'}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", default="2000", help="comma separated fleet sizes to test")
+    parser.add_argument("--deployments", type=int, default=3, help="max deployments per user")
+    parser.add_argument("--max-nodes", type=int, default=50, help="max nodes per deployment")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05, help="median explorer and Stellar latency in seconds")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="endpoint weights")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the reports as json")
+    args = parser.parse_args()
+    mix = {kind: float(weight) for kind, weight in (item.split("=") for item in args.mix.split(","))}
+
+    reports = []
+    for users in [int(users) for users in args.users.split(",")]:
+        args.users = users
+        reports.append(run(args, mix))
+        if not args.json:
+            print_report(reports[-1])
+    if args.json:
+        print(json.dumps(reports, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Compare container submission throughput of the per-container path and the batched path of JukeboxDeployment.
+
+The explorer is simulated in-process with gevent: every request takes `--latency` seconds, the explorer throttles
+clients above `--rate-limit` requests per second (throttled requests are retried after one second), and a
+workload is provisioned `--provision-time` seconds after it was submitted.
+
+per-container: one greenlet per container that submits its workload then polls it every second (wait_workload)
+batch: workloads submitted BATCH_SIZE at a time, then a single waiter polls the pending ones every
+WORKLOAD_POLL_INTERVAL seconds (deploy_containers_batch)
+
+Usage:
+    python benchmarks/batch_submission.py [--containers 50] [--latency 0.1] [--rate-limit 20] [--provision-time 10]
+"""
+import argparse
+import random
+import time
+from collections import deque
+
+import gevent
+from gevent.pool import Pool
+
+BATCH_SIZE = 10
+WORKLOAD_POLL_INTERVAL = 1
+
+
+class Throttled(Exception):
+    pass
+
+
+class FakeExplorer:
+    def __init__(self, latency, rate_limit, provision_time):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.provision_time = provision_time
+        self.requests = 0
+        self.throttled = 0
+        self._recent = deque()
+        self._workloads = {}  # wid: provisioned at
+
+    def _request(self):
+        self.requests += 1
+        now = time.monotonic()
+        while self._recent and self._recent[0] < now - 1:
+            self._recent.popleft()
+        gevent.sleep(self.latency)
+        if len(self._recent) >= self.rate_limit:
+            self.throttled += 1
+            raise Throttled()
+        self._recent.append(now)
+
+    def call(self, func, *args):
+        while True:
+            try:
+                self._request()
+                return func(*args)
+            except Throttled:
+                gevent.sleep(1)
+
+    def deploy(self):
+        wid = len(self._workloads) + 1
+        self._workloads[wid] = time.monotonic() + self.provision_time * random.uniform(0.5, 1.5)
+        return wid
+
+    def is_provisioned(self, wid):
+        return time.monotonic() >= self._workloads[wid]
+
+
+def per_container(explorer, containers):
+    def deploy_container():
+        wid = explorer.call(explorer.deploy)
+        while not explorer.call(explorer.is_provisioned, wid):
+            gevent.sleep(1)
+
+    gevent.joinall([gevent.spawn(deploy_container) for _ in range(containers)])
+
+
+def batch(explorer, containers):
+    pool = Pool(BATCH_SIZE)
+    pending = set(pool.imap(lambda _: explorer.call(explorer.deploy), range(containers)))
+
+    def poll(wid):
+        return wid, explorer.call(explorer.is_provisioned, wid)
+
+    while pending:
+        for wid, provisioned in pool.imap_unordered(poll, list(pending)):
+            if provisioned:
+                pending.discard(wid)
+        if pending:
+            gevent.sleep(WORKLOAD_POLL_INTERVAL)
+
+
+def run(name, func, args):
+    random.seed(0)
+    explorer = FakeExplorer(args.latency, args.rate_limit, args.provision_time)
+    start = time.monotonic()
+    func(explorer, args.containers)
+    elapsed = time.monotonic() - start
+    print(
+        f"{name:<14} {elapsed:8.2f}s {args.containers / elapsed:8.2f} containers/s "
+        f"{explorer.requests:6d} requests {explorer.throttled:6d} throttled"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--containers", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--rate-limit", type=int, default=20)
+    parser.add_argument("--provision-time", type=float, default=10)
+    args = parser.parse_args()
+    run("per-container", per_container, args)
+    run("batch", batch, args)
+
+
+if __name__ == "__main__":
+    main()
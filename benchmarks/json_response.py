@@ -0,0 +1,91 @@
+"""
+Compare per-request CPU of the deployments listing before and after the jukebox response layer.
+
+before: `j.data.serializers.json.dumps` (stdlib json) over the to_dict() trees, sent uncompressed
+after: `response.dumps` (orjson when installed), streamed in chunks and compressed
+
+Usage:
+    python benchmarks/json_response.py [--deployments 500] [--nodes 5] [--iterations 50]
+"""
+import argparse
+import json
+import random
+import time
+
+from jumpscale.packages.jukebox.bottle import response
+
+
+def fake_deployment(index, nodes_count):
+    now = int(time.time())
+    return {
+        "solution_type": random.choice(["dash", "digibyte", "presearch", "casperlabs", "ubuntu"]),
+        "identity_name": f"jukebox_user{index % 50}",
+        "deployment_name": f"deployment{index}",
+        "farm_name": "freefarm",
+        "nodes_count": nodes_count,
+        "pool_ids": [random.randint(1, 10 ** 6)],
+        "nodes": [
+            {
+                "state": "DEPLOYED",
+                "wid": random.randint(1, 10 ** 7),
+                "node_id": "".join(random.choice("abcdefghijkmnopqrstuvwxyz123456789") for _ in range(44)),
+                "ipv4_address": f"10.{index % 250}.{node % 250}.2",
+                "ipv6_address": f"2a02:1802:5e:0:{index:x}:{node:x}::1",
+                "creation_time": now,
+            }
+            for node in range(nodes_count)
+        ],
+        "state": "DEPLOYED",
+        "expiration_date": now + 60 * 60 * 24 * 30,
+        "auto_extend": bool(index % 2),
+        "cpu": 4,
+        "memory": 8192,
+        "disk_size": 102400,
+        "disk_type": "HDD",
+        "secret_env": "".join(random.choice("abcdef0123456789") for _ in range(160)),
+    }
+
+
+def before(deployments):
+    return json.dumps({"data": deployments}).encode()
+
+
+def after(deployments, encoding):
+    chunks = response.iter_json_array("data", deployments)
+    if encoding:
+        chunks = response.iter_compressed(chunks, encoding)
+    return b"".join(chunks)
+
+
+def measure(func, iterations):
+    size = 0
+    start = time.process_time()
+    for _ in range(iterations):
+        size = len(func())
+    return (time.process_time() - start) / iterations * 1000, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--deployments", type=int, default=500)
+    parser.add_argument("--nodes", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    random.seed(0)
+    deployments = [fake_deployment(i, args.nodes) for i in range(args.deployments)]
+    cases = [("before (json, identity)", lambda: before(deployments))]
+    cases.append((f"after ({'orjson' if response.orjson else 'json'}, identity)", lambda: after(deployments, None)))
+    cases.append(("after (gzip)", lambda: after(deployments, "gzip")))
+    if response.brotli:
+        cases.append(("after (br)", lambda: after(deployments, "br")))
+
+    print(f"{args.deployments} deployments x {args.nodes} nodes, {args.iterations} iterations")
+    print(f"{'case':<28}{'cpu ms/request':>16}{'bytes':>12}")
+    for name, func in cases:
+        cpu_ms, size = measure(func, args.iterations)
+        print(f"{name:<28}{cpu_ms:>16.3f}{size:>12}")
+
+
+if __name__ == "__main__":
+    main()
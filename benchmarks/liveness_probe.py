@@ -0,0 +1,141 @@
+"""
+Run the liveness probe engine against local listeners.
+
+`--listeners` servers are started on the loopback addresses (127.0.0.1, and ::1 when available), of three kinds:
+
+- rpc: answers any request with an HTTP 401, like a daemon RPC port called without credentials
+- silent: accepts connections and never answers, HTTP probes to it have to time out
+- closed: a port nothing listens on, probes to it are refused
+
+`--targets` probe targets are spread over them, some with an unreachable ipv6 address first to check the ipv4
+fallback, and probed `--concurrency` at a time. Every result is checked against the kind of its listener; the
+script reports the round summary and the probes per second, and exits with 1 on any wrong result.
+
+Usage:
+    python benchmarks/liveness_probe.py [--targets 5000] [--listeners 30] [--concurrency 1000] [--timeout 1]
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import argparse  # noqa: E402
+import itertools  # noqa: E402
+import resource  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+
+from gevent import socket  # noqa: E402
+from gevent.server import StreamServer  # noqa: E402
+
+from jumpscale.sals.jukebox import probe  # noqa: E402
+
+RPC = "rpc"
+SILENT = "silent"
+CLOSED = "closed"
+UNREACHABLE_IPV6 = "100::1"  # discard prefix, connecting to it fails or times out
+
+
+def answer_rpc(sock, address):
+    sock.recv(1024)
+    sock.sendall(b"HTTP/1.0 401 Unauthorized\r\nContent-Length: 0\r\n\r\n")
+    sock.close()
+
+
+def stay_silent(sock, address):
+    while sock.recv(1024):  # until the prober gives up and closes the connection
+        pass
+
+
+def free_port(host):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.bind((host, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def loopback_hosts():
+    hosts = ["127.0.0.1"]
+    try:
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        sock.bind(("::1", 0))
+        sock.close()
+        hosts.append("::1")
+    except OSError:
+        pass
+    return hosts
+
+
+def start_listeners(count):
+    """Start `count` listeners cycling over the kinds and the loopback hosts
+
+    Returns:
+        list: (kind, host, port) of each listener
+    """
+    listeners = []
+    servers = []
+    kinds = itertools.cycle([RPC, RPC, SILENT, CLOSED])
+    hosts = itertools.cycle(loopback_hosts())
+    for _ in range(count):
+        kind, host = next(kinds), next(hosts)
+        if kind == CLOSED:
+            listeners.append((kind, host, free_port(host)))
+            continue
+        server = StreamServer((host, 0), answer_rpc if kind == RPC else stay_silent, backlog=4096)
+        server.start()
+        servers.append(server)
+        listeners.append((kind, host, server.server_port))
+    return listeners, servers
+
+
+def build_targets(listeners, count, kind):
+    targets = []
+    expected = {}
+    for i in range(count):
+        listener_kind, host, port = listeners[i % len(listeners)]
+        addresses = [host]
+        if i % 5 == 0:
+            addresses.insert(0, UNREACHABLE_IPV6)
+        key = ("demo", i)
+        targets.append(probe.ProbeTarget(key, addresses, port, kind))
+        expected[key] = listener_kind == RPC or (listener_kind == SILENT and kind == probe.TCP)
+    return targets, expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", type=int, default=5000)
+    parser.add_argument("--listeners", type=int, default=30)
+    parser.add_argument("--concurrency", type=int, default=1000)
+    parser.add_argument("--timeout", type=float, default=1)
+    parser.add_argument("--kind", choices=[probe.HTTP, probe.TCP], default=probe.HTTP)
+    args = parser.parse_args()
+
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit < 2 * args.concurrency + 100:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard_limit, 2 * args.concurrency + 100), hard_limit))
+
+    listeners, servers = start_listeners(args.listeners)
+    targets, expected = build_targets(listeners, args.targets, args.kind)
+    engine = probe.ProbeEngine(concurrency=args.concurrency, timeout=args.timeout)
+
+    start = time.monotonic()
+    results = engine.run(targets)
+    duration = time.monotonic() - start
+    for server in servers:
+        server.stop()
+
+    wrong = [key for key, result in results.items() if result.alive != expected[key]]
+    summary = probe.summarize(results)
+    print(f"{len(results)} {args.kind} probes over {len(listeners)} listeners in {duration:.2f}s")
+    print(f"{len(results) / duration:.0f} probes/s with {args.concurrency} in flight")
+    print(f"summary: {summary}")
+    if len(results) != len(targets) or wrong:
+        print(f"{len(wrong)} wrong results, e.g. {[results[key] for key in wrong[:3]]}")
+        sys.exit(1)
+    print("all results match the listeners")
+
+
+if __name__ == "__main__":
+    main()
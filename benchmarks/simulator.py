@@ -0,0 +1,941 @@
+"""
+In-process simulator of the grid services used by jukebox, for reproducible load and regression benchmarks.
+
+It covers the subset of `j.sals.zos` (pools, workloads, nodes finder, explorer farms and prices, billing),
+the reservation_chatflow deployer (network views, network and container deployment, workload waits), the vdc
+Scheduler and the Stellar wallets that jukebox uses. Every explorer call sleeps for a latency drawn from a
+configurable distribution and can fail with a configurable rate; workloads are provisioned after a delay and
+can fail too. All randomness comes from one seeded generator, so runs are reproducible.
+
+Usage:
+    grid = SimulatedGrid(
+        farms={"freefarm": FarmSpec(nodes=20), "lochrist": FarmSpec(nodes=5, down_ratio=0.2)},
+        latency={"default": Latency(median=0.05), "workloads.deploy": Latency(median=0.2)},
+        failure_rates={"workload": 0.02},
+        time_scale=0.1,
+    )
+    with install(grid):
+        ...  # JukeboxDeployment, services and chat helpers now talk to the simulated grid
+
+    python benchmarks/simulator.py [--containers 20] [--farms 2] [--time-scale 0.1]
+"""
+import argparse
+import contextlib
+import datetime
+import itertools
+import json
+import math
+import random
+import time
+from collections import Counter, namedtuple
+from types import SimpleNamespace
+from unittest import mock
+
+import gevent
+import requests
+
+try:
+    from jumpscale.clients.explorer.models import NextAction, State as WorkloadState
+except ImportError:
+    NextAction = WorkloadState = None
+
+try:
+    from jumpscale.sals.zos.billing import InsufficientFunds
+except ImportError:
+
+    class InsufficientFunds(Exception):
+        pass
+
+
+POOL_EXPIRATION_VALUE = 9223372036854775807
+TRANSACTION_FEES = 0.1
+SESSION = requests.Session()  # explorer client session, gets the limiter mounted but the simulated calls skip it
+
+FarmSpec = namedtuple(
+    "FarmSpec",
+    ["nodes", "cru", "mru", "hru", "public_ip_ratio", "down_ratio", "cu_price", "su_price"],
+    defaults=[10, 32, 128, 4000, 0.5, 0.0, 0.1, 0.05],
+)
+FarmSpec.__doc__ = "Farm topology: number of nodes, resources per node (mru and hru in GB) and unit prices per hour"
+
+
+class SimulatedFailure(Exception):
+    pass
+
+
+class Latency:
+    def __init__(self, median=0.05, sigma=0.5, minimum=0.0):
+        """Log-normal latency distribution in seconds, `sigma=0` makes it fixed"""
+        self.median = median
+        self.sigma = sigma
+        self.minimum = minimum
+
+    def sample(self, rng):
+        if not self.sigma:
+            return self.median
+        return max(self.minimum, rng.lognormvariate(math.log(self.median), self.sigma))
+
+
+class SimNode:
+    def __init__(self, node_id, farm, spec, public_ip, up):
+        self.node_id = node_id
+        self.farm_id = farm.id
+        self.farm_name = farm.name
+        self.total_resources = SimpleNamespace(cru=spec.cru, mru=spec.mru, hru=spec.hru, sru=0)
+        self.reserved_resources = SimpleNamespace(cru=0, mru=0, hru=0, sru=0)
+        self.public_ip = public_ip
+        self.up = up
+
+    def fits(self, cru=0, mru=0, hru=0):
+        total, reserved = self.total_resources, self.reserved_resources
+        return total.cru - reserved.cru >= cru and total.mru - reserved.mru >= mru and total.hru - reserved.hru >= hru
+
+    def reserve(self, cru, mru, hru, sign=1):
+        self.reserved_resources.cru += sign * cru
+        self.reserved_resources.mru += sign * mru
+        self.reserved_resources.hru += sign * hru
+
+
+class SimPool:
+    def __init__(self, pool_id, farm_name, owner, now):
+        self.pool_id = pool_id
+        self.farm_name = farm_name
+        self.owner = owner
+        self.cus = 0.0
+        self.sus = 0.0
+        self.ipv4us = 0.0
+        self.active = {}  # {wid: (cu, su) per second}
+        self._updated = now
+
+    def drain(self, now):
+        cu_rate = sum(cu for cu, _ in self.active.values())
+        su_rate = sum(su for _, su in self.active.values())
+        elapsed = now - self._updated
+        self.cus = max(self.cus - cu_rate * elapsed, 0)
+        self.sus = max(self.sus - su_rate * elapsed, 0)
+        self._updated = now
+        return cu_rate, su_rate
+
+    def view(self, now):
+        cu_rate, su_rate = self.drain(now)
+        remaining = [units / rate for units, rate in ((self.cus, cu_rate), (self.sus, su_rate)) if rate]
+        if not remaining or min(remaining) == 0:
+            empty_at = POOL_EXPIRATION_VALUE
+        else:
+            empty_at = int(now + min(remaining))
+        return SimpleNamespace(
+            pool_id=self.pool_id,
+            cus=self.cus,
+            sus=self.sus,
+            ipv4us=self.ipv4us,
+            empty_at=empty_at,
+            active_workload_ids=list(self.active),
+            node_ids=[],
+            customer_tid=self.owner,
+        )
+
+
+class SimNetwork:
+    def __init__(self, name, ip_range, owner):
+        self.name = name
+        self.ip_range = ip_range
+        self.owner = owner
+        self.nodes = {}  # {node_id: subnet index}
+        self.used_ips = set()
+        self.workload_ids = []
+
+    def _prefix(self):
+        return ".".join(self.ip_range.split(".")[:2])
+
+    def add_node(self, node_id):
+        if node_id not in self.nodes:
+            self.nodes[node_id] = len(self.nodes) + 2
+        return self.nodes[node_id]
+
+
+class SimNetworkView:
+    def __init__(self, grid, network):
+        self._grid = grid
+        self._network = network
+        self.name = network.name
+        self.iprange = network.ip_range
+
+    @property
+    def network_workloads(self):
+        return [self._grid.workloads[wid] for wid in self._network.workload_ids]
+
+    def copy(self):
+        return SimNetworkView(self._grid, self._network)
+
+    def get_node_free_ips(self, node):
+        subnet = self._network.nodes.get(node.node_id)
+        if subnet is None:
+            return []
+        prefix = self._network._prefix()
+        candidates = (f"{prefix}.{subnet}.{host}" for host in range(2, 255))
+        return [ip for ip in candidates if ip not in self._network.used_ips]
+
+
+class SimWallet:
+    def __init__(self, grid, name, balance):
+        self._grid = grid
+        self.instance_name = name
+        self.address = f"G{name.upper():A<55}"[:56]
+        self.balances = {"TFT": balance, "XLM": 10}
+        self.network = SimpleNamespace(value="TEST")
+
+    def activate_through_activation_wallet(self):
+        self._grid.call("stellar.activate")
+
+    def add_known_trustline(self, asset_code):
+        self._grid.call("stellar.trustline")
+
+    def save(self):
+        pass
+
+    def _get_asset(self, code="TFT"):
+        return SimpleNamespace(code=code, issuer="GSIMULATEDISSUER")
+
+    def get_balance_by_asset(self, asset="TFT"):
+        self._grid.call("stellar.balance")
+        return self.balances.get(asset, 0)
+
+    def transfer(self, destination_address, amount, asset="TFT", memo_text=None, **kwargs):
+        self._grid.call("stellar.transfer")
+        code = asset.split(":")[0]
+        if self.balances.get(code, 0) < amount + TRANSACTION_FEES:
+            raise InsufficientFunds(f"{self.instance_name} doesn't have {amount} {code}")
+        self.balances[code] -= amount + TRANSACTION_FEES
+        for wallet in self._grid.wallets.values():
+            if wallet.address == destination_address:
+                wallet.balances[code] = wallet.balances.get(code, 0) + amount
+        return f"tx-{next(self._grid._ids)}"
+
+
+class SimulatedGrid:
+    def __init__(
+        self,
+        farms=None,
+        latency=None,
+        failure_rates=None,
+        provision_time=Latency(median=5, sigma=0.3),
+        payment_delay=Latency(median=3, sigma=0.3),
+        time_scale=1.0,
+        seed=0,
+        unit_costs=None,
+    ):
+        """Simulated grid state and explorer/Stellar behaviour
+
+        Arguments:
+            farms (dict): {farm_name: FarmSpec}
+            latency (dict): {operation or "default": Latency} of the explorer and Stellar calls, operations are
+                named like "pools.create", "workloads.get" or "stellar.transfer"
+            failure_rates (dict): {operation, "workload" or "network": probability of failure}
+            provision_time (Latency): delay before a workload is provisioned
+            payment_delay (Latency): delay before a pool payment is released
+            time_scale (float): multiplier applied to all simulated delays and to jukebox polling intervals
+            seed (int): seed of the random generator
+            unit_costs (callable): (cpu, memory, disk_size) -> (cu, su) per second, defaults to jukebox pricing
+        """
+        self.rng = random.Random(seed)
+        self.latency = {"default": Latency(median=0.05)}
+        self.latency.update(latency or {})
+        self.failure_rates = failure_rates or {}
+        self.provision_time = provision_time
+        self.payment_delay = payment_delay
+        self.time_scale = time_scale
+        self.unit_costs = unit_costs or self._default_unit_costs
+        self.calls = Counter()
+        self.failures = Counter()
+        self._ids = itertools.count(1000)
+        self.farms = {}
+        self.nodes = {}
+        self.pools = {}
+        self.payments = {}  # {reservation_id: {"pool_id", "amount", "released_at", "cu", "su"}}
+        self.workloads = {}
+        self._workload_state = {}  # {wid: (ready_at, succeeds, cost)}
+        self.networks = {}  # {(identity_name, network_name): SimNetwork}
+        self.blocked_nodes = {}
+        self.wallets = {}
+        self.start = time.monotonic()
+        for farm_name, spec in (farms or {"freefarm": FarmSpec()}).items():
+            self.add_farm(farm_name, spec)
+
+    @staticmethod
+    def _default_unit_costs(cpu, memory, disk_size):
+        try:
+            from jumpscale.sals.jukebox.pricing import unit_costs
+
+            return unit_costs(cpu, memory, disk_size)
+        except ImportError:
+            return min(cpu, memory / 1024 / 4) / 3600, disk_size / 1024 / 300 / 3600
+
+    # topology
+
+    def add_farm(self, farm_name, spec):
+        farm = SimpleNamespace(id=next(self._ids), name=farm_name, spec=spec)
+        self.farms[farm_name] = farm
+        for index in range(spec.nodes):
+            node_id = f"{farm_name}-node-{index}"
+            self.nodes[node_id] = SimNode(
+                node_id,
+                farm,
+                spec,
+                public_ip=self.rng.random() < spec.public_ip_ratio,
+                up=self.rng.random() >= spec.down_ratio,
+            )
+        return farm
+
+    def set_node_up(self, node_id, up=True):
+        self.nodes[node_id].up = up
+
+    def add_wallet(self, name, balance=1000):
+        self.wallets[name] = SimWallet(self, name, balance)
+        return self.wallets[name]
+
+    # behaviour
+
+    def now(self):
+        """Simulated timestamp, advancing `1 / time_scale` times faster than the wall clock"""
+        return datetime.datetime.utcnow().timestamp() + (time.monotonic() - self.start) * (1 / self.time_scale - 1)
+
+    def sleep(self, latency):
+        gevent.sleep(latency.sample(self.rng) * self.time_scale)
+
+    def call(self, operation):
+        """Account an explorer or Stellar call, sleeping for its latency and failing at its failure rate"""
+        self.calls[operation] += 1
+        self.sleep(self.latency.get(operation, self.latency["default"]))
+        if self.rng.random() < self.failure_rates.get(operation, 0):
+            self.failures[operation] += 1
+            raise SimulatedFailure(f"Simulated failure of {operation}")
+
+    def zos(self, identity_name=None):
+        return SimZos(self, identity_name or "system")
+
+    def _farm_prices(self, farm_name):
+        spec = self.farms[farm_name].spec
+        return {"cu": spec.cu_price, "su": spec.su_price, "ipv4u": 0}
+
+    def _price(self, cus, sus, farm_prices):
+        return (cus * farm_prices["cu"] + sus * farm_prices["su"]) / 3600
+
+    def _reserve_pool(self, pool_id, cu, su, ipv4us, reservation_id=None):
+        reservation_id = reservation_id or next(self._ids)
+        pool = self.pools[pool_id]
+        amount = self._price(cu, su, self._farm_prices(pool.farm_name))
+        self.payments[reservation_id] = dict(pool_id=pool_id, amount=amount, cu=cu, su=su, released_at=None)
+        escrow = SimpleNamespace(address=f"GESCROW{reservation_id}", amount=amount, asset="TFT")
+        return SimpleNamespace(reservation_id=reservation_id, escrow_information=escrow)
+
+    def _pay(self, wallet, payment_detail):
+        payment = self.payments[payment_detail.reservation_id]
+        wallet.transfer(payment_detail.escrow_information.address, payment["amount"], asset="TFT")
+        delay = self.payment_delay.sample(self.rng)
+        payment["released_at"] = self.now() + delay
+
+    def _payment_info(self, reservation_id):
+        payment = self.payments[reservation_id]
+        released = bool(payment["released_at"] and self.now() >= payment["released_at"])
+        if released and not payment.get("applied"):
+            pool = self.pools[payment["pool_id"]]
+            pool.drain(self.now())
+            pool.cus += payment["cu"]
+            pool.sus += payment["su"]
+            payment["applied"] = True
+        return SimpleNamespace(paid=bool(payment["released_at"]), released=released)
+
+    def _new_workload(self, identity_name, node_id, pool_id, workload_type, cost=None):
+        wid = next(self._ids)
+        node = self.nodes[node_id]
+        failure_rate = self.failure_rates.get("network" if workload_type == "network" else "workload", 0)
+        succeeds = node.up and self.rng.random() >= failure_rate
+        ready_at = self.now() + self.provision_time.sample(self.rng)
+        workload = SimpleNamespace(
+            id=wid,
+            info=SimpleNamespace(
+                node_id=node_id,
+                pool_id=pool_id,
+                workload_type=workload_type,
+                epoch=datetime.datetime.utcnow(),
+                next_action=NextAction.DEPLOY if NextAction else "DEPLOY",
+                metadata="",
+                customer_tid=identity_name,
+                result=SimpleNamespace(workload_id=None, state=None, data_json="", message=""),
+            ),
+        )
+        self.workloads[wid] = workload
+        self._workload_state[wid] = (ready_at, succeeds, cost)
+        return workload
+
+    def _refresh_workload(self, workload):
+        ready_at, succeeds, cost = self._workload_state[workload.id]
+        result = workload.info.result
+        if result.workload_id or self.now() < ready_at:
+            return workload
+        result.workload_id = workload.id
+        if succeeds:
+            result.state = WorkloadState.Ok if WorkloadState else "OK"
+            if workload.info.workload_type == "container":
+                result.data_json = f'{{"ipv4": "{workload.ip_address}", "ipv6": "2a02:1802::{workload.id:x}"}}'
+                self.pools[workload.info.pool_id].drain(self.now())
+                self.pools[workload.info.pool_id].active[workload.id] = cost
+        else:
+            result.state = WorkloadState.Error if WorkloadState else "ERROR"
+            result.message = "Simulated provisioning failure"
+            self._release(workload)
+        return workload
+
+    def _release(self, workload):
+        capacity = getattr(workload, "capacity", None)
+        if capacity and not getattr(workload, "released", False):
+            self.nodes[workload.info.node_id].reserve(*capacity, sign=-1)
+            workload.released = True
+        pool = self.pools.get(workload.info.pool_id)
+        if pool and workload.id in pool.active:
+            pool.drain(self.now())
+            pool.active.pop(workload.id)
+
+    def get_workload(self, wid):
+        return self._refresh_workload(self.workloads[wid])
+
+    def decomission(self, wid):
+        workload = self.workloads[wid]
+        workload.info.next_action = NextAction.DELETE if NextAction else "DELETE"
+        self._release(workload)
+
+    def deploy_container(
+        self,
+        identity_name,
+        pool_id,
+        node_id,
+        network_name,
+        ip_address,
+        cpu,
+        memory,
+        disk_size,
+        env=None,
+        flist="",
+        entrypoint="",
+        metadata="",
+        ready=False,
+    ):
+        """Reserve a container on a node, `ready` makes it provisioned right away"""
+        node = self.nodes[node_id]
+        capacity = (cpu, memory / 1024, disk_size / 1024)
+        if not node.fits(*capacity):
+            raise SimulatedFailure(f"Node {node_id} is out of capacity")
+        node.reserve(*capacity)
+        workload = self._new_workload(
+            identity_name, node_id, pool_id, "container", cost=self.unit_costs(cpu, memory, disk_size)
+        )
+        workload.capacity = capacity
+        workload.ip_address = ip_address
+        workload.environment = dict(env or {})
+        workload.flist = flist
+        workload.entrypoint = entrypoint
+        workload.info.metadata = metadata
+        if ready:
+            _, _, cost = self._workload_state[workload.id]
+            self._workload_state[workload.id] = (0, True, cost)
+            self._refresh_workload(workload)
+        network = self.networks.get((identity_name, network_name))
+        if network:
+            network.used_ips.add(ip_address)
+        return workload.id
+
+
+class SimPools:
+    def __init__(self, zos):
+        self._zos = zos
+        self._grid = zos._grid
+
+    def create(self, cu, su, ipv4us=0, farm="freefarm", **kwargs):
+        self._grid.call("pools.create")
+        pool_id = next(self._grid._ids)
+        self._grid.pools[pool_id] = SimPool(pool_id, farm, self._zos.identity_name, self._grid.now())
+        # like the explorer, the reservation creating a pool has the id of the pool
+        return self._grid._reserve_pool(pool_id, cu, su, ipv4us, reservation_id=pool_id)
+
+    def extend(self, pool_id, cu, su, ipv4us=0, **kwargs):
+        self._grid.call("pools.extend")
+        return self._grid._reserve_pool(pool_id, cu, su, ipv4us)
+
+    def get(self, pool_id):
+        self._grid.call("pools.get")
+        return self._grid.pools[pool_id].view(self._grid.now())
+
+    def get_payment_info(self, reservation_id):
+        self._grid.call("pools.get_payment_info")
+        return self._grid._payment_info(reservation_id)
+
+
+class SimWorkloads:
+    def __init__(self, zos):
+        self._grid = zos._grid
+        self._zos = zos
+
+    def get(self, wid):
+        self._grid.call("workloads.get")
+        return self._grid.get_workload(wid)
+
+    def deploy(self, workload):
+        self._grid.call("workloads.deploy")
+        return self._grid.deploy_container(self._zos.identity_name, metadata=workload.info.metadata, **workload.spec)
+
+    def decomission(self, wid):
+        self._grid.call("workloads.decomission")
+        self._grid.decomission(wid)
+
+
+class SimContainers:
+    def __init__(self, zos):
+        self._grid = zos._grid
+
+    def encrypt_secret(self, node_id, value):
+        return f"encrypted:{value}"
+
+    def create(
+        self, node_id, network_name, ip_address, flist, capacity_pool_id, cpu=1, memory=1024, disk_size=256, **kwargs
+    ):
+        spec = dict(
+            pool_id=capacity_pool_id,
+            node_id=node_id,
+            network_name=network_name,
+            ip_address=ip_address,
+            cpu=cpu,
+            memory=memory,
+            disk_size=disk_size,
+            env=kwargs.get("env"),
+            flist=flist,
+            entrypoint=kwargs.get("entrypoint", ""),
+        )
+        capacity = SimpleNamespace(cpu=cpu, memory=memory, disk_size=disk_size, disk_type=None)
+        return SimpleNamespace(spec=spec, capacity=capacity, info=SimpleNamespace(metadata="", description=""))
+
+
+class SimNodesFinder:
+    def __init__(self, zos):
+        self._grid = zos._grid
+
+    def nodes_search(self, farm_id=None, **kwargs):
+        self._grid.call("nodes.search")
+        return [node for node in self._grid.nodes.values() if farm_id is None or node.farm_id == farm_id]
+
+    def filter_is_up(self, node):
+        return node.up
+
+    def filter_public_ip4(self, node):
+        return node.public_ip
+
+
+class SimFarms:
+    def __init__(self, grid):
+        self._grid = grid
+
+    def list(self):
+        self._grid.call("farms.list")
+        return list(self._grid.farms.values())
+
+    def get(self, farm_id=None, farm_name=None):
+        self._grid.call("farms.get")
+        return next(farm for farm in self._grid.farms.values() if farm.id == farm_id or farm.name == farm_name)
+
+    def get_deal_for_threebot(self, farm_id, tid):
+        self._grid.call("farms.get_deal")
+        farm_name = next(farm.name for farm in self._grid.farms.values() if farm.id == farm_id)
+        return {"custom_cloudunits_price": self._grid._farm_prices(farm_name)}
+
+
+class SimPrices:
+    def __init__(self, grid):
+        self._grid = grid
+
+    def calculate(self, cus, sus, ipv4us, farm_prices):
+        return self._grid._price(cus, sus, farm_prices)
+
+
+class SimExplorer:
+    def __init__(self, zos):
+        self.farms = SimFarms(zos._grid)
+        self.prices = SimPrices(zos._grid)
+        self._session = SESSION
+
+
+class SimZos:
+    def __init__(self, grid, identity_name):
+        self._grid = grid
+        self.identity_name = identity_name
+        self.pools = SimPools(self)
+        self.workloads = SimWorkloads(self)
+        self.container = SimContainers(self)
+        self.nodes_finder = SimNodesFinder(self)
+        self._explorer = SimExplorer(self)
+        self.billing = SimpleNamespace(payout_farmers=grid._pay)
+
+
+class SimDeployer:
+    """The reservation_chatflow deployer methods used by jukebox"""
+
+    def __init__(self, grid):
+        self._grid = grid
+
+    def get_network_view(self, network_name, identity_name=None, **kwargs):
+        self._grid.call("workloads.list")
+        network = self._grid.networks.get((identity_name, network_name))
+        return SimNetworkView(self._grid, network) if network else None
+
+    def deploy_network(self, name, access_node, ip_range, ip_version, pool_id, identity_name=None, **kwargs):
+        self._grid.call("workloads.deploy")
+        network = self._grid.networks.setdefault((identity_name, name), SimNetwork(name, ip_range, identity_name))
+        network.add_node(access_node.node_id)
+        workload = self._grid._new_workload(identity_name, access_node.node_id, pool_id, "network")
+        network.workload_ids.append(workload.id)
+        return {"ids": [workload.id], "wg": f"[Interface]\nAddress = {network._prefix()}.255.2/32\n"}
+
+    def add_network_node(self, name, node, pool_id, network_view=None, identity_name=None, **kwargs):
+        network = self._grid.networks[(identity_name, name)]
+        if node.node_id in network.nodes:
+            return None
+        self._grid.call("workloads.deploy")
+        network.add_node(node.node_id)
+        workload = self._grid._new_workload(identity_name, node.node_id, pool_id, "network")
+        network.workload_ids.append(workload.id)
+        return {"ids": [workload.id]}
+
+    def deploy_container(
+        self,
+        pool_id,
+        node_id,
+        network_name,
+        ip_address,
+        flist,
+        identity_name=None,
+        cpu=1,
+        memory=1024,
+        disk_size=256,
+        **kwargs,
+    ):
+        self._grid.call("workloads.deploy")
+        env = kwargs.pop("env", None)
+        entrypoint = kwargs.pop("entrypoint", "")
+        for argument in ("secret_env", "interactive", "public_ipv6", "disk_type", "volumes", "log_config"):
+            kwargs.pop(argument, None)
+        return self._grid.deploy_container(
+            identity_name,
+            pool_id,
+            node_id,
+            network_name,
+            ip_address,
+            cpu,
+            memory,
+            disk_size,
+            env=env,
+            flist=flist,
+            entrypoint=entrypoint,
+            metadata=self.encrypt_metadata(kwargs),
+        )
+
+    def wait_workload(self, workload_id, bot=None, expiry=10, breaking_node_id=None, identity_name=None, **kwargs):
+        expiration = self._grid.now() + expiry * 60
+        while self._grid.now() < expiration:
+            self._grid.call("workloads.get")
+            workload = self._grid.get_workload(workload_id)
+            if workload.info.result.workload_id:
+                return workload.info.result.state == (WorkloadState.Ok if WorkloadState else "OK")
+            gevent.sleep(1 * self._grid.time_scale)
+        self._grid.decomission(workload_id)
+        return False
+
+    def encrypt_metadata(self, metadata, identity_name=None):
+        if isinstance(metadata, dict):
+            metadata = json.dumps(metadata)
+        return f"encrypted:{metadata}"
+
+    def decrypt_metadata(self, encrypted_metadata, identity_name=None):
+        return encrypted_metadata[len("encrypted:") :]
+
+
+class SimScheduler:
+    def __init__(self, grid, farm_name=None, pool_id=None, **kwargs):
+        self._grid = grid
+        self.farm_name = farm_name or (grid.pools[pool_id].farm_name if pool_id else None)
+        self.excluded = set()
+
+    def exclude_nodes(self, *node_ids):
+        self.excluded.update(node_ids)
+
+    def nodes_by_capacity(self, cru=0, sru=0, mru=0, hru=0, ip_version=None, accessnodes=False, **kwargs):
+        self._grid.call("nodes.search")
+        nodes = [
+            node
+            for node in self._grid.nodes.values()
+            if node.farm_name == self.farm_name
+            and node.up
+            and node.node_id not in self.excluded
+            and node.fits(cru, mru, hru)
+            and (node.public_ip or not accessnodes)
+        ]
+        self._grid.rng.shuffle(nodes)
+        yield from nodes
+
+
+class SimReservationChatflow:
+    def __init__(self, grid):
+        self._grid = grid
+        self._ranges = itertools.count(1)
+
+    def block_node(self, node_id):
+        self._grid.blocked_nodes[node_id] = self._grid.now()
+
+    def unblock_node(self, node_id):
+        self._grid.blocked_nodes.pop(node_id, None)
+
+    def list_blocked_nodes(self):
+        return dict(self._grid.blocked_nodes)
+
+    def get_ip_range(self, *args, **kwargs):
+        return f"10.{next(self._ranges) % 250}.0.0/16"
+
+
+class SimFleet:
+    def __init__(self, grid):
+        """In-memory stand-in for the jukebox deployments factory (`j.sals.jukebox`), counting store reads"""
+        self._grid = grid
+        self.deployments = {}  # {instance_name: JukeboxDeployment}
+        self.reads = Counter()
+        self._candidates = {}  # {farm_name: [SimNode]}
+        self._cursor = 0
+
+    def list_all(self):
+        self.reads["list_all"] += 1
+        return list(self.deployments)
+
+    def find(self, name=None, solution_type=None, identity_name=None, deployment_name=None):
+        if identity_name and identity_name.endswith(".3bot"):
+            identity_name = identity_name[: -len(".3bot")]
+        self.reads["find"] += 1
+        deployment = self.deployments.get(name or f"{solution_type}_{identity_name}_{deployment_name}")
+        if deployment and identity_name and deployment.identity_name != identity_name:
+            return None
+        return deployment
+
+    def list(self, identity_name):
+        self.reads["find_many"] += 1
+        self.reads["find"] += len(self.deployments)  # find_many loads every instance to filter them
+        return [deployment for deployment in self.deployments.values() if deployment.identity_name == identity_name]
+
+    def list_deployments(self, identity_name, solution_type):
+        return [deployment for deployment in self.list(identity_name) if deployment.solution_type == solution_type]
+
+    def delete(self, name):
+        """Cancel the workloads of a deployment and drop it, like `BlockchainStoredFactory.delete`"""
+        from jumpscale.sals.jukebox import stats, utils
+        from jumpscale.sals.jukebox.models import State
+
+        self.reads["delete"] += 1
+        deployment = self.deployments.pop(name, None)
+        if deployment:
+            for blockchain_node in deployment.nodes:
+                deployment.zos.workloads.decomission(blockchain_node.wid)
+                blockchain_node.state = State.DELETED
+        stats.remove(name)
+        utils.evict_deployment_cache(name)
+
+    def add_synthetic(
+        self,
+        identity_name,
+        deployment_name,
+        nodes=3,
+        farm_name=None,
+        solution_type="ubuntu",
+        expire_in=60 * 60 * 24 * 30,
+        auto_extend=False,
+        errored=0,
+        profile=(1, 1024, 10 * 1024),
+    ):
+        """Add a deployed deployment with its pool, network and provisioned containers, without latency
+
+        Arguments:
+            expire_in (int): seconds of capacity bought for the containers
+            errored (int): number of nodes marked as ERROR
+            profile (tuple): cpu, memory and disk_size of the containers in MB
+        """
+        from jumpscale.sals.jukebox.jukebox import JukeboxDeployment
+        from jumpscale.sals.jukebox.models import BlockchainNode, State
+
+        grid = self._grid
+        farm_name = farm_name or next(iter(grid.farms))
+        if identity_name not in grid.wallets:
+            grid.add_wallet(identity_name)
+        cpu, memory, disk_size = profile
+        pool_id = next(grid._ids)
+        pool = SimPool(pool_id, farm_name, identity_name, grid.now())
+        cu, su = grid.unit_costs(cpu, memory, disk_size)
+        pool.cus, pool.sus = cu * nodes * expire_in, su * nodes * expire_in
+        grid.pools[pool_id] = pool
+        network_name = f"{identity_name}_{pool_id}"
+        network = SimNetwork(network_name, f"10.{pool_id % 250}.0.0/16", identity_name)
+        grid.networks[(identity_name, network_name)] = network
+
+        instance_name = f"{solution_type}_{identity_name}_{deployment_name}"
+        deployment = JukeboxDeployment(
+            instance_name_=instance_name,
+            solution_type=solution_type,
+            identity_name=identity_name,
+            deployment_name=deployment_name,
+            nodes_count=nodes,
+        )
+        deployment.cpu, deployment.memory, deployment.disk_size = cpu, memory, disk_size
+        deployment.farm_name = farm_name
+        deployment.pool_ids = [pool_id]
+        deployment.farm_names = [farm_name]
+        deployment.auto_extend = auto_extend
+        deployment.expiration_date = grid.now() + expire_in
+        deployment.state = State.ERROR if errored else State.DEPLOYED
+        deployment.secret_env = SimDeployer(grid).encrypt_metadata({})  # the chatflows always store one
+        candidates = self._candidates.get(farm_name)
+        if candidates is None:
+            candidates = [node for node in grid.nodes.values() if node.farm_name == farm_name and node.up]
+            self._candidates[farm_name] = candidates
+        metadata = SimDeployer(grid).encrypt_metadata({"form_info": {"chatflow": solution_type}})
+        for index in range(nodes):
+            # round robin from the last used node, so filling a big fleet doesn't rescan the full nodes
+            for attempt in range(len(candidates)):
+                node = candidates[(self._cursor + attempt) % len(candidates)]
+                if node.fits(cpu, memory / 1024, disk_size / 1024):
+                    self._cursor += attempt + 1
+                    break
+            else:
+                raise SimulatedFailure(f"No capacity left on farm {farm_name}")
+            subnet = network.add_node(node.node_id)
+            ip_address = f"{network._prefix()}.{subnet}.{len(network.used_ips) + 2}"
+            wid = grid.deploy_container(
+                identity_name,
+                pool_id,
+                node.node_id,
+                network_name,
+                ip_address,
+                cpu,
+                memory,
+                disk_size,
+                env={"SOLUTION": solution_type},
+                flist=f"https://hub.grid.tf/jukebox/{solution_type}.flist",
+                metadata=metadata,
+                ready=True,
+            )
+            blockchain_node = BlockchainNode()
+            blockchain_node.wid = wid
+            blockchain_node.node_id = node.node_id
+            blockchain_node.pool_id = pool_id
+            blockchain_node.ipv4_address = ip_address
+            blockchain_node.state = State.ERROR if index < errored else State.DEPLOYED
+            deployment.nodes.append(blockchain_node)
+        self.deployments[instance_name] = deployment
+        return deployment
+
+
+@contextlib.contextmanager
+def install(grid, persist=False, fleet=None):
+    """Route the jukebox calls to the simulated grid while the context is active
+
+    Arguments:
+        grid (SimulatedGrid): simulated grid
+        persist (bool): save deployments to the jukebox store, by default `save` is a no-op
+        fleet (SimFleet): serve `j.sals.jukebox` listings from this fleet instead of the store
+    """
+    from jumpscale.loader import j
+    from jumpscale.sals.reservation_chatflow import deployer
+    from jumpscale.sals.jukebox import jukebox, payments, pricing, speculative
+
+    sim_deployer = SimDeployer(grid)
+    sim_chatflow = SimReservationChatflow(grid)
+
+    def find_wallet(name=None, *args, **kwargs):
+        return grid.wallets.get(name)
+
+    def new_wallet(name, *args, **kwargs):
+        return grid.add_wallet(name)
+
+    def farm_prices(farm_id, zos=None):
+        return grid.zos()._explorer.farms.get_deal_for_threebot(farm_id, None)["custom_cloudunits_price"]
+
+    def container_cost(container, duration, farm_id=None):
+        cu, su = grid.unit_costs(container.capacity.cpu, container.capacity.memory, container.capacity.disk_size)
+        farm_name = next(farm.name for farm in grid.farms.values() if farm.id == farm_id)
+        return grid._price(cu * duration, su * duration, grid._farm_prices(farm_name))
+
+    with contextlib.ExitStack() as stack:
+        patch = lambda target, name, value: stack.enter_context(mock.patch.object(target, name, value))
+        patch(j.sals.zos, "get", grid.zos)
+        for name in ("get_network_view", "deploy_network", "add_network_node", "deploy_container", "wait_workload"):
+            patch(deployer, name, getattr(sim_deployer, name))
+        for name in ("encrypt_metadata", "decrypt_metadata"):
+            patch(deployer, name, getattr(sim_deployer, name))
+        for name in ("block_node", "unblock_node", "list_blocked_nodes", "get_ip_range"):
+            patch(j.sals.reservation_chatflow.reservation_chatflow, name, getattr(sim_chatflow, name))
+        scheduler = lambda *args, **kwargs: SimScheduler(grid, *args, **kwargs)
+        patch(jukebox, "Scheduler", scheduler)
+        patch(speculative, "Scheduler", scheduler)
+        patch(j.clients.stellar, "find", find_wallet)
+        patch(j.clients.stellar, "get", find_wallet)
+        patch(j.clients.stellar, "new", new_wallet)
+        patch(j.clients.stellar, "delete", lambda name=None, *args, **kwargs: grid.wallets.pop(name, None))
+        patch(j.clients.stellar, "list_all", lambda: list(grid.wallets))
+        patch(j.clients.stellar, "check_stellar_service", lambda: True)
+        patch(j.tools.zos.consumption, "cost", container_cost)
+        patch(pricing, "get_farm_prices", farm_prices)
+        patch(payments, "MIN_INTERVAL", payments.MIN_INTERVAL * grid.time_scale)
+        patch(payments, "MAX_INTERVAL", payments.MAX_INTERVAL * grid.time_scale)
+        patch(jukebox, "WORKLOAD_POLL_INTERVAL", jukebox.WORKLOAD_POLL_INTERVAL * grid.time_scale)
+        if not persist:
+            patch(jukebox.JukeboxDeployment, "save", lambda self: None)
+        if fleet:
+            for name in ("list_all", "find", "list", "list_deployments", "delete"):
+                patch(j.sals.jukebox, name, getattr(fleet, name))
+        yield grid
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--containers", type=int, default=20)
+    parser.add_argument("--farms", type=int, default=1)
+    parser.add_argument("--time-scale", type=float, default=0.1)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from jumpscale.sals.jukebox.jukebox import JukeboxDeployment
+
+    farms = {f"farm{index}": FarmSpec(nodes=10) for index in range(args.farms)}
+    grid = SimulatedGrid(
+        farms=farms, failure_rates={"workload": args.failure_rate}, time_scale=args.time_scale, seed=args.seed
+    )
+    with install(grid):
+        wallet = grid.add_wallet("jukebox_bench", balance=10 ** 6)
+        deployment = JukeboxDeployment(
+            solution_type="ubuntu", identity_name="jukebox_bench", deployment_name="bench", nodes_count=args.containers
+        )
+        deployment.cpu, deployment.memory, deployment.disk_size = 1, 1024, 10 * 1024
+        split = {farm_name: args.containers // args.farms for farm_name in farms}
+        split[next(iter(farms))] += args.containers - sum(split.values())
+        deployment.farm_name = next(iter(farms))
+
+        start = time.monotonic()
+        pools_split = deployment.create_farm_pools(wallet, split, duration=60 * 60)
+        provisioned = time.monotonic()
+        deployment.deploy_farm_batches(pools_split, flist="https://hub.grid.tf/sim.flist")
+        deployed = time.monotonic()
+        deployment._update_deployment()
+
+    scale = 1 / args.time_scale
+    print(f"pools and networks: {(provisioned - start) * scale:.1f}s simulated")
+    print(f"containers:         {(deployed - provisioned) * scale:.1f}s simulated")
+    print(f"deployed:           {len(deployment.nodes)}/{args.containers}, state {deployment.state}")
+    print("explorer and stellar calls:")
+    for operation, count in sorted(grid.calls.items()):
+        print(f"  {operation:<28} {count}")
+
+
+if __name__ == "__main__":
+    main()
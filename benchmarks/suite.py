@@ -0,0 +1,249 @@
+"""
+Benchmark suite of the deploy pipeline and the background services, run against the simulated grid.
+
+Scenarios:
+    deploy_all_containers/<n>     deploy n containers on a ready pool and network
+    redeploy_containers/<n>       redeploy n errored containers of a 10 nodes deployment
+    <service>/<n>                 one pass of MonitorDeployments, SelfHealing and UpdateDeployment over n deployments
+
+Each scenario reports its wall time, its simulated time (wall time divided by the time scale, the grid latencies
+are scaled down by it) and the explorer and Stellar calls per operation. The pacing sleeps of the services
+between deployments are skipped, they only add a constant `interval * n`.
+
+Results are written as JSON and compared to a baseline: a scenario regresses when its simulated time grows by
+more than `--time-threshold` or its total calls by more than `--calls-threshold`, and the suite then exits with
+status 1. The baseline records the simulator parameters it was run with, results of a run with other parameters are
+not compared to it.
+
+Usage:
+    python benchmarks/suite.py [--quick] [--runs 3] [--sizes 100,1000,10000] [--output results.json]
+    python benchmarks/suite.py --save-baseline            # record benchmarks/baseline.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from contextlib import ExitStack
+from types import SimpleNamespace
+from unittest import mock
+
+import gevent
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from simulator import FarmSpec, Latency, SimFleet, SimulatedGrid, install  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEPLOY_SIZES = [1, 10, 50]
+SERVICE_SIZES = [100, 1000, 10000]
+TIME_THRESHOLD = 0.25
+CALLS_THRESHOLD = 0.1
+PROFILE = (1, 1024, 10 * 1024)
+RUNS = 3  # the gevent scheduling makes single runs noisy
+PARAMETERS = ["latency", "provision_time", "time_scale", "seed"]  # simulator parameters recorded in the baseline
+
+
+def make_grid(args, nodes=50, cru=32):
+    return SimulatedGrid(
+        farms={"freefarm": FarmSpec(nodes=nodes, cru=cru, mru=cru * 4, hru=cru * 200, public_ip_ratio=0.5)},
+        latency={"default": Latency(median=args.latency)},
+        provision_time=Latency(median=args.provision_time, sigma=0.3),
+        payment_delay=Latency(median=3, sigma=0.3),
+        time_scale=args.time_scale,
+        seed=args.seed,
+    )
+
+
+def result(name, grid, wall, **extra):
+    return dict(
+        name=name,
+        wall_s=round(wall, 4),
+        simulated_s=round(wall / grid.time_scale, 2),
+        calls=dict(sorted(grid.calls.items())),
+        total_calls=sum(grid.calls.values()),
+        **extra,
+    )
+
+
+def new_deployment(grid, nodes_count):
+    from jumpscale.sals.jukebox.jukebox import JukeboxDeployment
+
+    deployment = JukeboxDeployment(
+        solution_type="ubuntu", identity_name="jukebox_bench", deployment_name="bench", nodes_count=nodes_count
+    )
+    deployment.cpu, deployment.memory, deployment.disk_size = PROFILE
+    deployment.farm_name = "freefarm"
+    return deployment
+
+
+def bench_deploy(args, nodes_count):
+    grid = make_grid(args)
+    with install(grid):
+        wallet = grid.add_wallet("jukebox_bench", balance=10 ** 6)
+        deployment = new_deployment(grid, nodes_count)
+        pool_id = deployment.create_capacity_pool(wallet, cu=10 ** 6, su=10 ** 7, farm="freefarm")
+        deployment.deploy_network(deployment.network_name_for(pool_id), pool_id=pool_id)
+        grid.calls.clear()
+
+        start = time.monotonic()
+        deployment.deploy_all_containers(
+            nodes_count, network_name=deployment.network_name_for(pool_id), flist="https://hub.grid.tf/sim.flist"
+        )
+        wall = time.monotonic() - start
+    return result(f"deploy_all_containers/{nodes_count}", grid, wall, deployed=len(deployment.nodes))
+
+
+def bench_redeploy(args, errored):
+    from jumpscale.sals.jukebox import utils
+
+    grid = make_grid(args)
+    fleet = SimFleet(grid)
+    with install(grid, fleet=fleet):
+        deployment = fleet.add_synthetic("jukebox_bench", "bench", nodes=10, errored=errored, profile=PROFILE)
+        utils.evict_deployment_cache(deployment.instance_name)
+        grid.calls.clear()
+
+        start = time.monotonic()
+        deployment.redeploy_containers(errored)
+        wall = time.monotonic() - start
+    return result(f"redeploy_containers/{errored}", grid, wall, state=str(deployment.state))
+
+
+def populate(fleet, size):
+    for index in range(size):
+        fleet.add_synthetic(
+            f"jukebox_user{index % max(size // 5, 1)}",
+            f"deployment{index}",
+            nodes=1 + index % 5,
+            # a few percent of the fleet is about to expire or has errored nodes
+            expire_in=60 * 60 * 24 * (1 if index % 25 == 0 else 30),
+            auto_extend=bool(index % 2),
+            errored=1 if index % 50 == 0 else 0,
+            profile=PROFILE,
+        )
+
+
+def bench_service(args, module_name, service_name, size):
+    import importlib
+
+    module = importlib.import_module(f"jumpscale.packages.jukebox.services.{module_name}")
+    nodes = max(size * 3 // 200, 10)
+    grid = make_grid(args, nodes=nodes, cru=256)
+    fleet = SimFleet(grid)
+    with install(grid, fleet=fleet), ExitStack() as stack:
+        populate(fleet, size)
+        # skip the pacing between deployments and the notifications side effects
+        pacing = SimpleNamespace(sleep=lambda seconds: gevent.sleep(0), spawn=gevent.spawn, joinall=gevent.joinall)
+        stack.enter_context(mock.patch.object(module, "gevent", pacing))
+        service_class = getattr(module, service_name)
+        if hasattr(module, "notifications"):
+            stack.enter_context(mock.patch.object(module.notifications.Notifier, "flush", lambda self: 0))
+        service = service_class()
+        grid.calls.clear()
+        fleet.reads.clear()
+
+        start = time.monotonic()
+        service.job()
+        wall = time.monotonic() - start
+    return result(f"{service_name}/{size}", grid, wall, store_reads=dict(fleet.reads))
+
+
+def repeat(bench, runs, slowest=False):
+    """Run a scenario `runs` times, keeping the run of median simulated time and the median of the total calls
+
+    With `slowest` the run of highest simulated time and the highest total calls are kept instead, a baseline
+    recorded that way doesn't report the noise between runs as regressions.
+    """
+    items = sorted((bench() for _ in range(runs)), key=lambda item: item["simulated_s"])
+    index = -1 if slowest else len(items) // 2
+    item = items[index]
+    item["total_calls"] = sorted(item["total_calls"] for item in items)[index]
+    if runs > 1:
+        item["runs"] = runs
+    return item
+
+
+def run(args):
+    results = []
+    for size in args.deploy_sizes:
+        results.append(repeat(lambda: bench_deploy(args, size), args.runs, args.save_baseline))
+    results.append(repeat(lambda: bench_redeploy(args, 3), args.runs, args.save_baseline))
+    services = [
+        ("monitor", "MonitorDeployments"),
+        ("self_healing", "SelfHealing"),
+        ("update_deployment", "UpdateDeployment"),
+    ]
+    for size in args.sizes:
+        for module_name, service_name in services:
+            bench = lambda: bench_service(args, module_name, service_name, size)
+            results.append(repeat(bench, args.runs, args.save_baseline))
+    return results
+
+
+def compare(results, baseline, time_threshold, calls_threshold):
+    """Get the regressions of the results against the baseline"""
+    baseline = {item["name"]: item for item in baseline}
+    regressions = []
+    for item in results:
+        reference = baseline.get(item["name"])
+        if not reference:
+            continue
+        for metric, threshold in (("simulated_s", time_threshold), ("total_calls", calls_threshold)):
+            if reference[metric] and item[metric] > reference[metric] * (1 + threshold):
+                change = item[metric] / reference[metric] - 1
+                regressions.append(f"{item['name']} {metric}: {reference[metric]} -> {item[metric]} (+{change:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sizes = lambda value: [int(size) for size in value.split(",")]
+    parser.add_argument("--sizes", type=sizes, default=SERVICE_SIZES, help="fleet sizes for the services")
+    parser.add_argument("--quick", action="store_true", help="skip the largest fleet size")
+    parser.add_argument("--deploy-sizes", type=sizes, default=DEPLOY_SIZES)
+    parser.add_argument("--latency", type=float, default=0.05, help="median explorer latency in seconds")
+    parser.add_argument("--provision-time", type=float, default=5)
+    parser.add_argument("--time-scale", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--runs", type=int, default=RUNS, help="runs of each scenario, the median run is kept")
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--time-threshold", type=float, default=TIME_THRESHOLD)
+    parser.add_argument("--calls-threshold", type=float, default=CALLS_THRESHOLD)
+    args = parser.parse_args()
+    if args.quick:
+        args.sizes = [size for size in args.sizes if size < max(args.sizes)] or args.sizes
+
+    results = run(args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    parameters = {name: getattr(args, name) for name in PARAMETERS}
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"parameters": parameters, "results": results}, f, indent=2)
+            f.write("\n")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to record one", file=sys.stderr)
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["parameters"] != parameters:
+        print(f"Not compared, the baseline was run with {baseline['parameters']}", file=sys.stderr)
+        return
+    regressions = compare(results, baseline["results"], args.time_threshold, args.calls_threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Run the sync progress collector against a simulated fleet of blockchain nodes.
+
+One local JSON-RPC server answers for every node: the nodes get distinct loopback addresses (127.0.x.y), so the
+collector sees as many hosts as nodes. It answers getblockchaininfo/getconnectioncount batches like dash and
+digibyte daemons (behind HTTP basic auth) and info_get_status like casper nodes, after `--latency` seconds.
+`--bad-credentials` of the deployments have wrong RPC credentials and are expected to fail.
+
+The collector runs `--cycles` cycles over the fleet; the script reports the nodes per second, the failures and
+the connections the server accepted per cycle, which drop to zero once the connections are reused. Samples are
+kept in memory instead of redis.
+
+Usage:
+    python benchmarks/sync_progress.py [--nodes 3000] [--concurrency 200] [--latency 0.05] [--cycles 2]
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import argparse  # noqa: E402
+import base64  # noqa: E402
+import json  # noqa: E402
+import random  # noqa: E402
+import resource  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+from types import SimpleNamespace  # noqa: E402
+from unittest import mock  # noqa: E402
+
+import gevent  # noqa: E402
+from gevent.pywsgi import WSGIHandler, WSGIServer  # noqa: E402
+
+from jumpscale.sals.jukebox import sync  # noqa: E402
+from jumpscale.sals.jukebox.models import State  # noqa: E402
+
+TIP = 1_500_000
+NODES_PER_DEPLOYMENT = 5
+SOLUTION_TYPES = ["dash", "digibyte", "casperlabs"]
+CREDENTIALS = ("owner", "secret")
+
+
+class CountingHandler(WSGIHandler):
+    connections = 0
+
+    def handle(self):
+        CountingHandler.connections += 1
+        return super().handle()
+
+
+def rpc_app(latency):
+    authorization = "Basic " + base64.b64encode(":".join(CREDENTIALS).encode()).decode()
+
+    def app(environ, start_response):
+        gevent.sleep(latency)
+        body = json.loads(environ["wsgi.input"].read() or b"null")
+        height = TIP - random.randint(0, 3)
+        if environ["PATH_INFO"] == "/rpc":
+            result = {"result": {"last_added_block_info": {"height": height}, "peers": [{}] * 8}}
+        elif environ.get("HTTP_AUTHORIZATION") != authorization:
+            start_response("401 Unauthorized", [("Content-Length", "0")])
+            return [b""]
+        else:
+            results = {"getblockchaininfo": {"blocks": height, "headers": TIP}, "getconnectioncount": 8}
+            result = [{"id": call["id"], "result": results[call["method"]], "error": None} for call in body]
+        data = json.dumps(result).encode()
+        start_response("200 OK", [("Content-Type", "application/json"), ("Content-Length", str(len(data)))])
+        return [data]
+
+    return app
+
+
+def build_fleet(number_of_nodes, bad_credentials):
+    deployments = []
+    for index in range(0, number_of_nodes, NODES_PER_DEPLOYMENT):
+        nodes = [
+            SimpleNamespace(
+                wid=wid, state=State.DEPLOYED, ipv6_address=None, ipv4_address=f"127.0.{wid // 250}.{wid % 250 + 1}"
+            )
+            for wid in range(index, min(index + NODES_PER_DEPLOYMENT, number_of_nodes))
+        ]
+        bad = random.random() < bad_credentials
+        deployments.append(
+            SimpleNamespace(
+                instance_name=f"deployment_{index}",
+                solution_type=SOLUTION_TYPES[len(deployments) % len(SOLUTION_TYPES)],
+                nodes=nodes,
+                secret_env={"rpcuser": CREDENTIALS[0], "rpcpasswd": "wrong" if bad else CREDENTIALS[1]},
+            )
+        )
+    return deployments
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--cycles", type=int, default=2)
+    parser.add_argument("--bad-credentials", type=float, default=0.05)
+    args = parser.parse_args()
+
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 2 * max(args.nodes, args.concurrency) + 100
+    if soft_limit < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard_limit, wanted), hard_limit))
+
+    server = WSGIServer(("0.0.0.0", 0), rpc_app(args.latency), handler_class=CountingHandler, log=None, backlog=4096)
+    server.start()
+    random.seed(1)
+    deployments = build_fleet(args.nodes, args.bad_credentials)
+    stored = {}
+    collectors = {
+        "dash": sync.BitcoinRPCCollector(server.server_port),
+        "digibyte": sync.BitcoinRPCCollector(server.server_port),
+        "casperlabs": sync.CasperCollector(),
+    }
+    collectors["casperlabs"].port = server.server_port
+
+    with mock.patch.dict(sync.COLLECTORS, collectors), mock.patch.object(
+        sync.utils, "decrypt_secret_env", lambda deployment: deployment.secret_env
+    ), mock.patch.object(sync.STORE, "load"), mock.patch.object(sync.STORE, "prune"), mock.patch.object(
+        sync.STORE, "append", stored.update
+    ):
+        collector = sync.SyncCollector(concurrency=args.concurrency)
+        for cycle in range(args.cycles):
+            CountingHandler.connections = 0
+            start = time.monotonic()
+            collected = collector.run(deployments)
+            duration = time.monotonic() - start
+            print(
+                f"cycle {cycle + 1}: {collected}/{args.nodes} nodes in {duration:.2f}s "
+                f"({args.nodes / duration:.0f} nodes/s), {CountingHandler.connections} new connections"
+            )
+    server.stop()
+
+    expected_failures = sum(
+        len(deployment.nodes)
+        for deployment in deployments
+        if deployment.secret_env["rpcpasswd"] != CREDENTIALS[1] and deployment.solution_type != "casperlabs"
+    )
+    progress = [sync.progress([sample]) for sample in stored.values()]
+    synced = sum(1 for node_progress in progress if node_progress["synced"])
+    print(f"{synced}/{len(progress)} nodes synced, {expected_failures} nodes with wrong credentials")
+    if len(stored) != args.nodes - expected_failures:
+        print(f"expected {args.nodes - expected_failures} nodes collected, got {len(stored)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
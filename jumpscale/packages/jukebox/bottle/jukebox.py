@@ -1,5 +1,6 @@
 import base64
 import datetime
+import hmac
 import json
 
 from bottle import Bottle, HTTPResponse, abort, redirect, request
@@ -16,10 +17,39 @@ import nacl
 import requests
 
 from jumpscale.packages.jukebox.bottle.models import UserEntry
-from jumpscale.sals.jukebox import utils
+from jumpscale.packages.jukebox.bottle.response import json_array_response, json_response, read_body
+from jumpscale.packages.admin.services.notifier import MAIL_QUEUE
+from jumpscale.sals.jukebox import export, health, metrics, probe, ratelimit, stats, sync, tracing, utils
 
 app = Bottle()
 
+
+def user_priority(callback):
+    """Route plugin giving the explorer calls of API requests priority over the background services"""
+
+    def wrapper(*args, **kwargs):
+        with ratelimit.priority(ratelimit.USER):
+            return callback(*args, **kwargs)
+
+    return wrapper
+
+
+app.install(user_priority)
+
+
+def scrape_authorized(function):
+    """Let Prometheus in with `Authorization: Bearer <JUKEBOX_METRICS_TOKEN>`, the package admins with their session"""
+    admin_function = package_authorized("jukebox")(function)
+
+    def wrapper(*args, **kwargs):
+        token = j.core.config.get("JUKEBOX_METRICS_TOKEN")
+        authorization = request.headers.get("Authorization", "")
+        if token and hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+            return function(*args, **kwargs)
+        return admin_function(*args, **kwargs)
+
+    return wrapper
+
 THREEFOLD_LOGIN_URL = "https://login.threefold.me/api"
 
 IDENTITY_PREFIX = "jukebox"
@@ -29,9 +59,7 @@ JUKEBOX_AUTO_EXTEND_KEY = "jukebox:auto_extend"
 @app.route("/api/status", method="GET")
 @login_required
 def is_running():
-    return HTTPResponse(
-        j.data.serializers.json.dumps({"running": True}), status=200, headers={"Content-Type": "application/json"}
-    )
+    return json_response({"running": True})
 
 
 @app.route("/api/admins/list", method="GET")
@@ -40,13 +68,13 @@ def list_all_admins() -> str:
     threebot = j.servers.threebot.get("default")
     package = threebot.packages.get("jukebox")
     admins = list(set(package.admins))
-    return j.data.serializers.json.dumps({"data": admins})
+    return json_response({"data": admins})
 
 
 @app.route("/api/admins/add", method="POST")
 @package_authorized("jukebox")
 def add_admin() -> str:
-    data = j.data.serializers.json.loads(request.body.read())
+    data = read_body()
     name = data.get("name")
     threebot = j.servers.threebot.get("default")
     package = threebot.packages.get("jukebox")
@@ -61,7 +89,7 @@ def add_admin() -> str:
 @app.route("/api/admins/remove", method="POST")
 @package_authorized("jukebox")
 def remove_admin() -> str:
-    data = j.data.serializers.json.loads(request.body.read())
+    data = read_body()
     name = data.get("name")
     threebot = j.servers.threebot.get("default")
     package = threebot.packages.get("jukebox")
@@ -76,6 +104,66 @@ def remove_admin() -> str:
     threebot.packages.save()
 
 
+@app.route("/api/admins/stats", method="GET")
+@package_authorized("jukebox")
+def fleet_stats() -> str:
+    days = int(request.query.get("days", 7))
+    return json_response({"data": stats.get_stats(expiring_within_days=days)})
+
+
+@app.route("/api/admins/timings", method="GET")
+@package_authorized("jukebox")
+def deployment_timings() -> str:
+    name = request.query.get("name")
+    limit = int(request.query.get("limit", tracing.RECENT_TRACES))
+    return json_response({"data": tracing.get_traces(instance_name=name, limit=limit)})
+
+
+@app.route("/api/admins/nodes_health", method="GET")
+@package_authorized("jukebox")
+def nodes_health() -> str:
+    state = request.query.get("state")
+    return json_response({"data": health.REGISTRY.list_circuits(state=state)})
+
+
+@app.route("/api/admins/liveness", method="GET")
+@package_authorized("jukebox")
+def liveness() -> str:
+    return json_response({"data": probe.TRACKER.last_summary})
+
+
+@app.route("/api/admins/metrics", method="GET")
+@scrape_authorized
+def prometheus_metrics():
+    try:
+        metrics.MAIL_QUEUE_DEPTH.set(j.core.db.llen(MAIL_QUEUE))
+        deployments_per_state = stats.get_stats()["deployments"]["state"]
+        metrics.DEPLOYMENTS.clear()
+        for state, count in deployments_per_state.items():
+            metrics.DEPLOYMENTS.set(count, state=state)
+    except Exception as e:
+        j.logger.exception("Failed to collect jukebox metrics", exception=e)
+    return HTTPResponse(
+        metrics.REGISTRY.render(), status=200, headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+
+@app.route("/api/admins/export", method="GET")
+@package_authorized("jukebox")
+def export_fleet():
+    export_format = request.query.get("format", "jsonl")
+    if export_format not in export.EXPORT_FORMATS:
+        return json_response({"error": f"format {export_format} is not supported"}, status=400)
+    iter_export, content_type = export.EXPORT_FORMATS[export_format]
+    filename = f"jukebox_{j.data.time.utcnow().format('YYYY-MM-DD')}.{export_format}"
+    chunks = (chunk.encode() for chunk in iter_export())
+    return HTTPResponse(
+        chunks,
+        status=200,
+        headers={"Content-Type": content_type, "Content-Disposition": f"attachment; filename={filename}"},
+    )
+
+
 def create_intermediate_identity(tname, email, explorer_url):
 
     prefixed_tname = f"{IDENTITY_PREFIX}_{j.data.text.removesuffix(tname, '.3bot')}"
@@ -105,17 +193,11 @@ def accept():
     elif "explorer.grid.tf" in explorer_url:
         explorer_name = "mainnet"
     else:
-        return HTTPResponse(
-            j.data.serializers.json.dumps({"error": f"explorer {explorer_url} is not supported"}),
-            status=500,
-            headers={"Content-Type": "application/json"},
-        )
+        return json_response({"error": f"explorer {explorer_url} is not supported"}, status=500)
     user_entry_name = f"{IDENTITY_PREFIX}_{tname.replace('.3bot', '')}"
     user_entry = user_factory.get(user_entry_name)
     if user_entry.has_agreed:
-        return HTTPResponse(
-            j.data.serializers.json.dumps({"allowed": True}), status=200, headers={"Content-Type": "application/json"}
-        )
+        return json_response({"allowed": True})
     else:
         user_entry.has_agreed = True
         user_entry.explorer_url = explorer_url
@@ -123,9 +205,7 @@ def accept():
         user_entry.save()
         utils.get_or_create_user_wallet(f"jukebox_{j.data.text.removesuffix(tname, '.3bot')}")
         create_intermediate_identity(tname=tname, email=user_info["email"], explorer_url=explorer_url)
-        return HTTPResponse(
-            j.data.serializers.json.dumps({"allowed": True}), status=201, headers={"Content-Type": "application/json"}
-        )
+        return json_response({"allowed": True}, status=201)
 
 
 @app.route("/api/allowed", method="GET")
@@ -143,8 +223,8 @@ def allowed():
             create_intermediate_identity(
                 tname=tname, email=user_info["email"], explorer_url=explorer_url
             )  # check if not created, then add
-            return j.data.serializers.json.dumps({"allowed": True})
-    return j.data.serializers.json.dumps({"allowed": False})
+            return json_response({"allowed": True})
+    return json_response({"allowed": False})
 
 
 @app.route("/api/deployments/<solution_type>", method="GET")
@@ -154,9 +234,9 @@ def list_deployments(solution_type: str) -> str:
     tname = user_info["username"]
     prefixed_tname = f"{IDENTITY_PREFIX}_{tname.replace('.3bot', '')}"
     deployments = j.sals.jukebox.list_deployments(prefixed_tname, solution_type.lower())
-    deployments = [deployment.to_dict() for deployment in deployments]
+    deployments = sync.to_dicts(deployments)
 
-    return j.data.serializers.json.dumps({"data": deployments})
+    return json_array_response(deployments)
 
 
 @app.route("/api/deployments/cancel", method="POST")
@@ -166,7 +246,7 @@ def cancel_deployment() -> str:
     tname = user_info["username"]
     prefixed_tname = f"{IDENTITY_PREFIX}_{tname.replace('.3bot', '')}"
 
-    data = j.data.serializers.json.loads(request.body.read())
+    data = read_body()
     deployment_name = data.get("name")
     solution_type = data.get("solution_type", "").lower()
 
@@ -174,7 +254,7 @@ def cancel_deployment() -> str:
         identity_name=prefixed_tname, deployment_name=deployment_name, solution_type=solution_type
     )
     j.sals.jukebox.delete(deployment.instance_name)
-    return j.data.serializers.json.dumps({"data": {}})
+    return json_response({"data": {}})
 
 
 @app.route("/api/node/cancel", method="POST")
@@ -184,7 +264,7 @@ def cancel_node() -> str:
     tname = user_info["username"]
     prefixed_tname = f"{IDENTITY_PREFIX}_{tname.replace('.3bot', '')}"
 
-    data = j.data.serializers.json.loads(request.body.read())
+    data = read_body()
     deployment_name = data.get("name")
     wid = data.get("wid")
     solution_type = data.get("solution_type", "").lower()
@@ -193,7 +273,7 @@ def cancel_node() -> str:
         identity_name=prefixed_tname, deployment_name=deployment_name, solution_type=solution_type
     )
     deployment.delete_node(wid)
-    return j.data.serializers.json.dumps({"data": {}})
+    return json_response({"data": {}})
 
 
 @app.route("/api/deployments/switch_auto_extend", method="POST")
@@ -203,7 +283,7 @@ def switch_auto_extend() -> str:
     tname = user_info["username"]
     prefixed_tname = f"{IDENTITY_PREFIX}_{tname.replace('.3bot', '')}"
 
-    data = j.data.serializers.json.loads(request.body.read())
+    data = read_body()
     deployment_name = data.get("name")
     new_state = data.get("new_state", False)
     solution_type = data.get("solution_type", "").lower()
@@ -222,7 +302,7 @@ def extend_deployment() -> str:
     tname = user_info["username"]
     prefixed_tname = f"{IDENTITY_PREFIX}_{tname.replace('.3bot', '')}"
 
-    data = j.data.serializers.json.loads(request.body.read())
+    data = read_body()
     deployment_name = data.get("name")
     solution_type = data.get("solution_type", "").lower()
 
@@ -253,11 +333,9 @@ def get_wallet():
 
     data = utils.get_wallet_funding_info(prefixed_tname)
     if not data:
-        return HTTPResponse(
-            j.data.serializers.json.dumps({"wallet": False}), status=404, headers={"Content-Type": "application/json"}
-        )
+        return json_response({"wallet": False}, status=404)
 
-    return j.data.serializers.json.dumps({"data": data})
+    return json_response({"data": data})
 
 
 @app.route("/api/deployments/secret", method="POST")
@@ -267,7 +345,7 @@ def get_secret():
     tname = user_info["username"]
     prefixed_tname = f"{IDENTITY_PREFIX}_{tname.replace('.3bot', '')}"
 
-    data = j.data.serializers.json.loads(request.body.read())
+    data = read_body()
     deployment_name = data.get("name")
     solution_type = data.get("solution_type", "").lower()
     deployment = j.sals.jukebox.find(
@@ -278,4 +356,4 @@ def get_secret():
     except Exception as e:
         return HTTPResponse("Failed to get deployment secret", status=404, headers={"Content-Type": "application/json"})
 
-    return j.data.serializers.json.dumps({"data": secret})
+    return json_response({"data": secret})
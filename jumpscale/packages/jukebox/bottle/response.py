@@ -0,0 +1,168 @@
+import gzip
+import json
+import zlib
+
+from bottle import HTTPResponse, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSION_THRESHOLD = 1024  # bytes, smaller payloads are sent as is
+STREAM_THRESHOLD = 200  # items, bigger arrays are streamed in chunks
+STREAM_CHUNK_SIZE = 100  # items per chunk
+GZIP_LEVEL = 1  # listings compress ~4x already at level 1, higher levels mostly cost cpu
+BROTLI_QUALITY = 4
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def _default(obj):
+    # fallback for values that are not plain json types in to_dict() trees
+    if hasattr(obj, "value"):
+        return obj.value
+    if hasattr(obj, "timestamp"):
+        return obj.timestamp()
+    if isinstance(obj, (set, tuple)):
+        return list(obj)
+    if isinstance(obj, bytes):
+        return obj.decode()
+    return str(obj)
+
+
+def dumps(data):
+    """Serialize `data` to json bytes, using orjson when it is installed
+
+    Args:
+        data: json serializable object
+
+    Returns:
+        bytes: encoded json
+    """
+    if orjson:
+        return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=_default, separators=(",", ":")).encode()
+
+
+def loads(data):
+    """Parse json from str or bytes, an empty body is parsed as an empty dict"""
+    if orjson:
+        return orjson.loads(data or b"{}")
+    return json.loads(data or "{}")
+
+
+def read_body():
+    """Parse the json body of the current request"""
+    return loads(request.body.read())
+
+
+def accepted_encoding():
+    """Get the best compression supported by both the client and the server, or None"""
+    accept_encoding = request.headers.get("Accept-Encoding", "")
+    encodings = [encoding.split(";")[0].strip() for encoding in accept_encoding.split(",")]
+    if brotli and "br" in encodings:
+        return "br"
+    if "gzip" in encodings:
+        return "gzip"
+    return None
+
+
+def compress(payload, encoding):
+    if encoding == "br":
+        return brotli.compress(payload, quality=BROTLI_QUALITY)
+    if encoding == "gzip":
+        return gzip.compress(payload, compresslevel=GZIP_LEVEL)
+    return payload
+
+
+def _set_encoding_headers(headers, encoding):
+    headers["Content-Encoding"] = encoding
+    headers["Vary"] = "Accept-Encoding"
+
+
+def json_response(data, status=200, encoding=None):
+    """Build a json HTTPResponse, compressed when the client accepts it and the payload is above the threshold
+
+    Args:
+        data: json serializable object
+        status (int): http status code
+        encoding (str): force an encoding ("br", "gzip") instead of negotiating it from the request
+
+    Returns:
+        HTTPResponse
+    """
+    payload = dumps(data)
+    headers = dict(JSON_HEADERS)
+    if len(payload) >= COMPRESSION_THRESHOLD:
+        encoding = encoding or accepted_encoding()
+        if encoding:
+            payload = compress(payload, encoding)
+            _set_encoding_headers(headers, encoding)
+    return HTTPResponse(payload, status=status, headers=headers)
+
+
+def iter_json_array(key, items):
+    """Yield `{key: [...]}` as json chunks of STREAM_CHUNK_SIZE items"""
+    yield b'{"' + key.encode() + b'":['
+    chunk = []
+    first = True
+    for item in items:
+        chunk.append(dumps(item))
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            yield (b"" if first else b",") + b",".join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield (b"" if first else b",") + b",".join(chunk)
+    yield b"]}"
+
+
+def iter_compressed(chunks, encoding):
+    """Compress an iterable of byte chunks on the fly"""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            compressed = compressor.process(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.finish()
+        return
+
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def json_array_response(items, key="data", status=200):
+    """Respond with `{key: [...]}`, streaming the array in chunks when it is large
+
+    Small arrays go through `json_response`, large ones are serialized and compressed chunk by chunk
+    so the whole encoded listing is never held in memory at once.
+
+    Args:
+        items (list): json serializable items
+        key (str): key of the array in the response object
+        status (int): http status code
+
+    Returns:
+        HTTPResponse
+    """
+    if len(items) < STREAM_THRESHOLD:
+        return json_response({key: items}, status=status)
+
+    body = iter_json_array(key, items)
+    headers = dict(JSON_HEADERS)
+    encoding = accepted_encoding()
+    if encoding:
+        body = iter_compressed(body, encoding)
+        _set_encoding_headers(headers, encoding)
+    return HTTPResponse(body, status=status, headers=headers)
@@ -9,6 +9,7 @@ from jumpscale.sals.jukebox import utils
 
 class Extend(JukeboxDeployChatflow):
     title = "Extend Deployment"
+    SPECULATIVE_DEPLOY = False
     steps = [
         "number_of_nodes",
         "payment",
@@ -43,9 +44,11 @@ class Extend(JukeboxDeployChatflow):
         available_farms = list(available_farms)
         if len(available_farms) < self.no_farms:
             self.stop("There is not enough capacity to deploy your nodes.")
+        self.farms_split = {self.farm: self.nodes_count}
 
     @chatflow_step(title="Deploy")
     def deploy(self):
+        self._validate_farm()
         self.md_show_update("Deploying...")
         cloud_units = utils.calculate_required_units(
             cpu=self.QUERY["cru"],
@@ -0,0 +1,22 @@
+from jumpscale.loader import j
+from jumpscale.tools.servicemanager.servicemanager import BackgroundService
+
+from jumpscale.sals.jukebox import metrics
+from jumpscale.sals.jukebox.capacity import INDEX
+
+
+class CapacityIndexRefresh(BackgroundService):
+    def __init__(self, interval=60 * 10, *args, **kwargs):
+        """
+        Refresh the farms capacity index used by the chatflows to choose farms.
+        """
+        super().__init__(interval, *args, **kwargs)
+        self.schedule_on_start = True
+
+    def job(self):
+        j.logger.info("Refreshing farms capacity index...")
+        with metrics.service_job("capacity_index"):
+            INDEX.refresh()
+
+
+service = CapacityIndexRefresh()
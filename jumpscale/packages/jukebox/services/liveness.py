@@ -0,0 +1,59 @@
+from jumpscale.loader import j
+from jumpscale.tools.servicemanager.servicemanager import BackgroundService
+
+from jumpscale.sals.jukebox import metrics, probe
+from jumpscale.sals.jukebox.models import State
+
+
+class LivenessProbe(BackgroundService):
+    def __init__(self, interval=60 * 10, *args, **kwargs):
+        """
+        Probe the daemons of the deployed nodes, marking the ones that stopped answering as not responding, or as
+        errored if the explorer doesn't report their workload as running, and the ones that answer again as deployed.
+        """
+        super().__init__(interval, *args, **kwargs)
+        self.engine = probe.ProbeEngine(
+            concurrency=j.core.config.get("JUKEBOX_PROBE_CONCURRENCY", probe.DEFAULT_CONCURRENCY),
+            timeout=j.core.config.get("JUKEBOX_PROBE_TIMEOUT", probe.DEFAULT_TIMEOUT),
+        )
+
+    def job(self):
+        j.logger.info("Starting probing deployed nodes...")
+        with metrics.service_job("liveness_probe") as job:
+            probes = probe.get_probes()
+            deployments = {}
+            targets = []
+            for deployment_instance_name in j.sals.jukebox.list_all():
+                deployment = j.sals.jukebox.find(deployment_instance_name)
+                if deployment.state not in [State.DEPLOYED, State.ERROR]:
+                    continue
+                deployments[deployment_instance_name] = deployment
+                for node in deployment.nodes:
+                    target = probe.node_target(deployment, node, probes)
+                    if target:
+                        targets.append(target)
+
+            results = self.engine.run(targets)
+            job.processed(len(results))
+            farms = {target.key: target.farm for target in targets}
+            marked = 0
+            for deployment_instance_name, wids in probe.TRACKER.update(results, farms).items():
+                marked += len(deployments[deployment_instance_name].mark_nodes_down(wids))
+            probe.TRACKER.last_summary["marked_down"] = marked
+
+            recovered = 0
+            for deployment_instance_name, deployment in deployments.items():
+                wids = [
+                    node.wid
+                    for node in deployment.nodes
+                    if node.state == State.NOT_RESPONDING
+                    and getattr(results.get((deployment_instance_name, node.wid)), "alive", False)
+                ]
+                if wids:
+                    recovered += len(deployment.mark_nodes_up(wids))
+            probe.TRACKER.last_summary["recovered"] = recovered
+
+        j.logger.info(f"Probed {len(results)} nodes: {probe.TRACKER.last_summary}")
+
+
+service = LivenessProbe()
@@ -2,8 +2,11 @@ import gevent
 from jumpscale.loader import j
 from jumpscale.tools.servicemanager.servicemanager import BackgroundService
 
+from jumpscale.sals.jukebox import metrics
 from jumpscale.sals.jukebox.models import State
 
+UNRESPONSIVE_LIMIT = 10  # not responding nodes replaced per run, a probe verdict may still be a false positive
+
 
 class SelfHealing(BackgroundService):
     def __init__(self, interval=60 * 60 * 2, *args, **kwargs):
@@ -14,16 +17,24 @@ class SelfHealing(BackgroundService):
 
     def job(self):
         j.logger.info("Starting self healing for deployments...")
-        for deployment_instance_name in j.sals.jukebox.list_all():
-            deployment = j.sals.jukebox.find(deployment_instance_name)
-            if deployment.state in [State.DEPLOYING, State.DELETED, State.EXPIRED]:
-                continue
-            errored_workloads = 0
-            for node in deployment.nodes:
-                if node.state == State.ERROR:
-                    errored_workloads += 1
-            deployment.redeploy_containers(errored_workloads)
-            gevent.sleep(0.1)
+        unresponsive_budget = j.core.config.get("JUKEBOX_UNRESPONSIVE_HEAL_LIMIT", UNRESPONSIVE_LIMIT)
+        with metrics.service_job("self_healing") as job:
+            for deployment_instance_name in j.sals.jukebox.list_all():
+                deployment = j.sals.jukebox.find(deployment_instance_name)
+                if deployment.state in [State.DEPLOYING, State.DELETED, State.EXPIRED]:
+                    continue
+                unresponsive = [node.wid for node in deployment.nodes if node.state == State.NOT_RESPONDING]
+                if unresponsive and unresponsive_budget > 0:
+                    released = deployment.release_unresponsive_nodes(unresponsive[:unresponsive_budget])
+                    unresponsive_budget -= len(released)
+                errored_workloads = 0
+                for node in deployment.nodes:
+                    if node.state == State.ERROR:
+                        errored_workloads += 1
+                if errored_workloads:
+                    deployment.redeploy_containers(errored_workloads)
+                job.processed()
+                gevent.sleep(0.1)
 
         j.logger.info("Self healing is done")
 
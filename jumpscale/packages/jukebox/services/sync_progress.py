@@ -0,0 +1,33 @@
+from jumpscale.loader import j
+from jumpscale.tools.servicemanager.servicemanager import BackgroundService
+
+from jumpscale.sals.jukebox import metrics, sync
+from jumpscale.sals.jukebox.models import State
+
+
+class SyncProgress(BackgroundService):
+    def __init__(self, interval=60 * 15, *args, **kwargs):
+        """
+        Collect the blockchain sync progress of the deployed nodes.
+        """
+        super().__init__(interval, *args, **kwargs)
+        self.collector = sync.SyncCollector(
+            concurrency=j.core.config.get("JUKEBOX_SYNC_CONCURRENCY", sync.DEFAULT_CONCURRENCY),
+            timeout=j.core.config.get("JUKEBOX_SYNC_TIMEOUT", sync.DEFAULT_TIMEOUT),
+        )
+
+    def job(self):
+        j.logger.info("Starting collecting sync progress...")
+        with metrics.service_job("sync_progress") as job:
+            deployments = []
+            for deployment_instance_name in j.sals.jukebox.list_all():
+                deployment = j.sals.jukebox.find(deployment_instance_name)
+                if deployment.solution_type in sync.COLLECTORS and deployment.state in [State.DEPLOYED, State.ERROR]:
+                    deployments.append(deployment)
+            collected = self.collector.run(deployments)
+            job.processed(collected)
+
+        j.logger.info(f"Sync progress of {collected} nodes collected")
+
+
+service = SyncProgress()
@@ -2,6 +2,7 @@ import gevent
 from jumpscale.loader import j
 from jumpscale.tools.servicemanager.servicemanager import BackgroundService
 
+from jumpscale.sals.jukebox import metrics
 from jumpscale.sals.jukebox.models import State
 
 
@@ -14,12 +15,14 @@ class UpdateDeployment(BackgroundService):
 
     def job(self):
         j.logger.info("Starting updating deployments...")
-        for deployment_instance_name in j.sals.jukebox.list_all():
-            deployment = j.sals.jukebox.find(deployment_instance_name)
-            if deployment.state == State.DEPLOYING:
-                continue
-            deployment._update_deployment()
-            gevent.sleep(0.1)
+        with metrics.service_job("update_deployment") as job:
+            for deployment_instance_name in j.sals.jukebox.list_all():
+                deployment = j.sals.jukebox.find(deployment_instance_name)
+                if deployment.state == State.DEPLOYING:
+                    continue
+                deployment._update_deployment()
+                job.processed()
+                gevent.sleep(0.1)
 
         j.logger.info("All deployments are updated")
 
@@ -0,0 +1,23 @@
+from jumpscale.loader import j
+from jumpscale.tools.servicemanager.servicemanager import BackgroundService
+
+from jumpscale.sals.jukebox import metrics, warm_capacity
+
+
+class WarmCapacity(BackgroundService):
+    def __init__(self, interval=60 * 10, *args, **kwargs):
+        """
+        Refill the stock of pre-paid pools and networks of active users.
+        """
+        super().__init__(interval, *args, **kwargs)
+
+    def job(self):
+        if not warm_capacity.is_enabled():
+            return
+        j.logger.info("Refilling warm capacity...")
+        with metrics.service_job("warm_capacity"):
+            warm_capacity.refill_all()
+        j.logger.info("Warm capacity is refilled")
+
+
+service = WarmCapacity()
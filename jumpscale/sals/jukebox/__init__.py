@@ -2,6 +2,7 @@ from jumpscale.clients.explorer.models import NextAction
 from jumpscale.core.base import StoredFactory
 from jumpscale.loader import j
 
+from jumpscale.sals.jukebox import stats, sync, tracing, utils
 from jumpscale.sals.jukebox.jukebox import JukeboxDeployment
 from jumpscale.sals.jukebox.models import State
 
@@ -49,7 +50,12 @@ class BlockchainStoredFactory(StoredFactory):
         if deployment:
             j.logger.info(f"Deleting deployment {deployment}")
             self.cleanup(deployment)
-        return super().delete(name)
+        result = super().delete(name)
+        stats.remove(name)
+        tracing.remove(name)
+        sync.remove(name)
+        utils.evict_deployment_cache(name)
+        return result
 
     def cleanup(self, deployment):
         for blockchain_node in deployment.nodes:
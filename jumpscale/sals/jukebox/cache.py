@@ -0,0 +1,109 @@
+from collections import OrderedDict
+import time
+
+from gevent.event import AsyncResult
+
+_MISSING = object()
+
+
+def wipe(value):
+    """Clear containers in place so evicted secrets are not reachable through them anymore"""
+    if isinstance(value, dict):
+        for item in value.values():
+            wipe(item)
+        value.clear()
+    elif isinstance(value, list):
+        for item in value:
+            wipe(item)
+        value.clear()
+    elif isinstance(value, bytearray):
+        value[:] = b"\x00" * len(value)
+
+
+class TTLCache:
+    def __init__(self, ttl, maxsize=1024, on_evict=None):
+        """In-memory cache where entries expire after `ttl` seconds, least recently used entries are evicted first
+
+        Arguments:
+            ttl (float): entry lifetime in seconds
+            maxsize (int): max number of entries
+            on_evict (callable): called with the value of each expired, invalidated or evicted entry
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self._data = OrderedDict()  # key: (expires_at, value)
+        self._pending = {}  # key: AsyncResult of the call computing it
+
+    def _evict(self, key):
+        _, value = self._data.pop(key)
+        if self.on_evict:
+            self.on_evict(value)
+
+    def _purge(self):
+        now = time.monotonic()
+        for key in [key for key, (expires_at, _) in self._data.items() if expires_at <= now]:
+            self._evict(key)
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if not entry:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            self._evict(key)
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        if key in self._data:
+            _, old_value = self._data.pop(key)
+            if self.on_evict and old_value is not value:
+                self.on_evict(old_value)
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+        if len(self._data) > self.maxsize:
+            self._purge()
+        while len(self._data) > self.maxsize:
+            self._evict(next(iter(self._data)))
+
+    def get_or_set(self, key, func, ttl=None):
+        """Get the value of `key`, computing it with `func` on a miss
+
+        Concurrent misses on the same key wait for the first call instead of calling `func` again.
+        `ttl` can be a callable that gets the computed value and returns its ttl.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        pending = self._pending.get(key)
+        if pending:
+            return pending.get()
+
+        result = AsyncResult()
+        self._pending[key] = result
+        try:
+            value = func()
+        except Exception as e:
+            result.set_exception(e)
+            raise
+        else:
+            self.set(key, value, ttl(value) if callable(ttl) else ttl)
+            result.set(value)
+            return value
+        finally:
+            self._pending.pop(key, None)
+
+    def invalidate(self, key):
+        if key in self._data:
+            self._evict(key)
+
+    def clear(self):
+        for key in list(self._data):
+            self._evict(key)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,118 @@
+"""
+In-memory index of the free capacity of the grid farms.
+
+The index is refreshed periodically by the capacity_index background service, so chatflow steps can answer
+which farms fit N containers of a profile without querying the explorer. The chosen farm is re-validated
+with `refresh_farm` at deploy time.
+"""
+from collections import namedtuple
+
+from gevent.pool import Pool
+from jumpscale.loader import j
+
+from jumpscale.sals.jukebox import explorer
+
+INDEX_MAX_AGE = 30 * 60  # index older than that is considered stale
+
+NodeCapacity = namedtuple("NodeCapacity", ["node_id", "cru", "mru", "hru"])
+
+
+class FarmCapacity:
+    def __init__(self, farm_name, nodes, access_nodes):
+        """Free capacity of the up nodes of a farm
+
+        Arguments:
+            farm_name (str): farm name
+            nodes (list): NodeCapacity of each up node, mru and hru in GB
+            access_nodes (int): number of up nodes with public ipv4 that can be used as network access nodes
+        """
+        self.farm_name = farm_name
+        self.nodes = nodes
+        self.access_nodes = access_nodes
+        self.updated = j.data.time.utcnow().timestamp
+
+    def containers_fit(self, cru, mru, hru):
+        """Get how many containers of this profile can be deployed on the farm"""
+        total = 0
+        for node in self.nodes:
+            free = (node.cru, node.mru, node.hru)
+            counts = [free_units // needed for free_units, needed in zip(free, (cru, mru, hru)) if needed]
+            if counts:
+                total += max(int(min(counts)), 0)
+        return total
+
+    def fits(self, cru, mru, hru, number_of_deployments, accessnodes=True):
+        if accessnodes and not self.access_nodes:
+            return False
+        return self.containers_fit(cru, mru, hru) >= number_of_deployments
+
+
+class CapacityIndex:
+    def __init__(self, max_age=INDEX_MAX_AGE):
+        self.max_age = max_age
+        self._farms = {}  # {farm_name: FarmCapacity}
+        self.updated = None
+
+    @staticmethod
+    def _fetch_farm(zos, farm):
+        nodes = []
+        access_nodes = 0
+        for node in zos.nodes_finder.nodes_search(farm_id=farm.id):
+            if not zos.nodes_finder.filter_is_up(node):
+                continue
+            total, reserved = node.total_resources, node.reserved_resources
+            nodes.append(
+                NodeCapacity(
+                    node_id=node.node_id,
+                    cru=total.cru - reserved.cru,
+                    mru=total.mru - reserved.mru,
+                    hru=total.hru - reserved.hru,
+                )
+            )
+            if zos.nodes_finder.filter_public_ip4(node):
+                access_nodes += 1
+        return FarmCapacity(farm.name, nodes, access_nodes)
+
+    def refresh(self, concurrency=10):
+        """Rebuild the index for all farms, querying up to `concurrency` farms at a time"""
+        zos = explorer.get_zos()
+        farms = zos._explorer.farms.list()
+        pool = Pool(concurrency)
+        farms_capacity = {}
+
+        def fetch(farm):
+            try:
+                farms_capacity[farm.name] = self._fetch_farm(zos, farm)
+            except Exception as e:
+                j.logger.warning(f"Failed to get capacity of farm {farm.name}: {e}")
+                if farm.name in self._farms:
+                    farms_capacity[farm.name] = self._farms[farm.name]
+
+        pool.map(fetch, farms)
+        self._farms = farms_capacity
+        self.updated = j.data.time.utcnow().timestamp
+        j.logger.info(f"Capacity index refreshed with {len(farms_capacity)} farms")
+
+    def refresh_farm(self, farm_name):
+        """Refresh the capacity of a single farm and return it"""
+        zos = explorer.get_zos()
+        farm = zos._explorer.farms.get(farm_name=farm_name)
+        self._farms[farm_name] = self._fetch_farm(zos, farm)
+        return self._farms[farm_name]
+
+    def is_fresh(self):
+        return bool(self.updated and j.data.time.utcnow().timestamp - self.updated < self.max_age)
+
+    def available_farms(self, cru, mru, hru, number_of_deployments, accessnodes=True):
+        """Get names of the farms that fit `number_of_deployments` containers of this profile (mru and hru in GB)"""
+        return [
+            farm_name
+            for farm_name, farm in self._farms.items()
+            if farm.fits(cru, mru, hru, number_of_deployments, accessnodes=accessnodes)
+        ]
+
+    def get_farm(self, farm_name):
+        return self._farms.get(farm_name)
+
+
+INDEX = CapacityIndex()
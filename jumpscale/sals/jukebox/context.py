@@ -0,0 +1,33 @@
+"""
+Values bound to a greenlet and inherited by the greenlets it spawns.
+
+gevent records the greenlet that spawned each greenlet (`spawning_greenlet`), so a value bound on a greenlet is
+found from all the greenlets started under it, e.g. by `gevent.spawn` or a `Pool`, without passing it around.
+"""
+from contextlib import contextmanager
+
+import gevent
+
+
+def get(name, default=None):
+    """Get the value of `name` bound on the current greenlet or on the greenlets that spawned it"""
+    greenlet = gevent.getcurrent()
+    while greenlet is not None:
+        value = getattr(greenlet, name, None)
+        if value is not None:
+            return value
+        parent = getattr(greenlet, "spawning_greenlet", None)
+        greenlet = parent() if parent else None
+    return default
+
+
+@contextmanager
+def bind(name, value):
+    """Bind `value` as `name` on the current greenlet for the duration of the block"""
+    greenlet = gevent.getcurrent()
+    previous = getattr(greenlet, name, None)
+    setattr(greenlet, name, value)
+    try:
+        yield value
+    finally:
+        setattr(greenlet, name, previous)
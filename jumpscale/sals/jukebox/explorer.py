@@ -0,0 +1,107 @@
+"""
+Instrumented access to the explorer and Stellar.
+
+`get_zos` wraps the zos sal so every call through its sub-sals (`zos.pools.get`, `zos.workloads.deploy`,
+`zos._explorer.farms.get`, ...) goes through `call`, and `deployer` wraps the reservation chatflow deployer the
+same way. Calls are counted and timed per method in the metrics registry; local helpers that never reach the network
+(workload builders, encryption, node filters) are passed through untouched. The HTTP requests of the explorer client
+are admitted one by one by the shared rate limiter, see `ratelimit.limit_session`.
+"""
+import time
+
+from jumpscale.loader import j
+from jumpscale.sals.reservation_chatflow import deployer as _deployer
+
+from jumpscale.sals.jukebox import metrics, ratelimit
+
+EXPLORER = "explorer"
+STELLAR = "stellar"
+LOCAL_METHODS = {
+    "container.create",
+    "container.encrypt_secret",
+    "deployer.encrypt_metadata",
+    "deployer.decrypt_metadata",
+}
+STELLAR_PREFIXES = ("billing.", "wallet.")
+
+
+def backend_of(method):
+    return STELLAR if method.startswith(STELLAR_PREFIXES) else EXPLORER
+
+
+def call(method, func, *args, **kwargs):
+    """Call `func`, accounting it as a remote call of `method`
+
+    Args:
+        method (str): dotted method name, e.g. "pools.get"
+        func (callable): function doing the call
+    """
+    backend = backend_of(method)
+    metrics.REMOTE_CALLS.inc(backend=backend, method=method)
+    start = time.monotonic()
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        metrics.REMOTE_ERRORS.inc(backend=backend, method=method)
+        raise
+    finally:
+        metrics.REMOTE_SECONDS.observe(time.monotonic() - start, backend=backend, method=method)
+
+
+def _is_local(method):
+    name = method.rsplit(".", 1)[-1]
+    return method in LOCAL_METHODS or name.startswith(("filter_", "_"))
+
+
+class Instrumented:
+    def __init__(self, target, prefix):
+        """Proxy of `target` routing its method calls through `call`, sub-objects are proxied as well
+
+        Arguments:
+            target: object to proxy, its attributes are resolved on every access
+            prefix (str): method names prefix, e.g. "pools"
+        """
+        self._target = target
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        method = f"{self._prefix}.{name}"
+        if callable(value):
+            if _is_local(method) or isinstance(value, type):
+                return value
+
+            def instrumented(*args, **kwargs):
+                return call(method, value, *args, **kwargs)
+
+            return instrumented
+        if hasattr(value, "__dict__") and not isinstance(value, (str, bytes, int, float, list, dict, tuple)):
+            return Instrumented(value, method.lstrip("_"))
+        return value
+
+
+class InstrumentedZos(Instrumented):
+    def __init__(self, zos):
+        super().__init__(zos, "")
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if callable(value) or not hasattr(value, "__dict__"):
+            return value
+        return Instrumented(value, name.lstrip("_"))
+
+
+def get_zos(identity_name=None):
+    """Get the zos sal of `identity_name` (the system identity by default) with instrumented calls"""
+    zos = j.sals.zos.get(identity_name) if identity_name else j.sals.zos.get()
+    # the explorer client of an url is shared by all identities, the deployer helpers send through it as well
+    ratelimit.limit_session(zos._explorer._session)
+    return InstrumentedZos(zos)
+
+
+def wallet_call(wallet, method, *args, **kwargs):
+    """Call a Stellar wallet method, e.g. `wallet_call(wallet, "transfer", address, amount)`"""
+    return call(f"wallet.{method}", getattr(wallet, method), *args, **kwargs)
+
+
+deployer = Instrumented(_deployer, "deployer")
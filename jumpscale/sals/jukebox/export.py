@@ -0,0 +1,112 @@
+"""
+Streaming export of the deployments fleet, one row per node.
+
+Deployments are loaded one at a time while walking the factory, so memory does not grow with the fleet size.
+"""
+import csv
+import io
+
+import gevent
+from jumpscale.loader import j
+
+EXPORT_FIELDS = [
+    "instance_name",
+    "owner",
+    "solution_type",
+    "deployment_name",
+    "deployment_state",
+    "farm_name",
+    "pool_ids",
+    "expiration_date",
+    "auto_extend",
+    "nodes_count",
+    "pool_id",
+    "wid",
+    "node_id",
+    "node_state",
+    "ipv4_address",
+    "ipv6_address",
+    "creation_time",
+]
+CSV_BATCH_SIZE = 500  # rows written per chunk
+
+
+def _timestamp(value):
+    return int(value.timestamp()) if value else None
+
+
+def _value(enum_value):
+    return enum_value.value if enum_value else None
+
+
+def iter_deployments():
+    """Lazily load all deployments, yielding control to other greenlets between loads"""
+    for instance_name in j.sals.jukebox.list_all():
+        deployment = j.sals.jukebox.find(instance_name)
+        if deployment:
+            yield deployment
+        gevent.sleep(0)
+
+
+def iter_rows():
+    """Yield one dict per node (or per deployment without nodes) with EXPORT_FIELDS as keys"""
+    for deployment in iter_deployments():
+        row = {
+            "instance_name": deployment.instance_name,
+            "owner": j.data.text.removeprefix(deployment.identity_name, "jukebox_"),
+            "solution_type": deployment.solution_type,
+            "deployment_name": deployment.deployment_name,
+            "deployment_state": _value(deployment.state),
+            "farm_name": deployment.farm_name,
+            "pool_ids": list(deployment.pool_ids),
+            "expiration_date": _timestamp(deployment.expiration_date),
+            "auto_extend": deployment.auto_extend,
+            "nodes_count": deployment.nodes_count,
+            "pool_id": None,
+            "wid": None,
+            "node_id": None,
+            "node_state": None,
+            "ipv4_address": None,
+            "ipv6_address": None,
+            "creation_time": None,
+        }
+        if not deployment.nodes:
+            yield row
+            continue
+        for node in deployment.nodes:
+            node_row = dict(row)
+            node_row["farm_name"] = deployment.get_pool_farm(node.pool_id)
+            node_row["pool_id"] = node.pool_id
+            node_row["wid"] = node.wid
+            node_row["node_id"] = node.node_id
+            node_row["node_state"] = _value(node.state)
+            node_row["ipv4_address"] = str(node.ipv4_address) if node.ipv4_address else None
+            node_row["ipv6_address"] = str(node.ipv6_address) if node.ipv6_address else None
+            node_row["creation_time"] = _timestamp(node.creation_time)
+            yield node_row
+
+
+def iter_jsonl(rows=None):
+    """Yield the export as json lines"""
+    for row in rows if rows is not None else iter_rows():
+        yield j.data.serializers.json.dumps(row) + "\n"
+
+
+def iter_csv(rows=None, batch_size=CSV_BATCH_SIZE):
+    """Yield the export as csv text chunks of `batch_size` rows, starting with the header"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    count = 0
+    for row in rows if rows is not None else iter_rows():
+        row["pool_ids"] = ";".join(str(pool_id) for pool_id in row["pool_ids"])
+        writer.writerow(row)
+        count += 1
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+EXPORT_FORMATS = {"jsonl": (iter_jsonl, "application/x-ndjson"), "csv": (iter_csv, "text/csv")}
@@ -0,0 +1,107 @@
+"""
+Batch extension of expiring deployments.
+
+Deployments are grouped by owner wallet. Wallets are processed in parallel, but the payouts of one wallet are
+submitted one after the other as concurrent Stellar transactions from the same account conflict on the sequence
+number. The explorer matches pool payments by the reservation memo, so each pool extension still needs its own
+transaction; what is aggregated per wallet is the balance check, done once upfront so no fees are spent on
+extensions that can't all be paid, and the payment confirmations, which are all awaited together.
+"""
+from collections import defaultdict
+
+import gevent
+from gevent.pool import Pool
+from jumpscale.clients.stellar import TRANSACTION_FEES
+from jumpscale.loader import j
+from jumpscale.sals.zos.billing import InsufficientFunds
+
+from jumpscale.sals.jukebox import payments, pricing, utils
+
+EXTEND_CONCURRENCY = 5  # wallets extended at the same time
+EXTENSION_DURATION = 60 * 60 * 24 * 30
+
+EXTENDED = "extended"
+INSUFFICIENT_FUNDS = "insufficient_funds"
+NO_WALLET = "no_wallet"
+FAILED = "failed"
+
+
+def extension_cost(deployment, duration=EXTENSION_DURATION):
+    """Get the cost of extending all pools of a deployment, transaction fees included"""
+    items = pricing.extension_items(deployment, duration=duration)
+    return sum(pricing.price_batch(items, zos=deployment.zos)) + len(items) * TRANSACTION_FEES
+
+
+def _extend_wallet(identity_name, deployments, duration):
+    wallet = j.clients.stellar.find(identity_name)
+    if not wallet:
+        return {deployment.instance_name: NO_WALLET for deployment in deployments}
+
+    results = {}
+    utils.invalidate_wallet_balance(wallet.instance_name)
+    balance = utils.get_wallet_balance(wallet)
+    # soonest expiring first, so they are the ones extended if the balance doesn't cover all of them
+    to_extend = []
+    for deployment in sorted(deployments, key=lambda deployment: deployment.expiration_date.timestamp()):
+        cost = extension_cost(deployment, duration)
+        if cost > balance:
+            results[deployment.instance_name] = INSUFFICIENT_FUNDS
+            continue
+        balance -= cost
+        to_extend.append(deployment)
+
+    reservations = defaultdict(list)  # {instance_name: [reservation_id]}
+    for deployment in to_extend:
+        try:
+            for pool_id, cloud_units in deployment.get_extension_units(duration).items():
+                payment_detail = deployment.submit_pool_extension(
+                    pool_id, wallet, cu=cloud_units["cu"], su=cloud_units["su"]
+                )
+                reservations[deployment.instance_name].append((deployment, payment_detail.reservation_id))
+        except InsufficientFunds:
+            results[deployment.instance_name] = INSUFFICIENT_FUNDS
+        except Exception as e:
+            j.logger.exception(f"Failed to extend deployment {deployment.instance_name}", exception=e)
+            results[deployment.instance_name] = FAILED
+
+    waits = {
+        reservation_id: gevent.spawn(payments.wait_pool_payment, reservation_id, zos=deployment.zos)
+        for deployment_reservations in reservations.values()
+        for deployment, reservation_id in deployment_reservations
+    }
+    gevent.joinall(list(waits.values()))
+    for deployment in to_extend:
+        deployment_reservations = reservations.get(deployment.instance_name, [])
+        paid = all(waits[reservation_id].value for _, reservation_id in deployment_reservations)
+        if deployment_reservations and not paid:
+            j.logger.error(f"Extension payment of deployment {deployment.instance_name} was not released")
+            results.setdefault(deployment.instance_name, FAILED)
+        try:
+            deployment._update_deployment()
+        except Exception as e:
+            j.logger.exception(f"Failed to update deployment {deployment.instance_name}", exception=e)
+        results.setdefault(deployment.instance_name, EXTENDED)
+    return results
+
+
+def extend_deployments(deployments, duration=EXTENSION_DURATION, concurrency=EXTEND_CONCURRENCY):
+    """Extend deployments grouped by owner wallet, up to `concurrency` wallets at a time
+
+    Returns:
+        dict: {instance_name: one of EXTENDED, INSUFFICIENT_FUNDS, NO_WALLET or FAILED}
+    """
+    by_identity = defaultdict(list)
+    for deployment in deployments:
+        by_identity[deployment.identity_name].append(deployment)
+
+    def extend(identity_name):
+        try:
+            return _extend_wallet(identity_name, by_identity[identity_name], duration)
+        except Exception as e:
+            j.logger.exception(f"Failed to extend deployments of {identity_name}", exception=e)
+            return {deployment.instance_name: FAILED for deployment in by_identity[identity_name]}
+
+    results = {}
+    for wallet_results in Pool(concurrency).imap_unordered(extend, list(by_identity)):
+        results.update(wallet_results)
+    return results
@@ -0,0 +1,180 @@
+"""
+In-memory health registry of the grid nodes the jukebox deploys on.
+
+Every node has a circuit breaker fed by the outcome of the network and container workloads deployed on it:
+
+- closed: the node is scheduled normally
+- open: after FAILURE_THRESHOLD consecutive failures the node is excluded for a cooldown, which doubles every time
+  the circuit opens again, up to MAX_COOLDOWN; failures reported while it is open don't extend it
+- half open: once the cooldown is over, a single trial deployment is let through; its success closes the circuit,
+  its failure opens it again
+
+The scheduler exclusions are the unavailable circuits plus the reservation chatflow blocklist, which is cached for
+BLOCKLIST_TTL and kept up to date locally instead of being read from redis on every deployment. Farms are ranked by
+their number of unavailable nodes.
+"""
+import time
+
+from jumpscale.loader import j
+
+from jumpscale.sals.jukebox.cache import TTLCache
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+FAILURE_THRESHOLD = 2  # the first failure is already covered by the reservation chatflow blocklist
+BASE_COOLDOWN = 10 * 60
+MAX_COOLDOWN = 4 * 60 * 60
+TRIAL_TIMEOUT = 10 * 60  # a half open trial that never reported back lets another one through
+BLOCKLIST_TTL = 60
+
+
+class NodeCircuit:
+    def __init__(self, node_id, farm_name=None):
+        self.node_id = node_id
+        self.farm_name = farm_name
+        self.state = CLOSED
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.opened = 0  # times the circuit opened since it was last closed
+        self.retry_at = 0
+        self.trial_started_at = None
+        self.last_error = None
+
+    def is_available(self, now):
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return now >= self.retry_at
+        return self.trial_started_at is None or now - self.trial_started_at > TRIAL_TIMEOUT
+
+    def open(self, now):
+        self.state = OPEN
+        self.opened += 1
+        self.retry_at = now + min(BASE_COOLDOWN * 2 ** (self.opened - 1), MAX_COOLDOWN)
+        self.trial_started_at = None
+
+    def to_dict(self, now):
+        return {
+            "node_id": self.node_id,
+            "farm": self.farm_name,
+            "state": self.state,
+            "successes": self.successes,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "retry_in": round(max(self.retry_at - now, 0)) if self.state == OPEN else None,
+            "last_error": self.last_error,
+        }
+
+
+class NodeHealth:
+    def __init__(self):
+        self._circuits = {}  # {node_id: NodeCircuit}
+        self._blocklist = TTLCache(BLOCKLIST_TTL, maxsize=1)
+
+    def _circuit(self, node_id, farm_name=None):
+        circuit = self._circuits.get(node_id)
+        if not circuit:
+            circuit = self._circuits[node_id] = NodeCircuit(node_id, farm_name)
+        elif farm_name:
+            circuit.farm_name = farm_name
+        return circuit
+
+    def blocked_nodes(self):
+        """Get the node ids of the reservation chatflow blocklist, read at most once per BLOCKLIST_TTL"""
+        return self._blocklist.get_or_set(
+            "blocked", lambda: set(j.sals.reservation_chatflow.reservation_chatflow.list_blocked_nodes().keys())
+        )
+
+    def excluded_nodes(self):
+        """Get the node ids the scheduler must not pick: blocked nodes and unavailable circuits"""
+        now = time.monotonic()
+        unavailable = {node_id for node_id, circuit in self._circuits.items() if not circuit.is_available(now)}
+        return self.blocked_nodes() | unavailable
+
+    def allow(self, node_id):
+        """Check if a deployment can go to a node picked by the scheduler, taking the trial slot of a half open node"""
+        circuit = self._circuits.get(node_id)
+        now = time.monotonic()
+        if not circuit or circuit.state == CLOSED:
+            return True
+        if not circuit.is_available(now):
+            return False
+        circuit.state = HALF_OPEN
+        circuit.trial_started_at = now
+        return True
+
+    def record_success(self, node_id, farm_name=None):
+        circuit = self._circuit(node_id, farm_name)
+        circuit.successes += 1
+        circuit.consecutive_failures = 0
+        if circuit.state == CLOSED:
+            return
+        circuit.opened = 0
+        circuit.state = CLOSED
+        circuit.trial_started_at = None
+        # only lift the block this registry asked for when the circuit opened, other code may block nodes too
+        j.sals.reservation_chatflow.reservation_chatflow.unblock_node(node_id)
+        blocked = self._blocklist.get("blocked")
+        if blocked:
+            blocked.discard(node_id)
+
+    def record_failure(self, node_id, farm_name=None, error=None, block=True):
+        """Record a failed workload on a node
+
+        Args:
+            node_id (str): node id
+            farm_name (str): farm of the node, used to rank farms
+            error (str): failure reason shown in the registry listing
+            block (bool): also add the node to the reservation chatflow blocklist
+        """
+        circuit = self._circuit(node_id, farm_name)
+        circuit.failures += 1
+        circuit.consecutive_failures += 1
+        circuit.last_error = str(error)[:200] if error else None
+        # an open circuit stays open, the failures of workloads still in flight must not escalate its cooldown
+        if circuit.state == HALF_OPEN or (
+            circuit.state == CLOSED and circuit.consecutive_failures >= FAILURE_THRESHOLD
+        ):
+            circuit.open(time.monotonic())
+            j.logger.warning(f"Node {node_id} circuit opened after {circuit.consecutive_failures} failures")
+        if block:
+            j.sals.reservation_chatflow.reservation_chatflow.block_node(node_id)
+            blocked = self._blocklist.get("blocked")
+            if blocked is not None:
+                blocked.add(node_id)
+
+    def farm_penalty(self, farm_name):
+        """Get the number of unavailable nodes of a farm"""
+        now = time.monotonic()
+        return sum(
+            1
+            for circuit in self._circuits.values()
+            if circuit.farm_name == farm_name and not circuit.is_available(now)
+        )
+
+    def rank_farms(self, farm_names):
+        """Sort farms by number of unavailable nodes, keeping the given order between equally healthy farms"""
+        return sorted(farm_names, key=self.farm_penalty)
+
+    def healthiest_farms(self, farm_names):
+        """Get the farms with the fewest unavailable nodes"""
+        penalties = {farm_name: self.farm_penalty(farm_name) for farm_name in farm_names}
+        lowest = min(penalties.values(), default=0)
+        return [farm_name for farm_name in farm_names if penalties[farm_name] == lowest]
+
+    def list_circuits(self, state=None):
+        """Get the circuits of the known nodes, the unhealthy ones first
+
+        Args:
+            state (str): only the circuits in this state (closed, open or half_open)
+        """
+        circuits = [circuit for circuit in self._circuits.values() if not state or circuit.state == state]
+        circuits.sort(key=lambda circuit: (circuit.state == CLOSED, -circuit.consecutive_failures))
+        now = time.monotonic()
+        return [circuit.to_dict(now) for circuit in circuits]
+
+
+REGISTRY = NodeHealth()
@@ -1,15 +1,17 @@
 from collections import defaultdict
-from time import sleep
+import time
 import uuid
 
 import gevent
+from gevent.pool import Pool
 from jumpscale.clients.explorer.models import DiskType, State as WorkloadState, NextAction
 from jumpscale.core.base import Base, fields
 from jumpscale.core.base import Base, fields
 from jumpscale.loader import j
-from jumpscale.sals.reservation_chatflow import DeploymentFailed, deployer
+from jumpscale.sals.reservation_chatflow import DeploymentFailed
 
-from jumpscale.sals.jukebox import utils
+from jumpscale.sals.jukebox import explorer, health, metrics, payments, stats, tracing, utils
+from jumpscale.sals.jukebox.explorer import deployer
 from jumpscale.sals.jukebox.models import BlockchainNode, State
 from jumpscale.sals.vdc.scheduler import Scheduler
 from gevent.lock import BoundedSemaphore
@@ -18,6 +20,11 @@ from gevent.lock import BoundedSemaphore
 CURRENCIES = ["TFT"]
 IDENTITY_PREFIX = "jukebox"
 POOL_EXPIRATION_VALUE = 9223372036854775807
+BATCH_SIZE = 10  # container workloads signed and submitted concurrently
+WORKLOAD_EXPIRY = 3 * 60  # seconds to wait for a container workload to be provisioned
+WORKLOAD_POLL_INTERVAL = 1
+
+_wallet_locks = defaultdict(lambda: BoundedSemaphore(1))  # payouts from the same wallet can't run concurrently
 
 
 def on_exception(greenlet_thread):
@@ -36,7 +43,8 @@ class JukeboxDeployment(Base):
     deployment_name = fields.String(required=True)
     farm_name = fields.String()
     nodes_count = fields.Integer(required=True)
-    pool_ids = fields.List(fields.Integer())  # in case we will support multiple locations
+    pool_ids = fields.List(fields.Integer())  # one pool per farm
+    farm_names = fields.List(fields.String())  # farm of each pool in pool_ids
     nodes = fields.List(fields.Object(BlockchainNode))
     state = fields.Enum(State)
     expiration_date = fields.DateTime()
@@ -52,54 +60,108 @@ class JukeboxDeployment(Base):
     @property
     def zos(self):
         if self._zos is None:
-            self._zos = j.sals.zos.get(self.identity_name)
+            self._zos = explorer.get_zos(self.identity_name)
         return self._zos
 
     def lock_deployment(function):
         # NOTE: Please use it carefully.
         def wrapper(self, *args, **kwargs):
+            start = time.monotonic()
             self.__lock.acquire()
+            acquired = time.monotonic()
+            metrics.LOCK_WAIT_SECONDS.observe(acquired - start, function=function.__name__)
             try:
                 result = function(self, *args, **kwargs)
             except Exception as e:
                 raise e
             finally:
                 self.__lock.release()
+                metrics.LOCK_HOLD_SECONDS.observe(time.monotonic() - acquired, function=function.__name__)
 
             return result
 
         return wrapper
 
+    def save(self):
+        super().save()
+        try:
+            stats.update(self)
+        except Exception as e:
+            j.logger.exception(self._format_log("Failed to update fleet stats"), exception=e)
+
     def _format_log(self, msg):
         return f"Owner: {self.identity_name}, Solution_type: {self.solution_type}, Deployment_name: {self.deployment_name} {msg}"
 
+    def network_name_for(self, pool_id):
+        return f"{self.identity_name}_{pool_id}"
+
+    def get_pool_farm(self, pool_id):
+        if pool_id in self.pool_ids and len(self.farm_names) == len(self.pool_ids):
+            return self.farm_names[self.pool_ids.index(pool_id)]
+        return self.farm_name
+
+    def get_node_pool(self, node):
+        return node.pool_id or self.pool_ids[0]
+
+    def get_nodes_per_pool(self):
+        """Get the number of nodes each pool has to pay for"""
+        if len(self.pool_ids) == 1:
+            return {self.pool_ids[0]: self.nodes_count}
+        nodes_per_pool = {pool_id: 0 for pool_id in self.pool_ids}
+        for node in self.nodes:
+            if node.state != State.DELETED:
+                nodes_per_pool[self.get_node_pool(node)] = nodes_per_pool.get(self.get_node_pool(node), 0) + 1
+        return nodes_per_pool
+
+    @lock_deployment
+    def _add_pool(self, pool_id, farm_name):
+        # pools created before multi farm support have no farm_names
+        self.farm_names.extend([self.farm_name] * (len(self.pool_ids) - len(self.farm_names)))
+        self.pool_ids.append(pool_id)
+        self.farm_names.append(farm_name)
+        self.save()
+
     def wait_pool_payment(self, reservation_id, exp=5):
         j.logger.info(self._format_log(f"Waiting pool payment for reservation_id: {reservation_id}"))
-        expiration = j.data.time.now().timestamp + exp * 60
-        while j.data.time.get().timestamp < expiration:
-            payment_info = self.zos.pools.get_payment_info(reservation_id)
-            if payment_info.paid and payment_info.released:
-                return True
-            gevent.sleep(1)
-        return False
+        with tracing.span("pool_payment_wait", reservation_id=reservation_id):
+            return payments.wait_pool_payment(reservation_id, timeout=exp * 60, zos=self.zos)
 
     def create_capacity_pool(self, wallet, cu=100, su=100, ipv4us=0, farm="freefarm"):
         j.logger.info(self._format_log(f"Creating a pool with {cu} cus, {su} sus and {ipv4us} ipv4us on farm {farm}"))
-        payment_detail = self.zos.pools.create(cu=cu, su=su, ipv4us=ipv4us, farm=farm)
-        self.zos.billing.payout_farmers(wallet, payment_detail)
+        with tracing.span("pool_reserve", farm=farm):
+            payment_detail = self.zos.pools.create(cu=cu, su=su, ipv4us=ipv4us, farm=farm)
+        try:
+            with tracing.span("pool_payout", farm=farm), _wallet_locks[wallet.instance_name]:
+                self.zos.billing.payout_farmers(wallet, payment_detail)
+        finally:
+            utils.invalidate_wallet_balance(wallet.instance_name)
         if not self.wait_pool_payment(payment_detail.reservation_id):
             raise DeploymentFailed(f"Failed to pay to pool {payment_detail.reservation_id}")
 
         # TODO add in QR code with payment total for users
         j.logger.info(self._format_log(f"Pool {payment_detail.reservation_id} has been created successfully"))
-        self.pool_ids.append(payment_detail.reservation_id)
-        self.save()
+        self._add_pool(payment_detail.reservation_id, farm)
         return payment_detail.reservation_id
 
-    def extend_capacity_pool(self, pool_id, wallet, cu=100, su=100, ipv4us=0):
+    def submit_pool_extension(self, pool_id, wallet, cu=100, su=100, ipv4us=0):
+        """Reserve a pool extension and pay it, without waiting for the payment to be released
+
+        Returns:
+            payment detail of the extension reservation
+        """
         j.logger.info(self._format_log(f"Extending pool {pool_id} with {cu} cus, {su} sus and {ipv4us} ipv4us"))
-        payment_detail = self.zos.pools.extend(pool_id=pool_id, cu=cu, su=su, ipv4us=ipv4us)
-        self.zos.billing.payout_farmers(wallet, payment_detail)
+        farm_name = self.get_pool_farm(pool_id)
+        with tracing.span("pool_reserve", farm=farm_name, pool_id=pool_id):
+            payment_detail = self.zos.pools.extend(pool_id=pool_id, cu=cu, su=su, ipv4us=ipv4us)
+        try:
+            with tracing.span("pool_payout", farm=farm_name, pool_id=pool_id), _wallet_locks[wallet.instance_name]:
+                self.zos.billing.payout_farmers(wallet, payment_detail)
+        finally:
+            utils.invalidate_wallet_balance(wallet.instance_name)
+        return payment_detail
+
+    def extend_capacity_pool(self, pool_id, wallet, cu=100, su=100, ipv4us=0):
+        payment_detail = self.submit_pool_extension(pool_id, wallet, cu=cu, su=su, ipv4us=ipv4us)
         if not self.wait_pool_payment(payment_detail.reservation_id):
             raise DeploymentFailed(f"Failed to pay to pool {payment_detail.reservation_id}")
         j.logger.info(
@@ -109,29 +171,32 @@ class JukeboxDeployment(Base):
         )
         return payment_detail.reservation_id
 
-    def get_container_ip(self, network_name, node, excluded_ips=None):
+    def get_container_ip(self, network_name, node, excluded_ips=None, pool_id=None):
         j.logger.info(self._format_log(f"Add network {network_name} to node {node.node_id}"))
         excluded_ips = excluded_ips or []
+        pool_id = pool_id or self.pool_ids[0]
+        farm_name = self.get_pool_farm(pool_id)
         try:
-            network_view = deployer.get_network_view(network_name, identity_name=self.identity_name)
-            network_view_copy = network_view.copy()
-            result = deployer.add_network_node(
-                network_view.name,
-                node,
-                self.pool_ids[0],
-                network_view_copy,
-                identity_name=self.identity_name,
-                owner=self.identity_name,
-            )
+            with tracing.span("get_container_ip", farm=farm_name, node=node.node_id):
+                network_view = deployer.get_network_view(network_name, identity_name=self.identity_name)
+                network_view_copy = network_view.copy()
+                result = deployer.add_network_node(
+                    network_view.name,
+                    node,
+                    pool_id,
+                    network_view_copy,
+                    identity_name=self.identity_name,
+                    owner=self.identity_name,
+                )
 
-            if result:
-                for wid in result["ids"]:
-                    success = deployer.wait_workload(wid, None, breaking_node_id=node.node_id, expiry=3)
-                    if not success:
-                        raise DeploymentFailed(f"Failed to add node {node.node_id} to network {wid}", wid=wid)
+                if result:
+                    for wid in result["ids"]:
+                        success = deployer.wait_workload(wid, None, breaking_node_id=node.node_id, expiry=3)
+                        if not success:
+                            raise DeploymentFailed(f"Failed to add node {node.node_id} to network {wid}", wid=wid)
         except Exception as e:
             j.logger.exception(self._format_log(f"Failed to deploy network on {node.node_id}"), exception=e)
-            j.sals.reservation_chatflow.reservation_chatflow.block_node(node.node_id)
+            health.REGISTRY.record_failure(node.node_id, farm_name, error=e)
             return
 
         network_view_copy = network_view_copy.copy()
@@ -140,82 +205,143 @@ class JukeboxDeployment(Base):
             if ip not in excluded_ips:
                 return ip
 
-    def deploy_network(self, network_name, ip_range=None):
+    def deploy_network(self, network_name, ip_range=None, pool_id=None):
         j.logger.info(self._format_log(f"Creating network {network_name} with ip_range {ip_range}"))
         ip_range = ip_range or utils.get_network_ip_range()
-        scheduler = Scheduler(pool_id=self.pool_ids[0])
-        network_success = False
-        ip_version = "IPv4"
-        for access_node in scheduler.nodes_by_capacity(ip_version=ip_version, accessnodes=True):
-            j.logger.info(self._format_log(f"Deploying network {network_name} on node {access_node.node_id}"))
-            network_success = True
-            result = deployer.deploy_network(
-                network_name, access_node, ip_range, ip_version, self.pool_ids[0], self.identity_name
-            )
-            for wid in result["ids"]:
-                try:
-                    success = deployer.wait_workload(
-                        wid,
-                        breaking_node_id=access_node.node_id,
-                        identity_name=self.identity_name,
-                        bot=None,
-                        cancel_by_uuid=False,
-                        expiry=3,
-                    )
-                    network_success = network_success and success
-                except Exception as e:
-                    network_success = False
-                    j.logger.exception(
-                        self._format_log(f"Network workload {wid} failed on node {access_node.node_id}"), exception=e
+        pool_id = pool_id or self.pool_ids[0]
+        farm_name = self.get_pool_farm(pool_id)
+        with tracing.span("deploy_network", farm=farm_name, pool_id=pool_id):
+            scheduler = Scheduler(pool_id=pool_id)
+            scheduler.exclude_nodes(*health.REGISTRY.excluded_nodes())
+            network_success = False
+            ip_version = "IPv4"
+            for access_node in scheduler.nodes_by_capacity(ip_version=ip_version, accessnodes=True):
+                if not health.REGISTRY.allow(access_node.node_id):
+                    continue
+                j.logger.info(self._format_log(f"Deploying network {network_name} on node {access_node.node_id}"))
+                network_success = True
+                result = deployer.deploy_network(
+                    network_name, access_node, ip_range, ip_version, pool_id, self.identity_name
+                )
+                for wid in result["ids"]:
+                    try:
+                        success = deployer.wait_workload(
+                            wid,
+                            breaking_node_id=access_node.node_id,
+                            identity_name=self.identity_name,
+                            bot=None,
+                            cancel_by_uuid=False,
+                            expiry=3,
+                        )
+                        network_success = network_success and success
+                    except Exception as e:
+                        network_success = False
+                        j.logger.exception(
+                            self._format_log(f"Network workload {wid} failed on node {access_node.node_id}"),
+                            exception=e,
+                        )
+                        break
+                if network_success:
+                    health.REGISTRY.record_success(access_node.node_id, farm_name)
+                    # store wireguard config
+                    j.logger.info(
+                        self._format_log(
+                            f"saving wireguard config to {j.core.dirs.CFGDIR}/jukebox/wireguard/{self.identity_name}/{network_name}.conf"
+                        )
                     )
-                    break
-            if network_success:
-                # store wireguard config
-                j.logger.info(
-                    self._format_log(
-                        f"saving wireguard config to {j.core.dirs.CFGDIR}/jukebox/wireguard/{self.identity_name}/{network_name}.conf"
+                    wg_quick = result["wg"]
+                    j.sals.fs.mkdirs(f"{j.core.dirs.CFGDIR}/jukebox/wireguard/{self.identity_name}")
+                    j.sals.fs.write_file(
+                        f"{j.core.dirs.CFGDIR}/jukebox/wireguard/{self.identity_name}/{network_name}.conf", wg_quick
                     )
-                )
-                wg_quick = result["wg"]
-                j.sals.fs.mkdirs(f"{j.core.dirs.CFGDIR}/jukebox/wireguard/{self.identity_name}")
-                j.sals.fs.write_file(
-                    f"{j.core.dirs.CFGDIR}/jukebox/wireguard/{self.identity_name}/{network_name}.conf", wg_quick
-                )
-                return True, wg_quick
+                    return True, wg_quick
+                health.REGISTRY.record_failure(access_node.node_id, farm_name, block=False)
 
     def deploy_all_containers(
-        self, number_of_deployments, network_name, env=None, secret_env=None, metadata=None, flist=None, entry_point="",
+        self,
+        number_of_deployments,
+        network_name,
+        env=None,
+        secret_env=None,
+        metadata=None,
+        flist=None,
+        entry_point="",
+        planned_nodes=None,
+        pool_id=None,
+        batch=None,
     ):
-        j.logger.info(self._format_log(f"Deploying {number_of_deployments} containers on farm {self.farm_name}"))
+        """Deploy containers on the nodes of the pool farm
+
+        Arguments:
+            batch (bool): submit the workloads in batches with a shared wait instead of one greenlet per container,
+                defaults to the JUKEBOX_BATCH_DEPLOY config (enabled)
+        """
+        pool_id = pool_id or self.pool_ids[0]
+        if batch is None:
+            batch = j.core.config.get("JUKEBOX_BATCH_DEPLOY", True)
+        farm_name = self.get_pool_farm(pool_id)
+        j.logger.info(self._format_log(f"Deploying {number_of_deployments} containers on farm {farm_name}"))
         metadata = metadata or {}
         env = env or {}
         secret_env = secret_env or {}
         used_ip_addresses = defaultdict(lambda: [])  # {node_id:[ip_addresses]}
-        # TODO when using multiple farms use GlobalScheduler instead and pass farm_name when deploying
-        excluded_nodes = j.sals.reservation_chatflow.reservation_chatflow.list_blocked_nodes().keys()
-        scheduler = Scheduler(farm_name=self.farm_name)
-        scheduler.exclude_nodes(*excluded_nodes)
+        planned_nodes = list(planned_nodes or [])
+        scheduler = Scheduler(farm_name=farm_name)
+        scheduler.exclude_nodes(*health.REGISTRY.excluded_nodes())
         deployment_threads = []
+        placements = []  # (node, ip_address) of the containers to deploy in batch
         i = 0
         while i < number_of_deployments:
             # for each node check how many containers can be deployed on it, and based on that assign that node for X deployments
-            node = next(scheduler.nodes_by_capacity(cru=self.cpu, hru=self.disk_size / 1024, mru=self.memory / 1024))
+            if planned_nodes:
+                node = planned_nodes.pop(0)
+            else:
+                with tracing.span("schedule", farm=farm_name):
+                    node = next(
+                        scheduler.nodes_by_capacity(cru=self.cpu, hru=self.disk_size / 1024, mru=self.memory / 1024)
+                    )
+                if not health.REGISTRY.allow(node.node_id):
+                    # circuit opened by a failure since the exclusions were read, or trial already running
+                    scheduler.exclude_nodes(node.node_id)
+                    continue
 
             excluded_ips = used_ip_addresses.get(node.node_id, [])
-            ip_address = self.get_container_ip(network_name, node, excluded_ips)
+            ip_address = self.get_container_ip(network_name, node, excluded_ips, pool_id=pool_id)
             if not ip_address:
+                scheduler.exclude_nodes(node.node_id)
                 continue
 
             used_ip_addresses[node.node_id].append(ip_address)
+            if batch:
+                placements.append((node, ip_address))
+                i += 1
+                continue
 
             # START SPAWN
             thread = gevent.spawn(
-                self.deploy_container, network_name, node, ip_address, env, metadata, flist, entry_point, secret_env,
+                self.deploy_container,
+                network_name,
+                node,
+                ip_address,
+                env,
+                metadata,
+                flist,
+                entry_point,
+                secret_env,
+                pool_id,
             )
             thread.link_exception(on_exception)
             deployment_threads.append(thread)
             i += 1
             # END SPAWN
+        if batch:
+            deployed = self.deploy_containers_batch(
+                placements, network_name, env, metadata, flist, entry_point, secret_env, pool_id
+            )
+            if not deployed:
+                raise DeploymentFailed(f"Failed to deploy containers")
+            return
+
         # TODO check resv ids success/failure, if resv failed retry on same node
         gevent.joinall(deployment_threads)
         for greenlet_thread in deployment_threads:
@@ -224,45 +350,133 @@ class JukeboxDeployment(Base):
         else:
             raise DeploymentFailed(f"Failed to deploy containers")
 
+    def _provision_farm(self, wallet, farm_name, number_of_containers, duration):
+        cloud_units = utils.calculate_required_units(
+            cpu=self.cpu,
+            memory=self.memory,
+            disk_size=self.disk_size,
+            duration_seconds=duration,
+            number_of_containers=number_of_containers,
+        )
+        pool_id = self.create_capacity_pool(wallet, cu=cloud_units["cu"], su=cloud_units["su"], farm=farm_name)
+        if not self.deploy_network(self.network_name_for(pool_id), pool_id=pool_id):
+            raise DeploymentFailed(f"Failed to deploy network on pool {pool_id}")
+        return pool_id
+
+    def create_farm_pools(self, wallet, farms_split, duration=60 * 60):
+        """Create a pool and a network on each farm concurrently
+
+        Args:
+            wallet: wallet to pay the pools from
+            farms_split (dict): {farm_name: number of containers}
+            duration (int): seconds of capacity to buy for the containers
+
+        Returns:
+            dict: {pool_id: number of containers}
+        """
+        threads = {
+            farm_name: gevent.spawn(self._provision_farm, wallet, farm_name, number_of_containers, duration)
+            for farm_name, number_of_containers in farms_split.items()
+        }
+        gevent.joinall(list(threads.values()))
+        pools_split = {}
+        for farm_name, thread in threads.items():
+            if not thread.successful():
+                raise DeploymentFailed(f"Failed to provision farm {farm_name}: {thread.exception}")
+            pools_split[thread.value] = farms_split[farm_name]
+        return pools_split
+
+    def deploy_farm_batches(self, pools_split, **kwargs):
+        """Deploy the containers of each pool in parallel, kwargs are passed to deploy_all_containers
+
+        Args:
+            pools_split (dict): {pool_id: number of containers}
+        """
+        threads = [
+            gevent.spawn(
+                self.deploy_all_containers,
+                number_of_containers,
+                network_name=self.network_name_for(pool_id),
+                pool_id=pool_id,
+                **kwargs,
+            )
+            for pool_id, number_of_containers in pools_split.items()
+            if number_of_containers
+        ]
+        if not threads:
+            return
+        gevent.joinall(threads)
+        for thread in threads:
+            if not thread.successful():
+                j.logger.error(self._format_log(f"Failed to deploy farm batch: {thread.exception}"))
+        if not any(thread.successful() for thread in threads):
+            raise DeploymentFailed(f"Failed to deploy containers on all farms")
+
     def deploy_container(
-        self, network_name, node, ip_address, env=None, metadata=None, flist=None, entry_point="", secret_env=None,
+        self,
+        network_name,
+        node,
+        ip_address,
+        env=None,
+        metadata=None,
+        flist=None,
+        entry_point="",
+        secret_env=None,
+        pool_id=None,
     ):
         j.logger.info(self._format_log(f"Deploying container with ip_address {ip_address} on network {network_name}"))
         metadata = metadata or {}
         env = env or {}
         secret_env = secret_env or {}
+        pool_id = pool_id or self.pool_ids[0]
         if not flist:
             raise j.exceptions.Value(f"Flist for {self.solution_type} not found, Please pass it")
 
-        resv_id = deployer.deploy_container(
-            identity_name=self.identity_name,
-            pool_id=self.pool_ids[0],
-            node_id=node.node_id,
-            network_name=network_name,
-            ip_address=ip_address,
-            flist=flist,
-            cpu=self.cpu,
-            memory=self.memory,
-            disk_size=self.disk_size,
-            disk_type=self.disk_type,
-            env=env,
-            interactive=False,
-            entrypoint=entry_point,
-            public_ipv6=True,
-            **metadata,
-            solution_uuid=uuid.uuid4().hex,
-            secret_env=secret_env,
-        )
-        success = deployer.wait_workload(resv_id, None, expiry=3)
+        farm_name = self.get_pool_farm(pool_id)
+        with tracing.span("deploy_container", farm=farm_name, node=node.node_id):
+            resv_id = deployer.deploy_container(
+                identity_name=self.identity_name,
+                pool_id=pool_id,
+                node_id=node.node_id,
+                network_name=network_name,
+                ip_address=ip_address,
+                flist=flist,
+                cpu=self.cpu,
+                memory=self.memory,
+                disk_size=self.disk_size,
+                disk_type=self.disk_type,
+                env=env,
+                interactive=False,
+                entrypoint=entry_point,
+                public_ipv6=True,
+                **metadata,
+                solution_uuid=uuid.uuid4().hex,
+                secret_env=secret_env,
+            )
+        with tracing.span("wait_workload", farm=farm_name, node=node.node_id, wid=resv_id):
+            try:
+                success = deployer.wait_workload(resv_id, None, expiry=3)
+            except Exception as e:
+                health.REGISTRY.record_failure(node.node_id, farm_name, error=e, block=False)
+                raise
         if not success:
+            health.REGISTRY.record_failure(node.node_id, farm_name, error=f"workload {resv_id} failed", block=False)
             raise DeploymentFailed(f"Failed to deploy workload {resv_id}", wid=resv_id)
+        health.REGISTRY.record_success(node.node_id, farm_name)
 
         j.logger.info(self._format_log(f"Container {resv_id} has been deployed successfully"))
         workload = self.zos.workloads.get(resv_id)
+        self.nodes.append(self._node_from_workload(workload, pool_id))
+        self.save()
+        return resv_id
+
+    @staticmethod
+    def _node_from_workload(workload, pool_id):
         node = BlockchainNode()
         node.wid = workload.id
         node.node_id = workload.info.node_id
         node.creation_time = workload.info.epoch
+        node.pool_id = pool_id
         node.state = State.DEPLOYED
         if workload.info.result.data_json:
             data_dict = j.data.serializers.json.loads(workload.info.result.data_json)
@@ -271,9 +485,134 @@ class JukeboxDeployment(Base):
         else:
             if workload.info.result.state != WorkloadState.Ok:
                 node.state = State.ERROR
-        self.nodes.append(node)
+        return node
+
+    def _build_container(self, network_name, node, ip_address, env, metadata, flist, entry_point, secret_env, pool_id):
+        """Build a container workload like deployer.deploy_container does, without submitting it"""
+        encrypted_secret_env = {
+            key: self.zos.container.encrypt_secret(node.node_id, value or "") for key, value in secret_env.items()
+        }
+        container = self.zos.container.create(
+            node_id=node.node_id,
+            network_name=network_name,
+            ip_address=ip_address,
+            flist=flist,
+            capacity_pool_id=pool_id,
+            env={key: value or "" for key, value in env.items()},
+            cpu=self.cpu,
+            memory=self.memory,
+            disk_size=self.disk_size,
+            entrypoint=entry_point,
+            interactive=False,
+            secret_env=encrypted_secret_env,
+            public_ipv6=True,
+        )
+        container.capacity.disk_type = self.disk_type
+        container.info.metadata = deployer.encrypt_metadata(
+            {**metadata, "solution_uuid": uuid.uuid4().hex}, identity_name=self.identity_name
+        )
+        return container
+
+    def wait_workloads(self, wids, expiry=WORKLOAD_EXPIRY, farm_name=None):
+        """Wait for many workloads at once, polling only the ones that are still being provisioned
+
+        Arguments:
+            farm_name (str): farm of the workloads pool, reported with their outcome to the health registry
+
+        Returns:
+            dict: {wid: workload} of the provisioned workloads, failed and expired ones are left out
+        """
+        pending = set(wids)
+        provisioned = {}
+        pool = Pool(BATCH_SIZE)
+        expiration = j.data.time.now().timestamp + expiry
+
+        def get(wid):
+            try:
+                return self.zos.workloads.get(wid)
+            except Exception as e:
+                j.logger.warning(self._format_log(f"Failed to get workload {wid}: {e}"))
+
+        while pending:
+            for workload in pool.imap_unordered(get, list(pending)):
+                if not workload or not workload.info.result.workload_id:
+                    continue
+                pending.discard(workload.id)
+                if workload.info.result.state == WorkloadState.Ok:
+                    health.REGISTRY.record_success(workload.info.node_id, farm_name)
+                    provisioned[workload.id] = workload
+                else:
+                    j.logger.error(
+                        self._format_log(f"Workload {workload.id} failed with error {workload.info.result.message}")
+                    )
+                    health.REGISTRY.record_failure(
+                        workload.info.node_id, farm_name, error=workload.info.result.message, block=False
+                    )
+            if not pending or j.data.time.now().timestamp > expiration:
+                break
+            gevent.sleep(WORKLOAD_POLL_INTERVAL)
+
+        for wid in pending:
+            j.logger.error(self._format_log(f"Workload {wid} was not provisioned in {expiry} seconds"))
+            try:
+                workload = self.zos.workloads.get(wid)
+                health.REGISTRY.record_failure(
+                    workload.info.node_id, farm_name, error=f"not provisioned in {expiry} seconds"
+                )
+                self.zos.workloads.decomission(wid)
+            except Exception as e:
+                j.logger.exception(self._format_log(f"Failed to cancel workload {wid}"), exception=e)
+        return provisioned
+
+    def deploy_containers_batch(
+        self,
+        placements,
+        network_name,
+        env=None,
+        metadata=None,
+        flist=None,
+        entry_point="",
+        secret_env=None,
+        pool_id=None,
+    ):
+        """Sign and submit the container workloads BATCH_SIZE at a time, then wait for all of them together
+
+        Arguments:
+            placements (list): (node, ip_address) of each container
+
+        Returns:
+            int: number of containers deployed successfully
+        """
+        if not flist:
+            raise j.exceptions.Value(f"Flist for {self.solution_type} not found, Please pass it")
+        pool_id = pool_id or self.pool_ids[0]
+        metadata = metadata or {}
+        env = env or {}
+        secret_env = secret_env or {}
+        j.logger.info(self._format_log(f"Submitting {len(placements)} containers on network {network_name}"))
+
+        farm_name = self.get_pool_farm(pool_id)
+
+        def submit(placement):
+            node, ip_address = placement
+            try:
+                with tracing.span("deploy_container", farm=farm_name, node=node.node_id):
+                    container = self._build_container(
+                        network_name, node, ip_address, env, metadata, flist, entry_point, secret_env, pool_id
+                    )
+                    return self.zos.workloads.deploy(container)
+            except Exception as e:
+                j.logger.exception(self._format_log(f"Failed to submit container on {node.node_id}"), exception=e)
+
+        wids = [wid for wid in Pool(BATCH_SIZE).imap(submit, placements) if wid]
+        with tracing.span("wait_workload", farm=farm_name, pool_id=pool_id, workloads=len(wids)):
+            provisioned = self.wait_workloads(wids, farm_name=farm_name)
+        for wid in wids:
+            if wid in provisioned:
+                self.nodes.append(self._node_from_workload(provisioned[wid], pool_id))
         self.save()
-        return resv_id
+        j.logger.info(self._format_log(f"{len(provisioned)}/{len(placements)} containers have been deployed"))
+        return len(provisioned)
 
     @lock_deployment
     def delete_node(self, wid):
@@ -285,25 +624,22 @@ class JukeboxDeployment(Base):
                 self.save()
                 self.zos.workloads.decomission(node.wid)
 
-    def deploy_from_workload(self, number_of_containers, final_state=State.DEPLOYED, redeploy=False):
+    def deploy_from_workload(self, number_of_containers, final_state=State.DEPLOYED, redeploy=False, split=None):
+        """Deploy more containers like the existing ones
+
+        Arguments:
+            split (dict): {pool_id: number of containers}, all the containers go to the first pool by default
+        """
         self._update_state(State.DEPLOYING)
-        wid = self.nodes[0].wid
-        workload = self.zos.workloads.get(wid)
-        network_name = f"{self.identity_name}_{self.pool_ids[0]}"
-        secret_env = j.sals.reservation_chatflow.deployer.decrypt_metadata(self.secret_env, self.identity_name)
-        secret_env_dict = j.data.serializers.json.loads(secret_env)
-        metadata = j.sals.reservation_chatflow.deployer.decrypt_metadata(workload.info.metadata, self.identity_name)
-        metadata_dict = j.data.serializers.json.loads(metadata)
-        metadata_dict.pop("solution_uuid")
-
-        self.deploy_all_containers(
-            number_of_containers,
-            network_name=network_name,
-            env=workload.environment,
-            secret_env=secret_env_dict,
-            metadata=metadata_dict,
-            flist=workload.flist,
-            entry_point=workload.entrypoint,
+        template = utils.get_deployment_template(self)
+
+        self.deploy_farm_batches(
+            split or {self.pool_ids[0]: number_of_containers},
+            env=template["env"],
+            secret_env=template["secret_env"],
+            metadata=template["metadata"],
+            flist=template["flist"],
+            entry_point=template["entrypoint"],
         )
         if not redeploy:
             self._update_nodes_count(self.nodes_count + number_of_containers)
@@ -311,7 +647,15 @@ class JukeboxDeployment(Base):
 
     def redeploy_containers(self, number_of_containers):
         j.logger.info(self._format_log(f"Redeploying {number_of_containers} containers"))
-        self.deploy_from_workload(number_of_containers, final_state=State.DEPLOYING, redeploy=True)
+        # redeploy the errored containers on the pools they were on
+        split = defaultdict(int)
+        for node in self.nodes:
+            if node.state == State.ERROR and sum(split.values()) < number_of_containers:
+                split[self.get_node_pool(node)] += 1
+        if sum(split.values()) < number_of_containers:
+            split[self.pool_ids[0]] += number_of_containers - sum(split.values())
+        with tracing.trace(self.instance_name, "redeploy"):
+            self.deploy_from_workload(number_of_containers, final_state=State.DEPLOYING, redeploy=True, split=split)
 
         number_deployed_containers = len(self.nodes) - self.nodes_count
         number_failed_containers = number_of_containers - number_deployed_containers
@@ -339,40 +683,146 @@ class JukeboxDeployment(Base):
         self.nodes = new_nodes
         self.save()
 
+    @lock_deployment
+    def mark_nodes_down(self, wids):
+        """Mark the suspect nodes as down, so self healing replaces them
+
+        A node whose workload the explorer reports as running is marked as NOT_RESPONDING, its container is kept until
+        self healing replaces it or its daemon answers again; the containers of the other nodes are decomissioned
+        unless they are already deleted and the nodes are marked as errored.
+
+        Returns:
+            list: wids of the nodes marked as not responding or errored
+        """
+        marked = []
+        for node in self.nodes:
+            if node.wid not in wids or node.state != State.DEPLOYED:
+                continue
+            try:
+                workload = self.zos.workloads.get(node.wid)
+            except Exception as e:
+                j.logger.exception(self._format_log(f"Failed to get workload {node.wid}"), exception=e)
+                continue
+            running = workload.info.result.state == WorkloadState.Ok and workload.info.next_action == NextAction.DEPLOY
+            if running:
+                j.logger.warning(
+                    self._format_log(f"Node {node.wid} is not answering liveness probes but its workload is running")
+                )
+                node.state = State.NOT_RESPONDING
+                marked.append(node.wid)
+                continue
+            j.logger.warning(self._format_log(f"Node {node.wid} is not answering liveness probes and not running"))
+            if workload.info.next_action != NextAction.DELETED:
+                try:
+                    self.zos.workloads.decomission(node.wid)
+                except Exception as e:
+                    j.logger.exception(self._format_log(f"Failed to decomission node {node.wid}"), exception=e)
+                    continue
+            node.state = State.ERROR
+            marked.append(node.wid)
+        if marked:
+            self.save()
+        return marked
+
+    @lock_deployment
+    def mark_nodes_up(self, wids):
+        """Mark the not responding nodes that answer the liveness probes again as deployed
+
+        Returns:
+            list: wids of the nodes marked as deployed
+        """
+        marked = []
+        for node in self.nodes:
+            if node.wid in wids and node.state == State.NOT_RESPONDING:
+                j.logger.info(self._format_log(f"Node {node.wid} is answering liveness probes again"))
+                node.state = State.DEPLOYED
+                marked.append(node.wid)
+        if marked:
+            self.save()
+        return marked
+
+    @lock_deployment
+    def release_unresponsive_nodes(self, wids):
+        """Decomission the containers of not responding nodes and mark them as errored, so they get redeployed
+
+        Returns:
+            list: wids of the nodes marked as errored
+        """
+        released = []
+        for node in self.nodes:
+            if node.wid not in wids or node.state != State.NOT_RESPONDING:
+                continue
+            try:
+                self.zos.workloads.decomission(node.wid)
+            except Exception as e:
+                j.logger.exception(self._format_log(f"Failed to decomission node {node.wid}"), exception=e)
+                continue
+            node.state = State.ERROR
+            released.append(node.wid)
+        if released:
+            self.save()
+        return released
+
     @lock_deployment
     def _update_nodes_count(self, new_count):
         self.nodes_count = new_count
         self.save()
 
+    def get_pools_expiration(self):
+        """Get the earliest expiration of the pools that have containers"""
+        nodes_per_pool = self.get_nodes_per_pool()
+        pool_ids = [pool_id for pool_id in self.pool_ids if nodes_per_pool.get(pool_id)] or self.pool_ids[:1]
+        return min(self.zos.pools.get(pool_id).empty_at for pool_id in pool_ids)
+
     @lock_deployment
     def _update_deployment(self):
-        pool = self.zos.pools.get(self.pool_ids[0])
-        if pool.empty_at == POOL_EXPIRATION_VALUE and pool.cus == 0:  # Also add check on sus if VMs are used
+        nodes_per_pool = self.get_nodes_per_pool()
+        pools = {
+            pool_id: self.zos.pools.get(pool_id)
+            for pool_id in self.pool_ids
+            if nodes_per_pool.get(pool_id) or pool_id == self.pool_ids[0]
+        }
+        unused = {pool_id for pool_id, pool in pools.items() if pool.empty_at == POOL_EXPIRATION_VALUE}
+        expired = {pool_id for pool_id in unused if pools[pool_id].cus == 0}  # Also add check on sus if VMs are used
+        if len(expired) == len(pools):
             self.state = State.EXPIRED
-        elif pool.empty_at == POOL_EXPIRATION_VALUE:
+        elif unused:
             self.state = State.ERROR
         else:
-            self.expiration_date = pool.empty_at
+            self.expiration_date = min(pool.empty_at for pool in pools.values())
         for node in self.nodes:
             workload = self.zos.workloads.get(node.wid)
             if workload.info.next_action == NextAction.DEPLOY or node.state in [State.DELETED, State.EXPIRED]:
                 continue
 
-            elif pool.empty_at == POOL_EXPIRATION_VALUE and pool.cus == 0:  # Also add check on sus if VMs are used
+            elif self.get_node_pool(node) in expired:
                 node.state = State.EXPIRED
             else:
                 node.state = State.ERROR
         self.save()
 
+    def get_extension_units(self, duration=60 * 60 * 24 * 30):
+        """Get the cloud units to add to each pool to extend the deployment by `duration` seconds
+
+        Returns:
+            dict: {pool_id: {"cu", "su", "ipv4u"}} of the pools that have containers
+        """
+        return {
+            pool_id: utils.calculate_required_units(
+                cpu=self.cpu,
+                memory=self.memory,
+                disk_size=self.disk_size,
+                duration_seconds=duration,
+                number_of_containers=number_of_containers,
+            )
+            for pool_id, number_of_containers in self.get_nodes_per_pool().items()
+            if number_of_containers
+        }
+
     def extend(self, duration=60 * 60 * 24 * 30):
         j.logger.info(self._format_log(f"Extending with {duration} seconds"))
         wallet = j.clients.stellar.get(self.identity_name)
-        cloud_units = utils.calculate_required_units(
-            cpu=self.cpu,
-            memory=self.memory,
-            disk_size=self.disk_size,
-            duration_seconds=duration,
-            number_of_containers=self.nodes_count,
-        )
-        self.extend_capacity_pool(pool_id=self.pool_ids[0], wallet=wallet, cu=cloud_units["cu"], su=cloud_units["su"])
-        self._update_deployment()
+        with tracing.trace(self.instance_name, "extend"):
+            for pool_id, cloud_units in self.get_extension_units(duration).items():
+                self.extend_capacity_pool(pool_id=pool_id, wallet=wallet, cu=cloud_units["cu"], su=cloud_units["su"])
+            self._update_deployment()
@@ -2,17 +2,62 @@ from contextlib import ContextDecorator
 import random
 from textwrap import dedent
 
+import gevent
 from jumpscale.clients.explorer.models import DiskType
 from jumpscale.clients.stellar import TRANSACTION_FEES
 from jumpscale.loader import j
 from jumpscale.sals.chatflows.chatflows import GedisChatBot, StopChatFlow, chatflow_step
 from jumpscale.sals.marketplace.apps_chatflow import MarketPlaceAppsChatflow
 
-from jumpscale.sals.jukebox import utils
+from jumpscale.sals.jukebox import explorer, health, pricing, ratelimit, tracing, utils, warm_capacity
+from jumpscale.sals.jukebox.cache import TTLCache
 from jumpscale.sals.jukebox.models import State
+from jumpscale.sals.jukebox.speculative import SpeculativeProvision
 
 IDENTITY_PREFIX = "jukebox"
 INIT_WALLET = "init_wallet"
+ACTIVATION_WALLET = "activation_wallet"
+SYSTEM_CHECK_TTL = 60
+SYSTEM_CHECK_ERROR_TTL = 10
+
+_system_checks = TTLCache(ttl=SYSTEM_CHECK_TTL, maxsize=64)  # {check: error message or ""}
+
+
+def _system_check_ttl(error):
+    return SYSTEM_CHECK_ERROR_TTL if error else SYSTEM_CHECK_TTL
+
+
+def get_stellar_service_error():
+    def check():
+        if not j.clients.stellar.check_stellar_service():
+            return "Payment service is currently down, try again later"
+        return ""
+
+    return _system_checks.get_or_set("stellar_service", check, ttl=_system_check_ttl)
+
+
+def get_wallet_error(name, asset, limit):
+    """Check that a system wallet exists and has at least `limit` of `asset`, the result is cached for all chats
+
+    Returns:
+        str: error message, empty if the wallet is healthy
+    """
+
+    def check():
+        if name not in j.clients.stellar.list_all():
+            j.logger.info(f"This system doesn't have {name} configured")
+            return f"{name} doesn't exist, please contact support."
+        try:
+            balance = explorer.wallet_call(j.clients.stellar.find(name), "get_balance_by_asset", asset)
+        except Exception as e:
+            j.logger.exception(f"Failed to get {name} balance", exception=e)
+            return f"Couldn't get the balance for {name} wallet"
+        if balance < limit:
+            return f"{name} doesn't have enough {asset} to support the deployment."
+        j.logger.info(f"{name} is funded")
+        return ""
+
+    return _system_checks.get_or_set((name, asset, limit), check, ttl=_system_check_ttl)
 
 
 class new_jukebox_context(ContextDecorator):
@@ -32,6 +77,7 @@ class new_jukebox_context(ContextDecorator):
 class JukeboxDeployChatflow(MarketPlaceAppsChatflow):
     ENTRY_POINT = ""
     DISK_TYPE = DiskType.HDD
+    SPECULATIVE_DEPLOY = True  # prepare pool and network during payment when JUKEBOX_SPECULATIVE_DEPLOY is set
 
     title = "Blockchain"
     steps = [
@@ -47,18 +93,15 @@ class JukeboxDeployChatflow(MarketPlaceAppsChatflow):
     QUERY = {"cru": 1, "mru": 1, "hru": 1}
 
     def _check_wallet(self, name, asset, limit):
-        if name in j.clients.stellar.list_all():
-            try:
-                w = j.clients.stellar.find(name)
-                if w.get_balance_by_asset(asset) < limit:
-                    raise StopChatFlow(f"{name} doesn't have enough {asset} to support the deployment.")
-            except:
-                raise StopChatFlow(f"Couldn't get the balance for {name} wallet")
-            else:
-                j.logger.info(f"{name} is funded")
-        else:
-            j.logger.info(f"This system doesn't have {name} configured")
-            raise StopChatFlow(f"{name} doesn't exist, please contact support.")
+        error = get_wallet_error(name, asset, limit)
+        if error:
+            raise StopChatFlow(error)
+
+    def _prepare_user_wallet(self, wallet_name):
+        if not j.clients.stellar.find(wallet_name):
+            # check xlms
+            self._check_wallet(name=ACTIVATION_WALLET, asset="XLM", limit=10)
+        return utils.get_or_create_user_wallet(wallet_name)
 
     def _init(self):
         self.env = {}
@@ -70,22 +113,24 @@ class JukeboxDeployChatflow(MarketPlaceAppsChatflow):
         self.identity_name = f"{IDENTITY_PREFIX}_{self.owner_tname}"
 
         self.md_show_update("It will take a few seconds to be ready to help you ...")
-        # check stellar service
-        if not j.clients.stellar.check_stellar_service():
-            raise StopChatFlow("Payment service is currently down, try again later")
-
-        self._check_wallet(name=INIT_WALLET, asset="TFT", limit=50)
-
+        # system checks are cached and shared between chats, and run concurrently with the user wallet setup
         wallet_name = f"jukebox_{self.owner_tname}"
-        if not j.clients.stellar.find(wallet_name):
-            # check xlms
-            self._check_wallet(name="activation_wallet", asset="XLM", limit=10)
-
-        self.wallet = utils.get_or_create_user_wallet(wallet_name)
+        checks = [
+            gevent.spawn(get_stellar_service_error),
+            gevent.spawn(get_wallet_error, INIT_WALLET, "TFT", 50),
+        ]
+        wallet_thread = gevent.spawn(self._prepare_user_wallet, wallet_name)
+        gevent.joinall(checks + [wallet_thread])
+        for check in checks:
+            error = check.get()
+            if error:
+                raise StopChatFlow(error)
+        self.wallet = wallet_thread.get()
 
     @chatflow_step(title="Deployment Name")
     def get_deployment_name(self):
         self._init()
+        warm_capacity.touch(self.identity_name)
         deployment_names = []
         all_deployments = j.sals.jukebox.list_deployments(
             identity_name=self.identity_name, solution_type=self.SOLUTION_TYPE
@@ -124,14 +169,23 @@ class JukeboxDeployChatflow(MarketPlaceAppsChatflow):
                 self.QUERY["cru"], self.QUERY["hru"], self.QUERY["mru"], self.nodes_count
             )
             available_farms = list(available_farms)
-            if len(available_farms) < self.no_farms:
-                self.md_show(f"There are not enough farms to deploy {self.nodes_count} nodes.")
-            else:
+            if len(available_farms) >= self.no_farms:
                 break
+            if self.farm_selection.value != "No":
+                # no farm fits all the nodes, spread them over multiple farms
+                self.farms_split = utils.split_nodes_across_farms(
+                    self.QUERY["cru"], self.QUERY["hru"], self.QUERY["mru"], self.nodes_count
+                )
+                if self.farms_split:
+                    # the farm with most nodes is the primary farm of the deployment
+                    self.farm = next(iter(self.farms_split))
+                    return
+            self.md_show(f"There are not enough farms to deploy {self.nodes_count} nodes.")
         if self.farm_selection.value == "No":
             self.farm = self.drop_down_choice(f"Please select a farm to deploy on", available_farms, required=True)
         else:
-            self.farm = random.choice(available_farms)
+            self.farm = random.choice(health.REGISTRY.healthiest_farms(available_farms))
+        self.farms_split = {self.farm: self.nodes_count}
 
     @chatflow_step(title="New Expiration")
     def set_expiration(self):
@@ -139,30 +193,88 @@ class JukeboxDeployChatflow(MarketPlaceAppsChatflow):
             self, default=j.data.time.utcnow().timestamp + 3600 * 25
         )
 
+    def _one_hour_cloud_units(self, number_of_containers=None):
+        return utils.calculate_required_units(
+            cpu=self.QUERY["cru"],
+            memory=self.QUERY["mru"] * 1024,
+            disk_size=self.QUERY["hru"] * 1024,
+            duration_seconds=60 * 60,
+            number_of_containers=number_of_containers or self.nodes_count,
+        )
+
+    def _calculate_cost(self, duration):
+        """Get the cost of the nodes on all farms of the split for `duration` seconds, fees not included"""
+        total = 0
+        for farm_name, number_of_containers in self.farms_split.items():
+            cost_per_cont = utils.calculate_payment_from_container_resources(
+                self.QUERY["cru"],
+                self.QUERY["mru"] * 1024,
+                self.QUERY["hru"] * 1024,
+                duration=duration,
+                farm_name=farm_name,
+            )
+            total += cost_per_cont * number_of_containers
+        return total
+
+    def _start_speculative_deploy(self):
+        if not (self.SPECULATIVE_DEPLOY and j.core.config.get("JUKEBOX_SPECULATIVE_DEPLOY", False)):
+            return
+        current = getattr(self, "speculative", None)
+        if current and current.matches(self.farm, self.nodes_count) and len(self.farms_split) == 1:
+            return
+        if current:
+            # farm or nodes changed after going back
+            self.speculative = None
+            gevent.spawn(current.rollback)
+        if len(self.farms_split) > 1:
+            return
+        cloud_units = self._one_hour_cloud_units()
+        self.speculative = SpeculativeProvision(
+            self.identity_name, self.farm, self.QUERY, self.nodes_count, cu=cloud_units["cu"], su=cloud_units["su"]
+        )
+
+    def _rollback_speculative_deploy(self):
+        current = getattr(self, "speculative", None)
+        if current:
+            gevent.spawn(current.rollback)
+
+    def _claim_speculative_deploy(self):
+        current = getattr(self, "speculative", None)
+        if not current:
+            return None, None
+        self.md_show_update("Waiting for the network to be ready...")
+        return current.claim()
+
     @chatflow_step(title="Payment")
     def payment(self):
         self.currencies = ["TFT"]
+        self._start_speculative_deploy()
 
-        calculated_cost_per_cont = utils.calculate_payment_from_container_resources(
-            self.QUERY["cru"],
-            self.QUERY["mru"] * 1024,
-            self.QUERY["hru"] * 1024,
-            duration=self.expiration,
-            farm_name=self.farm,
-        )
-
+        # one transaction to extend each pool and refund its first hour to the init_wallet, and one to pay
         payment_success, _, self.payment_id = utils.show_payment(
             bot=self,
-            amount=calculated_cost_per_cont * self.nodes_count + 3 * TRANSACTION_FEES,
+            amount=self._calculate_cost(self.expiration) + (1 + 2 * len(self.farms_split)) * TRANSACTION_FEES,
             wallet_name=self.wallet.instance_name,
             expiry=5,
             description=j.data.serializers.json.dumps({"type": "jukebox", "owner": self.owner_tname}),
         )
         if not payment_success:
+            self._rollback_speculative_deploy()
             self.stop(f"Payment timedout. Please restart.")
 
+    def _validate_farm(self):
+        # farms were chosen from the capacity index, make sure the farms can still fit the nodes
+        for farm_name, number_of_containers in self.farms_split.items():
+            if not utils.validate_farm_capacity(
+                farm_name, self.QUERY["cru"], self.QUERY["hru"], self.QUERY["mru"], number_of_containers
+            ):
+                j.sals.billing.issue_refund(self.payment_id)
+                utils.invalidate_wallet_balance(self.wallet.instance_name)
+                self.stop(f"Farm {farm_name} doesn't have enough capacity anymore, please try again.")
+
     @chatflow_step(title="Deployment")
     def deploy(self):
+        self._validate_farm()
         deployment = j.sals.jukebox.new(
             solution_type=self.SOLUTION_TYPE,
             deployment_name=self.deployment_name,
@@ -179,77 +291,110 @@ class JukeboxDeployChatflow(MarketPlaceAppsChatflow):
             self.secret_env, self.identity_name
         )
         deployment.save()
+        self.prepaid_units = {}  # {pool_id: {"cu", "su"}} of the pools not created for exactly the first hour
 
-        with new_jukebox_context(deployment.instance_name):
+        with new_jukebox_context(deployment.instance_name), tracing.trace(
+            deployment.instance_name, "deploy"
+        ), ratelimit.priority(ratelimit.INTERACTIVE):
             # create pool
             self.md_show_update("Initializing the deployment...")
             init_wallet = j.clients.stellar.find(INIT_WALLET)
-            # Calculate required units from query for one hour
-            one_hour_cloud_units = utils.calculate_required_units(
-                cpu=self.QUERY["cru"],
-                memory=self.QUERY["mru"] * 1024,
-                disk_size=self.QUERY["hru"] * 1024,
-                duration_seconds=60 * 60,
-                number_of_containers=self.nodes_count,
-            )
 
-            # TODO to be done for all farms to have a list of pool_ids, the following is per one farm
             try:
-                pool_rev_id = deployment.create_capacity_pool(
-                    init_wallet, cu=one_hour_cloud_units["cu"], su=one_hour_cloud_units["su"], ipv4us=0, farm=self.farm
-                )
-
-                self.network_name = f"jukebox_{self.owner_tname}_{pool_rev_id}"
-
-                self.md_show_update("Deploying network...")
-                # Create network
-                _, self.wg_quick = deployment.deploy_network(network_name=self.network_name)
-
-                # Get possible nodes,ip_addresses then spawn deployment of container in gevent
-                self.md_show_update("Deploying containers...")
-                deployment.deploy_all_containers(
-                    number_of_deployments=self.nodes_count,
-                    network_name=self.network_name,
-                    env=self.env,
-                    metadata=self.metadata,
-                    flist=self.FLIST,
-                    entry_point=self.ENTRY_POINT,
-                    secret_env=self.secret_env,
-                )
+                if len(self.farms_split) > 1:
+                    self.md_show_update("Deploying networks on farms {}...".format(", ".join(self.farms_split)))
+                    pools_split = deployment.create_farm_pools(init_wallet, self.farms_split, duration=60 * 60)
+                    self.md_show_update("Deploying containers...")
+                    deployment.deploy_farm_batches(
+                        pools_split,
+                        env=self.env,
+                        metadata=self.metadata,
+                        flist=self.FLIST,
+                        entry_point=self.ENTRY_POINT,
+                        secret_env=self.secret_env,
+                    )
+                else:
+                    pools_split = self._deploy_on_farm(deployment, init_wallet)
                 deployment._update_state(State.DEPLOYED)
 
-                # Extend pool with the remain expiration
-                cloud_units = utils.calculate_required_units(
-                    cpu=self.QUERY["cru"],
-                    memory=self.QUERY["mru"] * 1024,
-                    disk_size=self.QUERY["hru"] * 1024,
-                    duration_seconds=self.expiration - 60 * 60,
-                    number_of_containers=self.nodes_count,
-                )
-                deployment.extend_capacity_pool(
-                    pool_id=deployment.pool_ids[0],
-                    wallet=self.wallet,
-                    cu=cloud_units["cu"],
-                    su=cloud_units["su"],
-                    ipv4us=0,
-                )
+                # Extend pools with what they miss for the full expiration, the prepaid part goes back to init_wallet
+                amount_to_refund = len(self.farms_split) * TRANSACTION_FEES
+                for pool_id, number_of_containers in pools_split.items():
+                    cloud_units = utils.calculate_required_units(
+                        cpu=self.QUERY["cru"],
+                        memory=self.QUERY["mru"] * 1024,
+                        disk_size=self.QUERY["hru"] * 1024,
+                        duration_seconds=self.expiration,
+                        number_of_containers=number_of_containers,
+                    )
+                    prepaid = self.prepaid_units.get(pool_id) or self._one_hour_cloud_units(number_of_containers)
+                    cu = max(cloud_units["cu"] - prepaid["cu"], 0)
+                    su = max(cloud_units["su"] - prepaid["su"], 0)
+                    amount_to_refund += pricing.units_price(
+                        cloud_units["cu"] - cu, cloud_units["su"] - su, deployment.get_pool_farm(pool_id)
+                    )
+                    if cu or su:
+                        deployment.extend_capacity_pool(pool_id=pool_id, wallet=self.wallet, cu=cu, su=su, ipv4us=0)
 
             except Exception as e:
                 j.logger.exception(f"Failed to deploy", exception=e)
                 j.sals.billing.issue_refund(self.payment_id)
+                utils.invalidate_wallet_balance(self.wallet.instance_name)
                 self.stop("Failed to deploy")
 
-        # take back one hour payment to the init_wallet.
-        calculated_cost_per_cont = utils.calculate_payment_from_container_resources(
-            self.QUERY["cru"],
-            self.QUERY["mru"] * 1024,
-            self.QUERY["hru"] * 1024,
-            duration=60 * 60,
-            farm_name=self.farm,
-        )
-        amount_to_refund = round(calculated_cost_per_cont * self.nodes_count + TRANSACTION_FEES, 6)
+        # take back the prepaid units used by the deployment and the pools fees to the init_wallet.
+        amount_to_refund = round(amount_to_refund, 6)
         asset = self.wallet._get_asset("TFT")
-        self.wallet.transfer(init_wallet.address, amount_to_refund, asset=f"{asset.code}:{asset.issuer}")
+        try:
+            explorer.wallet_call(
+                self.wallet, "transfer", init_wallet.address, amount_to_refund, asset=f"{asset.code}:{asset.issuer}"
+            )
+        finally:
+            utils.invalidate_wallet_balance(self.wallet.instance_name)
+            utils.invalidate_wallet_balance(init_wallet.instance_name)
+
+    def _deploy_on_farm(self, deployment, init_wallet):
+        """Deploy all the nodes on a single farm, using speculative or warm capacity when available
+
+        Returns:
+            dict: {pool_id: number of containers}
+        """
+        # Calculate required units from query for one hour
+        one_hour_cloud_units = self._one_hour_cloud_units()
+        pool_entry, planned_nodes = self._claim_speculative_deploy()
+        pool_entry = pool_entry or warm_capacity.acquire(
+            self.identity_name, self.farm, self.QUERY, cu=one_hour_cloud_units["cu"], su=one_hour_cloud_units["su"]
+        )
+        if pool_entry:
+            # use a pre-paid pool and its ready network
+            deployment._add_pool(pool_entry["pool_id"], self.farm)
+            self.prepaid_units[pool_entry["pool_id"]] = {"cu": pool_entry["cu"], "su": pool_entry["su"]}
+            self.network_name = pool_entry["network_name"]
+            self.wg_quick = pool_entry["wg_quick"]
+        else:
+            pool_rev_id = deployment.create_capacity_pool(
+                init_wallet, cu=one_hour_cloud_units["cu"], su=one_hour_cloud_units["su"], ipv4us=0, farm=self.farm,
+            )
+
+            self.network_name = f"jukebox_{self.owner_tname}_{pool_rev_id}"
+
+            self.md_show_update("Deploying network...")
+            # Create network
+            _, self.wg_quick = deployment.deploy_network(network_name=self.network_name)
+
+        # Get possible nodes,ip_addresses then spawn deployment of container in gevent
+        self.md_show_update("Deploying containers...")
+        deployment.deploy_all_containers(
+            number_of_deployments=self.nodes_count,
+            network_name=self.network_name,
+            env=self.env,
+            metadata=self.metadata,
+            flist=self.FLIST,
+            entry_point=self.ENTRY_POINT,
+            secret_env=self.secret_env,
+            planned_nodes=planned_nodes,
+        )
+        return {deployment.pool_ids[0]: self.nodes_count}
 
     @chatflow_step(title="Success", disable_previous=True, final_step=True)
     def success(self):
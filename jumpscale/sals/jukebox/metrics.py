@@ -0,0 +1,203 @@
+"""
+In-process metrics of the jukebox, rendered in the Prometheus text format.
+
+Counters, gauges and histograms are kept in memory by the threebot process that runs the services and serves the
+bottle app, and are scraped from `/jukebox/api/admins/metrics`. Gauges of values that are cheap to read but costly to
+keep up to date (queue depths, stats aggregates) are set by the endpoint right before rendering.
+
+Prometheus can't log in with 3bot connect, it authenticates with a bearer token set in the threebot config:
+
+    j.core.config.set("JUKEBOX_METRICS_TOKEN", "<random token>")
+
+    scrape_configs:
+      - job_name: jukebox
+        scheme: https
+        metrics_path: /jukebox/api/admins/metrics
+        authorization:
+          credentials: <random token>
+        static_configs:
+          - targets: ["jukebox.grid.tf"]
+
+Without a token only the package admins can read the endpoint, with their browser session.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import time
+
+from jumpscale.loader import j
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        Arguments:
+            name (str): metric name, e.g. "jukebox_service_job_seconds"
+            documentation (str): HELP line of the metric
+            labelnames (tuple): names of the labels every sample has to set
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # {label values: value}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise j.exceptions.Value(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """Yield (suffix, label values, extra labels, value) of each sample"""
+        for key, value in self._values.items():
+            yield "", key, None, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.TYPE}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def clear(self):
+        """Drop all samples, e.g. before setting the current values of a labelled gauge"""
+        self._values.clear()
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts, total = self._values.get(key) or ([0] * len(self.buckets), 0)
+        counts[bisect_left(self.buckets, value)] += 1
+        self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block, also when it raises"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self):
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", key, [("le", _format_value(bucket))], cumulative
+            yield "_sum", key, None, total
+            yield "_count", key, None, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise j.exceptions.Value(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets=buckets))
+
+
+SERVICE_JOB_SECONDS = histogram("jukebox_service_job_seconds", "Duration of background service jobs", ["service"])
+SERVICE_JOB_FAILURES = counter("jukebox_service_job_failures_total", "Failed background service jobs", ["service"])
+SERVICE_ITEMS = counter("jukebox_service_items_total", "Items processed by background service jobs", ["service"])
+REMOTE_CALLS = counter("jukebox_remote_calls_total", "Explorer and Stellar calls", ["backend", "method"])
+REMOTE_ERRORS = counter("jukebox_remote_errors_total", "Failed explorer and Stellar calls", ["backend", "method"])
+REMOTE_SECONDS = histogram("jukebox_remote_call_seconds", "Latency of explorer and Stellar calls", ["backend", "method"])
+LOCK_WAIT_SECONDS = histogram("jukebox_lock_wait_seconds", "Time waited for lock_deployment", ["function"])
+LOCK_HOLD_SECONDS = histogram("jukebox_lock_hold_seconds", "Time lock_deployment was held", ["function"])
+MAIL_QUEUE_DEPTH = gauge("jukebox_mail_queue_depth", "Emails waiting in the mail queue")
+DEPLOYMENTS = gauge("jukebox_deployments", "Deployments per state", ["state"])
+
+
+class _Job:
+    def __init__(self, service):
+        self.service = service
+
+    def processed(self, count=1):
+        SERVICE_ITEMS.inc(count, service=self.service)
+
+
+@contextmanager
+def service_job(service):
+    """Time a background service job and count its failures
+
+    Yields an object whose `processed(count)` counts the items handled by the job.
+    """
+    try:
+        with SERVICE_JOB_SECONDS.time(service=service):
+            yield _Job(service)
+    except Exception:
+        SERVICE_JOB_FAILURES.inc(service=service)
+        raise
@@ -10,6 +10,7 @@ class State(Enum):
     DELETED = "DELETED"
     ERROR = "ERROR"
     EXPIRED = "EXPIRED"
+    NOT_RESPONDING = "NOT_RESPONDING"  # node whose workload is running but whose daemon stopped answering the probes
 
 
 class BlockchainNode(Base):
@@ -19,3 +20,4 @@ class BlockchainNode(Base):
     ipv4_address = fields.IPAddress()
     ipv6_address = fields.IPAddress()
     creation_time = fields.DateTime(default=datetime.datetime.utcnow)
+    pool_id = fields.Integer()  # pool the container is reserved on, deployments may span multiple farms
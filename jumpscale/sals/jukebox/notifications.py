@@ -0,0 +1,187 @@
+"""
+Coalesced and rate limited email notifications of the jukebox users.
+
+Services queue notifications on a `Notifier` during a job and flush it at the end:
+
+- an alert is keyed by deployment and kind, with a state (e.g. the number of down nodes); it is sent again only
+  when its state changes or after REPEAT_INTERVAL, and `resolve` forgets it once the condition is over
+- the notifications of a user are coalesced into a single digest email
+- a user gets at most USER_LIMIT emails per USER_WINDOW and a flush queues at most FLUSH_LIMIT emails; the
+  notifications over the limits, one-shot events included, are kept in redis per user for up to PENDING_TTL and
+  merged into the next flush, where a newer notification of the same deployment and kind replaces them and a
+  resolved alert drops them
+
+All the reads and writes of a flush are batched, the emails are pushed to the mail queue with a single rpush.
+"""
+from collections import OrderedDict, namedtuple
+
+from jumpscale.loader import j
+
+from jumpscale.packages.admin.services.notifier import MAIL_QUEUE
+from jumpscale.sals.jukebox import metrics
+
+STATE_KEY = "jukebox:notifications"  # {instance_name:kind: last sent state}
+SENT_KEY = "jukebox:notifications:sent:{}"  # emails sent to a user in the current window
+PENDING_KEY = "jukebox:notifications:pending:{}"  # {instance_name:kind: deferred notification} of a user
+PENDING_USERS_KEY = "jukebox:notifications:pending"  # users with deferred notifications
+PENDING_TTL = 60 * 60 * 24 * 3
+REPEAT_INTERVAL = 60 * 60 * 24
+USER_LIMIT = 4
+USER_WINDOW = 60 * 60 * 24
+FLUSH_LIMIT = 500
+DEFAULT_SENDER = "support@jukebox.grid.tf"
+
+Notification = namedtuple("Notification", ["identity_name", "field", "state", "subject", "message"])
+
+NOTIFICATIONS = metrics.counter("jukebox_notifications_total", "Notifications per outcome", ["result"])
+
+
+class Notifier:
+    def __init__(self):
+        self._pending = []
+        self._resolved = set()
+
+    def notify(self, identity_name, instance_name, kind, subject, message, state=None):
+        """Queue a notification for the next flush
+
+        Args:
+            identity_name (str): identity of the user to notify
+            instance_name (str): deployment the notification is about
+            kind (str): alert kind, e.g. "nodes_down"
+            subject (str): subject when the notification is sent alone
+            message (str): body, without greeting
+            state (str): alert state, an alert already sent with the same state is not repeated before
+                REPEAT_INTERVAL; None for events that are always sent
+        """
+        field = f"{instance_name}:{kind}"
+        self._resolved.discard(field)
+        self._pending.append(Notification(identity_name, field, state, subject, message))
+
+    def resolve(self, instance_name, kind):
+        """Forget an alert whose condition is over, so it is sent right away if it happens again"""
+        self._resolved.add(f"{instance_name}:{kind}")
+
+    @staticmethod
+    def _drain(notifications, resolved):
+        """Get the deferred notifications that are still relevant followed by `notifications`
+
+        Returns:
+            tuple: (notifications, users whose deferred notifications were read)
+        """
+        users = [user.decode() if isinstance(user, bytes) else user for user in j.core.db.smembers(PENDING_USERS_KEY)]
+        if not users:
+            return notifications, users
+        pipeline = j.core.db.pipeline()
+        for identity_name in users:
+            pipeline.hgetall(PENDING_KEY.format(identity_name))
+        fresh = {notification.field for notification in notifications} | resolved
+        deferred = []
+        for items in pipeline.execute():
+            for field, data in (items or {}).items():
+                field = field.decode() if isinstance(field, bytes) else field
+                if field not in fresh:
+                    deferred.append(Notification(**j.data.serializers.json.loads(data)))
+        return deferred + notifications, users
+
+    def _due(self, notifications, now):
+        fields = [notification.field for notification in notifications if notification.state is not None]
+        last_sent = dict(zip(fields, j.core.db.hmget(STATE_KEY, fields))) if fields else {}
+        due = []
+        for notification in notifications:
+            sent = last_sent.get(notification.field)
+            if sent:
+                sent = j.data.serializers.json.loads(sent)
+                if sent["state"] == notification.state and now - sent["sent_at"] < REPEAT_INTERVAL:
+                    NOTIFICATIONS.inc(result="deduplicated")
+                    continue
+            due.append(notification)
+        return due
+
+    @staticmethod
+    def _digest(user, notifications):
+        if len(notifications) == 1:
+            subject = notifications[0].subject
+        else:
+            subject = f"Jukebox: {len(notifications)} updates about your deployments"
+        message = f"Dear {user},\n\n" + "\n\n".join(notification.message for notification in notifications)
+        return subject, message
+
+    def flush(self):
+        """Send the due notifications as one digest per user
+
+        Returns:
+            int: number of emails queued
+        """
+        now = j.data.time.utcnow().timestamp
+        notifications, self._pending = self._pending, []
+        resolved, self._resolved = self._resolved, set()
+        notifications, drained_users = self._drain(notifications, resolved)
+        per_user = OrderedDict()
+        for notification in self._due(notifications, now):
+            per_user.setdefault(notification.identity_name, []).append(notification)
+
+        identity_names = list(per_user)
+        sent_keys = [SENT_KEY.format(identity_name) for identity_name in identity_names]
+        sent_counts = j.core.db.mget(sent_keys) if sent_keys else []
+        sender = (j.core.config.get("EMAIL_SERVER_CONFIG") or {}).get("sender", DEFAULT_SENDER)
+        mails = []
+        sent_states = {}
+        sent_users = []
+        deferred = {}  # {identity_name: [Notification]}
+        for identity_name, sent_count in zip(identity_names, sent_counts):
+            user_notifications = per_user[identity_name]
+            if int(sent_count or 0) >= USER_LIMIT or len(mails) >= FLUSH_LIMIT:
+                deferred[identity_name] = user_notifications
+                NOTIFICATIONS.inc(len(user_notifications), result="deferred")
+                continue
+            identity = j.core.identity.find(identity_name)
+            if not identity:
+                j.logger.warning(f"Can't notify {identity_name}, identity not found")
+                NOTIFICATIONS.inc(len(user_notifications), result="dropped")
+                continue
+            user = j.data.text.removeprefix(identity_name, "jukebox_")
+            subject, message = self._digest(user, user_notifications)
+            mail_info = {
+                "recipients_emails": [identity.email.replace("_jukebox@", "@")],
+                "sender": sender,
+                "subject": subject,
+                "message": message,
+            }
+            mails.append(j.data.serializers.json.dumps(mail_info))
+            sent_users.append(identity_name)
+            for notification in user_notifications:
+                if notification.state is not None:
+                    sent_states[notification.field] = j.data.serializers.json.dumps(
+                        {"state": notification.state, "sent_at": now}
+                    )
+            NOTIFICATIONS.inc(len(user_notifications), result="sent")
+
+        pipeline = j.core.db.pipeline()
+        if mails:
+            pipeline.rpush(MAIL_QUEUE, *mails)
+        if sent_states:
+            pipeline.hset(STATE_KEY, mapping=sent_states)
+        resolved -= set(sent_states)
+        if resolved:
+            pipeline.hdel(STATE_KEY, *resolved)
+        for identity_name in sent_users:
+            key = SENT_KEY.format(identity_name)
+            pipeline.set(key, 0, ex=USER_WINDOW, nx=True)  # the window starts with the first email
+            pipeline.incr(key)
+        for identity_name in set(drained_users) | set(deferred):
+            pipeline.delete(PENDING_KEY.format(identity_name))
+        for identity_name, user_notifications in deferred.items():
+            key = PENDING_KEY.format(identity_name)
+            mapping = {
+                notification.field: j.data.serializers.json.dumps(notification._asdict())
+                for notification in user_notifications
+            }
+            pipeline.hset(key, mapping=mapping)
+            pipeline.expire(key, PENDING_TTL)
+            pipeline.sadd(PENDING_USERS_KEY, identity_name)
+        done_users = set(drained_users) - set(deferred)
+        if done_users:
+            pipeline.srem(PENDING_USERS_KEY, *done_users)
+        pipeline.execute()
+        j.logger.info(f"Queued {len(mails)} notification emails for {len(notifications)} notifications")
+        return len(mails)
@@ -0,0 +1,119 @@
+"""
+Shared confirmation of capacity pool payments.
+
+Every pool creation and extension used to poll the explorer once a second until its payment was released.
+All pending reservations are now watched by one loop: each reservation is checked right away (the Stellar
+transaction has landed when `payout_farmers` returns), then with an exponential backoff with jitter, and the
+waiting greenlets are notified through events.
+"""
+import random
+
+import gevent
+from gevent.event import AsyncResult, Event
+from gevent.pool import Pool
+from jumpscale.loader import j
+
+from jumpscale.sals.jukebox import explorer, ratelimit
+
+MIN_INTERVAL = 1
+MAX_INTERVAL = 15
+BACKOFF_FACTOR = 1.5
+JITTER = 0.2  # intervals are randomized by +/- 20% so reservations created together don't poll together
+CONCURRENCY = 10  # payment infos fetched at the same time, the explorer has no bulk endpoint
+
+
+class PendingPayment:
+    def __init__(self, reservation_id, zos):
+        self.reservation_id = reservation_id
+        self.zos = zos
+        self.result = AsyncResult()
+        self.interval = MIN_INTERVAL
+        self.next_check = 0  # check as soon as possible
+
+    def backoff(self, now):
+        self.next_check = now + self.interval * random.uniform(1 - JITTER, 1 + JITTER)
+        self.interval = min(self.interval * BACKOFF_FACTOR, MAX_INTERVAL)
+
+
+class PaymentWatcher:
+    def __init__(self, concurrency=CONCURRENCY):
+        self.concurrency = concurrency
+        self._pending = {}  # {reservation_id: PendingPayment}
+        self._wakeup = Event()
+        self._loop = None
+
+    def _is_paid(self, payment):
+        try:
+            payment_info = payment.zos.pools.get_payment_info(payment.reservation_id)
+        except Exception as e:
+            j.logger.warning(f"Failed to get payment info of reservation {payment.reservation_id}: {e}")
+            return False
+        return payment_info.paid and payment_info.released
+
+    def _check(self, payment):
+        return payment, self._is_paid(payment)
+
+    def _run(self):
+        pool = Pool(self.concurrency)
+        # payments are awaited by deploys and extensions alike, the loop must not take the priority of its starter
+        try:
+            with ratelimit.priority(ratelimit.USER):
+                while self._pending:
+                    now = j.data.time.now().timestamp
+                    due = [payment for payment in self._pending.values() if payment.next_check <= now]
+                    for payment, paid in pool.imap_unordered(self._check, due):
+                        if paid:
+                            self._pending.pop(payment.reservation_id, None)
+                            payment.result.set(True)
+                        else:
+                            payment.backoff(j.data.time.now().timestamp)
+                    if not self._pending:
+                        break
+                    next_check = min(payment.next_check for payment in self._pending.values())
+                    self._wakeup.clear()
+                    self._wakeup.wait(timeout=max(next_check - j.data.time.now().timestamp, 0))
+        finally:
+            self._loop = None
+
+    def notify(self, reservation_id):
+        """Check a pending reservation on the next loop iteration, e.g. when its payment is known to have landed"""
+        payment = self._pending.get(reservation_id)
+        if payment:
+            payment.next_check = 0
+            payment.interval = MIN_INTERVAL
+            self._wakeup.set()
+
+    def wait(self, reservation_id, timeout=5 * 60, zos=None):
+        """Wait for the payment of a pool reservation to be released
+
+        Args:
+            reservation_id (int): pool reservation id
+            timeout (int): seconds to wait
+            zos: zos sal to query the explorer with, defaults to the system one
+
+        Returns:
+            bool: True if the payment is released before the timeout
+        """
+        payment = self._pending.get(reservation_id)
+        if not payment:
+            payment = PendingPayment(reservation_id, zos or explorer.get_zos())
+            self._pending[reservation_id] = payment
+        self.notify(reservation_id)
+        if not self._loop:
+            self._loop = gevent.spawn(self._run)
+        try:
+            return payment.result.get(timeout=timeout)
+        except gevent.Timeout:
+            if not payment.result.ready():
+                self._pending.pop(reservation_id, None)
+            return False
+
+    def pending_count(self):
+        return len(self._pending)
+
+
+WATCHER = PaymentWatcher()
+
+
+def wait_pool_payment(reservation_id, timeout=5 * 60, zos=None):
+    return WATCHER.wait(reservation_id, timeout=timeout, zos=zos)
@@ -0,0 +1,135 @@
+"""
+Pricing engine for jukebox deployments.
+
+Deployments only use a handful of resource profiles (the `QUERY` of each chatflow), so the cloud units of a
+profile are computed once, farm ids are resolved once per farm name and quotes are cached for a short time.
+`price_batch` prices many deployments at once with one explorer lookup per distinct farm, and farm prices
+are cached for a while since they rarely change.
+"""
+from functools import lru_cache
+
+from jumpscale.clients.explorer.models import Container, DiskType
+from jumpscale.loader import j
+
+from jumpscale.sals.jukebox import explorer
+from jumpscale.sals.jukebox.cache import TTLCache
+
+QUOTE_CACHE_TTL = 10 * 60
+FARM_CACHE_TTL = 60 * 60 * 24
+FARM_PRICES_CACHE_TTL = 15 * 60
+MONTH = 60 * 60 * 24 * 30
+
+_farm_ids = TTLCache(ttl=FARM_CACHE_TTL, maxsize=1024)  # {farm_name: farm_id}
+_farm_prices = TTLCache(ttl=FARM_PRICES_CACHE_TTL, maxsize=1024)  # {farm_id: custom cloud units prices}
+_quotes = TTLCache(ttl=QUOTE_CACHE_TTL, maxsize=4096)
+
+
+def _container(cpu, memory, disk_size, disk_type=DiskType.HDD):
+    container = Container()
+    container.capacity.cpu = cpu
+    container.capacity.memory = memory
+    container.capacity.disk_size = disk_size
+    container.capacity.disk_type = disk_type
+    return container
+
+
+@lru_cache(maxsize=256)
+def unit_costs(cpu, memory, disk_size, disk_type=DiskType.HDD):
+    """Get the cloud units consumed by one container of this profile per second
+
+    Args:
+        cpu (int): number of cpus
+        memory (int): memory in MB
+        disk_size (int): disk size in MB
+        disk_type (DiskType): disk type
+
+    Returns:
+        tuple: (cu, su)
+    """
+    cloud_units = _container(cpu, memory, disk_size, disk_type).resource_units().cloud_units()
+    return cloud_units.cu, cloud_units.su
+
+
+def required_units(cpu, memory, disk_size, duration_seconds, number_of_containers=1):
+    cu, su = unit_costs(cpu, memory, disk_size)
+    return {
+        "cu": cu * number_of_containers * duration_seconds,
+        "su": su * number_of_containers * duration_seconds,
+        "ipv4u": 0,
+    }
+
+
+def get_farm_id(farm_name):
+    return _farm_ids.get_or_set(farm_name, lambda: explorer.get_zos()._explorer.farms.get(farm_name=farm_name).id)
+
+
+def container_cost(cpu, memory, disk_size, duration, farm_id=None, farm_name="freefarm", disk_type=DiskType.HDD):
+    """Get the cost of one container of this profile for `duration` seconds on a farm, cached for QUOTE_CACHE_TTL"""
+    if farm_name and not farm_id:
+        farm_id = get_farm_id(farm_name)
+
+    def calculate():
+        container = _container(cpu, memory, disk_size, disk_type)
+        return j.tools.zos.consumption.cost(container, duration=duration, farm_id=farm_id)
+
+    return _quotes.get_or_set((cpu, memory, disk_size, disk_type, duration, farm_id), calculate)
+
+
+def get_farm_prices(farm_id, zos=None):
+    """Get the cloud units prices of a farm for this threebot, cached for FARM_PRICES_CACHE_TTL
+
+    Concurrent requests for the same farm share a single explorer call.
+    """
+
+    def fetch():
+        explorer_client = (zos or explorer.get_zos())._explorer
+        return explorer_client.farms.get_deal_for_threebot(farm_id, j.core.identity.me.tid)["custom_cloudunits_price"]
+
+    return _farm_prices.get_or_set(farm_id, fetch)
+
+
+def invalidate_farm_prices(farm_id=None):
+    if farm_id is None:
+        _farm_prices.clear()
+    else:
+        _farm_prices.invalidate(farm_id)
+
+
+def units_price(cu, su, farm_name, ipv4u=0, zos=None):
+    """Get the price of cloud units on a farm, transaction fees not included"""
+    zos = zos or explorer.get_zos()
+    farm_prices = get_farm_prices(get_farm_id(farm_name), zos=zos)
+    return zos._explorer.prices.calculate(cus=cu, sus=su, ipv4us=ipv4u, farm_prices=farm_prices)
+
+
+def price_batch(items, zos=None):
+    """Price many (profile, count, duration, farm_name) tuples at once
+
+    Farms are resolved and their prices fetched once per distinct farm, and identical items are only priced once.
+
+    Args:
+        items (list): tuples of ((cpu, memory, disk_size), number_of_containers, duration_seconds, farm_name)
+        zos: zos sal to use for explorer calls, defaults to the system one
+
+    Returns:
+        list: price of each item (transaction fees not included), in the same order
+    """
+    zos = zos or explorer.get_zos()
+    prices = {}
+    for item in items:
+        if item in prices:
+            continue
+        profile, count, duration, farm_name = item
+        cloud_units = required_units(*profile, duration_seconds=duration, number_of_containers=count)
+        prices[item] = units_price(cloud_units["cu"], cloud_units["su"], farm_name, cloud_units["ipv4u"], zos=zos)
+    return [prices[item] for item in items]
+
+
+def extension_items(deployment, duration=MONTH):
+    """Build price_batch items for extending each pool of a deployment by `duration` seconds"""
+    profile = (deployment.cpu, deployment.memory, deployment.disk_size)
+    return [
+        (profile, number_of_containers, duration, deployment.get_pool_farm(pool_id))
+        for pool_id, number_of_containers in deployment.get_nodes_per_pool().items()
+        if number_of_containers
+    ]
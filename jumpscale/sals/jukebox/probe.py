@@ -0,0 +1,251 @@
+"""
+Direct liveness probing of the deployed blockchain nodes.
+
+The explorer only knows if a container workload is running, not if the daemon inside it is still serving. A probe
+connects to the public addresses of the container on the port of its solution type, nodes with only an address of
+their private network are not probed:
+
+- tcp: the TCP handshake has to complete
+- http: the daemon has to answer an HTTP request with any status line, an unauthenticated JSON-RPC call answered
+  with 401 proves the RPC server is up without needing the user credentials
+
+Probes run on gevent sockets, `concurrency` at a time with a deadline per target, so thousands of nodes are checked
+in a few timeouts. A node becomes a suspect after DOWN_THRESHOLD failed rounds in a row: it is marked as errored if
+the explorer reports its workload as not running, otherwise as NOT_RESPONDING until it answers again, and self healing
+replaces a limited number of those per run. Failures that look like a problem of the prober network or of a whole group
+are not counted: a round where most probes fail is not applied, and neither are the failures of a deployment or a farm
+where most probes of the round failed.
+"""
+from collections import namedtuple
+import ipaddress
+import time
+
+import gevent
+from gevent import socket
+from gevent.pool import Pool
+from jumpscale.loader import j
+
+from jumpscale.sals.jukebox import metrics
+from jumpscale.sals.jukebox.models import State
+
+TCP = "tcp"
+HTTP = "http"
+# {solution_type: (kind, port)}, solution types without a reachable daemon port (presearch) are not probed
+DEFAULT_PROBES = {
+    "dash": (HTTP, 9998),
+    "digibyte": (HTTP, 14022),
+    "casperlabs": (HTTP, 7777),
+    "ubuntu": (TCP, 22),
+}
+DEFAULT_TIMEOUT = 5
+DEFAULT_CONCURRENCY = 1000
+DOWN_THRESHOLD = 3  # failed rounds in a row before a node is taken as down
+PROBED_STATES = [State.DEPLOYED, State.NOT_RESPONDING]
+GRACE_PERIOD = 30 * 60  # seconds after creation during which a node is not probed, its daemon may still be starting
+MAX_FAILURE_RATIO = 0.5  # more failures than that in a round means the prober can't reach the grid
+MIN_ROUND_SIZE = 10  # rounds smaller than that are always applied
+MIN_GROUP_SIZE = 2  # deployments and farms with fewer probes than that are not checked as a group
+HTTP_BODY = b'{"jsonrpc":"1.0","id":"probe","method":"getblockcount","params":[]}'
+HTTP_REQUEST = b"POST / HTTP/1.0\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(HTTP_BODY)
+
+ProbeTarget = namedtuple("ProbeTarget", ["key", "addresses", "port", "kind", "farm"], defaults=(None,))
+ProbeResult = namedtuple("ProbeResult", ["key", "alive", "address", "latency", "error"])
+
+PROBES = metrics.counter("jukebox_probes_total", "Liveness probes of deployed nodes", ["result"])
+PROBE_SECONDS = metrics.histogram(
+    "jukebox_probe_seconds", "Latency of successful liveness probes", buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+)
+
+
+def get_probes():
+    """Get the probe of each solution type, DEFAULT_PROBES updated by the JUKEBOX_PROBES config
+
+    e.g. `{"dash": ["tcp", 9999]}` probes the dash p2p port instead of its RPC port.
+    """
+    probes = dict(DEFAULT_PROBES)
+    for solution_type, probe_config in (j.core.config.get("JUKEBOX_PROBES", {}) or {}).items():
+        probes[solution_type] = tuple(probe_config) if probe_config else None
+    return {solution_type: probe_config for solution_type, probe_config in probes.items() if probe_config}
+
+
+def _connect(address, port, kind):
+    family = socket.AF_INET6 if ":" in address else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.connect((address, port))
+        if kind == HTTP:
+            sock.sendall(HTTP_REQUEST + HTTP_BODY)
+            if not sock.recv(16).startswith(b"HTTP/"):
+                raise ConnectionError("Not an HTTP response")
+    finally:
+        sock.close()
+
+
+def probe(target, timeout=DEFAULT_TIMEOUT):
+    """Probe the addresses of `target` in order until one answers, within `timeout` seconds in total
+
+    Returns:
+        ProbeResult: `alive` with the address that answered and its latency, or the error of the last address
+    """
+    deadline = time.monotonic() + timeout
+    error = "no address"
+    for index, address in enumerate(target.addresses):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            error = "timeout"
+            break
+        start = time.monotonic()
+        try:
+            # share the time left between the remaining addresses, a blackholed ipv6 must not starve ipv4
+            with gevent.Timeout(remaining / (len(target.addresses) - index)):
+                _connect(address, target.port, target.kind)
+        except gevent.Timeout:
+            error = "timeout"
+        except OSError as e:
+            error = f"{type(e).__name__}: {e}"[:200]
+        else:
+            return ProbeResult(target.key, True, address, time.monotonic() - start, None)
+    return ProbeResult(target.key, False, None, None, error)
+
+
+class ProbeEngine:
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT):
+        """
+        Arguments:
+            concurrency (int): max probes in flight, bounded by the open files limit of the process
+            timeout (float): deadline of each target in seconds
+        """
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    def run(self, targets):
+        """Probe all targets concurrently
+
+        Returns:
+            dict: {target key: ProbeResult}
+        """
+        results = {}
+        pool = Pool(self.concurrency)
+        for result in pool.imap_unordered(lambda target: probe(target, self.timeout), targets):
+            results[result.key] = result
+            PROBES.inc(result="alive" if result.alive else "dead")
+            if result.alive:
+                PROBE_SECONDS.observe(result.latency)
+        return results
+
+
+def summarize(results):
+    """Aggregate the results of a round: counts, failure ratio, latency percentiles and errors"""
+    latencies = sorted(result.latency for result in results.values() if result.alive)
+    errors = {}
+    for result in results.values():
+        if not result.alive:
+            kind = result.error.split(":", 1)[0]
+            errors[kind] = errors.get(kind, 0) + 1
+
+    def percentile(rank):
+        return round(latencies[min(int(len(latencies) * rank), len(latencies) - 1)], 3) if latencies else None
+
+    return {
+        "probed": len(results),
+        "alive": len(latencies),
+        "dead": len(results) - len(latencies),
+        "failure_ratio": round(1 - len(latencies) / len(results), 3) if results else 0,
+        "p50": percentile(0.5),
+        "p99": percentile(0.99),
+        "errors": errors,
+    }
+
+
+def is_public(address):
+    """Check if an address can be reached from outside, the ipv4 of a container is usually on its private network"""
+    return bool(address) and ipaddress.ip_address(str(address)).is_global
+
+
+def node_target(deployment, node, probes, address_filter=is_public):
+    """Get the probe target of a deployed node, None if it can't be probed yet
+
+    Args:
+        address_filter (callable): takes an address of the node and tells if the prober can reach it
+    """
+    probe_config = probes.get(deployment.solution_type)
+    if not probe_config or node.state not in PROBED_STATES:
+        return None
+    if node.creation_time and node.creation_time.timestamp() > j.data.time.utcnow().timestamp - GRACE_PERIOD:
+        return None
+    addresses = [
+        str(address) for address in (node.ipv6_address, node.ipv4_address) if address and address_filter(address)
+    ]
+    if not addresses:
+        return None
+    kind, port = probe_config
+    farm_name = deployment.get_pool_farm(node.pool_id)
+    return ProbeTarget((deployment.instance_name, node.wid), addresses, port, kind, farm_name)
+
+
+class LivenessTracker:
+    def __init__(self, down_threshold=DOWN_THRESHOLD):
+        """Count the failed rounds in a row of each node to decide which ones are suspects"""
+        self.down_threshold = down_threshold
+        self._failures = {}  # {(instance_name, wid): failed rounds in a row}
+        self.last_summary = None
+
+    @staticmethod
+    def _held(results, farms):
+        """Get the deployments and farms where most probes failed, their failures may not be the nodes fault"""
+        groups = {}
+        for key, result in results.items():
+            instance_name, _ = key
+            for group in (("deployments", instance_name), ("farms", farms.get(key))):
+                if group[1] is not None:
+                    groups.setdefault(group, []).append(result.alive)
+        held = {"deployments": [], "farms": []}
+        for (kind, name), alive in groups.items():
+            if len(alive) >= MIN_GROUP_SIZE and alive.count(False) / len(alive) > MAX_FAILURE_RATIO:
+                held[kind].append(name)
+        return held
+
+    def update(self, results, farms=None):
+        """Apply the results of a round
+
+        Args:
+            results (dict): {(instance_name, wid): ProbeResult}
+            farms (dict): {(instance_name, wid): farm name} of the probed nodes
+
+        Returns:
+            dict: {instance_name: [wid]} of the suspects, the nodes that failed DOWN_THRESHOLD rounds in a row or
+                more, empty if the round was not applied
+        """
+        farms = farms or {}
+        self.last_summary = summarize(results)
+        if len(results) >= MIN_ROUND_SIZE and self.last_summary["failure_ratio"] > MAX_FAILURE_RATIO:
+            j.logger.warning(f"Liveness round not applied, {self.last_summary['dead']} of {len(results)} probes failed")
+            self.last_summary["applied"] = False
+            return {}
+        self.last_summary["applied"] = True
+        held = self.last_summary["held"] = self._held(results, farms)
+        if held["deployments"] or held["farms"]:
+            j.logger.warning(f"Liveness failures not counted for most nodes failing in {held}")
+        held_deployments, held_farms = set(held["deployments"]), set(held["farms"])
+
+        suspects = {}
+        for key, result in results.items():
+            if result.alive:
+                self._failures.pop(key, None)
+                continue
+            instance_name, wid = key
+            if instance_name in held_deployments or farms.get(key) in held_farms:
+                continue  # keep its count as is until the group answers again
+            self._failures[key] = self._failures.get(key, 0) + 1
+            if self._failures[key] >= self.down_threshold:
+                suspects.setdefault(instance_name, []).append(wid)
+        for key in set(self._failures) - set(results):
+            self._failures.pop(key)  # node not probed anymore (deleted, redeployed or in error)
+        self.last_summary["suspects"] = sum(len(wids) for wids in suspects.values())
+        return suspects
+
+    def failures(self, instance_name, wid):
+        return self._failures.get((instance_name, wid), 0)
+
+
+TRACKER = LivenessTracker()
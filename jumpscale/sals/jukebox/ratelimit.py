@@ -0,0 +1,207 @@
+"""
+Shared admission control of the explorer traffic.
+
+Every HTTP request the jukebox sends to the explorer goes through one limiter, installed as the transport adapter
+of the explorer client session (see `limit_session`). Composite helpers such as `deployer.deploy_network` send many
+requests, each one is admitted and timed on its own, so the window adapts to the explorer response times and not to
+the duration of the helpers:
+
+- a token bucket caps the request rate at `rate` per second with bursts of `burst` requests
+- an AIMD window caps the requests in flight: it grows by one request per window of successful requests and is cut
+  by DECREASE_FACTOR, at most once per TARGET_LATENCY, when a request is slower than TARGET_LATENCY, is answered
+  with a throttling status or fails with a connection error
+- waiting calls are admitted by priority class, then in arrival order: interactive deploys first, then the user
+  API, then the background services
+
+The priority of a call is bound on the greenlet with `priority(...)` and inherited by the greenlets it spawns;
+calls without one are background calls.
+"""
+from contextlib import contextmanager
+import heapq
+import itertools
+import time
+
+from gevent.event import Event
+from gevent.timeout import Timeout
+from jumpscale.loader import j
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestsConnectionError
+
+from jumpscale.sals.jukebox import context, metrics
+
+INTERACTIVE = 0
+USER = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", USER: "user", BACKGROUND: "background"}
+
+DEFAULT_CONFIG = {"rate": 20, "burst": 40, "min_concurrency": 2, "max_concurrency": 50, "initial_concurrency": 10}
+TARGET_LATENCY = 2  # seconds, slower calls are taken as a sign of an overloaded explorer
+DECREASE_FACTOR = 0.7
+CONGESTION_STATUSES = {429, 502, 503, 504}
+
+_PRIORITY_ATTRIBUTE = "_jukebox_priority"
+
+QUEUE_SECONDS = metrics.histogram(
+    "jukebox_explorer_queue_seconds", "Time explorer calls waited for admission", ["priority"]
+)
+CONCURRENCY_LIMIT = metrics.gauge("jukebox_explorer_concurrency_limit", "Explorer calls allowed in flight")
+IN_FLIGHT = metrics.gauge("jukebox_explorer_in_flight", "Explorer calls in flight")
+
+
+def is_congestion(exception):
+    """Check if an explorer call failure means the explorer is overloaded rather than the request being wrong"""
+    response = getattr(exception, "response", None)
+    if getattr(response, "status_code", None) in CONGESTION_STATUSES:
+        return True
+    if isinstance(exception, (Timeout, TimeoutError, ConnectionError, RequestsConnectionError)):
+        return True
+    return "Timeout" in type(exception).__name__
+
+
+@contextmanager
+def priority(priority_class):
+    """Run the block and the greenlets it spawns with `priority_class` (INTERACTIVE, USER or BACKGROUND)"""
+    with context.bind(_PRIORITY_ATTRIBUTE, priority_class):
+        yield
+
+
+def current_priority():
+    return context.get(_PRIORITY_ATTRIBUTE, BACKGROUND)
+
+
+class _Waiter:
+    __slots__ = ("priority", "sequence", "event")
+
+    def __init__(self, priority_class, sequence):
+        self.priority = priority_class
+        self.sequence = sequence
+        self.event = Event()
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class ExplorerLimiter:
+    def __init__(self, rate=20, burst=40, min_concurrency=2, max_concurrency=50, initial_concurrency=10):
+        """Token bucket and AIMD concurrency window with priority admission
+
+        Arguments:
+            rate (float): requests per second
+            burst (int): requests that can be sent at once after an idle period
+            min_concurrency (int): lower bound of the concurrency window
+            max_concurrency (int): upper bound of the concurrency window
+            initial_concurrency (int): starting concurrency window
+        """
+        self.rate = rate
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(initial_concurrency)
+        self.in_flight = 0
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._decreased_at = 0
+        self._waiters = []  # heap of _Waiter
+        self._sequence = itertools.count()
+        CONCURRENCY_LIMIT.set(int(self.concurrency))
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _wake_head(self):
+        if self._waiters:
+            self._waiters[0].event.set()
+
+    def _remove(self, waiter):
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+            heapq.heapify(self._waiters)
+        self._wake_head()
+
+    def acquire(self, priority_class=BACKGROUND):
+        """Wait until a call of `priority_class` is admitted, to be followed by `release`"""
+        waiter = _Waiter(priority_class, next(self._sequence))
+        heapq.heappush(self._waiters, waiter)
+        start = time.monotonic()
+        try:
+            while True:
+                timeout = None  # wait to become the head, or for a call in flight to finish
+                if self._waiters[0] is waiter and self.in_flight < int(self.concurrency):
+                    self._refill()
+                    if self._tokens >= 1:
+                        heapq.heappop(self._waiters)
+                        self._tokens -= 1
+                        self.in_flight += 1
+                        IN_FLIGHT.set(self.in_flight)
+                        self._wake_head()
+                        break
+                    timeout = (1 - self._tokens) / self.rate
+                waiter.event.clear()
+                waiter.event.wait(timeout)
+        except BaseException:
+            self._remove(waiter)
+            raise
+        QUEUE_SECONDS.observe(time.monotonic() - start, priority=PRIORITY_NAMES.get(priority_class, priority_class))
+
+    def release(self, latency, congested=False):
+        """Release a call admitted by `acquire`, adapting the concurrency window to how it went
+
+        Args:
+            latency (float): duration of the call in seconds
+            congested (bool): the call failed because the explorer is overloaded
+        """
+        self.in_flight -= 1
+        IN_FLIGHT.set(self.in_flight)
+        now = time.monotonic()
+        if congested or latency > TARGET_LATENCY:
+            # one decrease per congestion episode, not one per call that was already in flight during it
+            if now - self._decreased_at > TARGET_LATENCY:
+                self.concurrency = max(self.min_concurrency, self.concurrency * DECREASE_FACTOR)
+                self._decreased_at = now
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+        CONCURRENCY_LIMIT.set(int(self.concurrency))
+        self._wake_head()
+
+
+_limiter = None
+
+
+def get_limiter():
+    """Get the process wide explorer limiter, configured by JUKEBOX_EXPLORER_LIMITS"""
+    global _limiter
+    if _limiter is None:
+        config = dict(DEFAULT_CONFIG)
+        config.update(j.core.config.get("JUKEBOX_EXPLORER_LIMITS", {}) or {})
+        _limiter = ExplorerLimiter(**config)
+    return _limiter
+
+
+class LimitedAdapter(HTTPAdapter):
+    """Transport adapter admitting every request through the explorer limiter"""
+
+    def send(self, request, **kwargs):
+        limiter = get_limiter()
+        limiter.acquire(current_priority())
+        start = time.monotonic()
+        congested = False
+        try:
+            response = super().send(request, **kwargs)
+            congested = response.status_code in CONGESTION_STATUSES
+            return response
+        except Exception as e:
+            congested = is_congestion(e)
+            raise
+        finally:
+            limiter.release(time.monotonic() - start, congested)
+
+
+def limit_session(session):
+    """Route the requests of an explorer client session through the limiter, once per session"""
+    if isinstance(session.get_adapter("https://"), LimitedAdapter):
+        return
+    adapter = LimitedAdapter()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
@@ -0,0 +1,83 @@
+"""
+Speculative provisioning for the deploy chatflow.
+
+Once the farm and expiration are known, the pool, its network and the nodes placement are prepared in the
+background while the user is paying. The deploy step claims them; if the payment fails or the chat is abandoned
+(nothing claimed in `claim_timeout`) they are rolled back.
+"""
+import gevent
+from jumpscale.loader import j
+from jumpscale.sals.vdc.scheduler import Scheduler
+
+from jumpscale.sals.jukebox import health, warm_capacity
+
+CLAIM_TIMEOUT = 15 * 60
+
+
+def plan_nodes(farm_name, cru, mru, hru, number_of_nodes):
+    """Pick the nodes of a farm to deploy on, mru and hru in GB"""
+    scheduler = Scheduler(farm_name=farm_name)
+    scheduler.exclude_nodes(*health.REGISTRY.excluded_nodes())
+    return [next(scheduler.nodes_by_capacity(cru=cru, hru=hru, mru=mru)) for _ in range(number_of_nodes)]
+
+
+class SpeculativeProvision:
+    def __init__(self, identity_name, farm_name, query, number_of_nodes, cu, su, claim_timeout=CLAIM_TIMEOUT):
+        """Start provisioning a pool with a network and planning the nodes in the background
+
+        Arguments:
+            identity_name (str): identity that will own the pool
+            farm_name (str): farm to deploy on
+            query (dict): {"cru", "mru", "hru"} of one node, mru and hru in GB
+            number_of_nodes (int): number of nodes to plan
+            cu (float), su (float): units of the pool
+            claim_timeout (int): seconds after which an unclaimed provision is rolled back
+        """
+        self.identity_name = identity_name
+        self.farm_name = farm_name
+        self.number_of_nodes = number_of_nodes
+        self.claimed = False
+        self.rolled_back = False
+        self._pool_thread = gevent.spawn(
+            warm_capacity.provision, identity_name, farm_name, cu=cu, su=su, flavor=warm_capacity.flavor_of(query)
+        )
+        self._plan_thread = gevent.spawn(
+            plan_nodes, farm_name, query["cru"], query["mru"], query["hru"], number_of_nodes
+        )
+        self._watchdog = gevent.spawn_later(claim_timeout, self.rollback)
+
+    def matches(self, farm_name, number_of_nodes):
+        return not self.rolled_back and self.farm_name == farm_name and self.number_of_nodes == number_of_nodes
+
+    @staticmethod
+    def _result(thread, name):
+        try:
+            return thread.get()
+        except Exception as e:
+            j.logger.exception(f"Speculative {name} failed", exception=e)
+            return None
+
+    def claim(self):
+        """Wait for the provisioning to finish and take its results
+
+        Returns:
+            tuple: (pool entry as returned by warm_capacity.provision or None, list of planned nodes or None)
+        """
+        if self.rolled_back:
+            return None, None
+        self.claimed = True
+        self._watchdog.kill()
+        return self._result(self._pool_thread, "pool provisioning"), self._result(self._plan_thread, "placement")
+
+    def rollback(self):
+        """Release the provisioned pool and network, waiting for them to be ready first"""
+        if self.claimed or self.rolled_back:
+            return
+        self.rolled_back = True
+        if gevent.getcurrent() is not self._watchdog:
+            self._watchdog.kill(block=False)
+        self._plan_thread.kill(block=False)
+        entry = self._result(self._pool_thread, "pool provisioning")
+        if entry:
+            j.logger.info(f"Rolling back speculative pool {entry['pool_id']} of {self.identity_name}")
+            warm_capacity.release(entry)
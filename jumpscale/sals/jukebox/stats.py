@@ -0,0 +1,150 @@
+"""
+Fleet-wide aggregates maintained incrementally on deployment save/delete.
+
+Every saved deployment stores its contribution to the counters, so the next save only applies the
+difference and reading the aggregates never has to load the deployments.
+"""
+from collections import defaultdict
+
+from gevent.lock import BoundedSemaphore
+from jumpscale.loader import j
+
+from jumpscale.sals.jukebox import utils
+from jumpscale.sals.jukebox.models import State
+
+STATS_KEY = "jukebox:stats"
+CONTRIBUTIONS_KEY = "jukebox:stats:contributions"
+EXPIRATIONS_KEY = "jukebox:stats:expirations"
+ACTIVE_STATES = [State.DEPLOYING, State.DEPLOYED, State.ERROR, State.NOT_RESPONDING]
+
+_lock = BoundedSemaphore(1)
+
+
+def _contribution(deployment):
+    counters = defaultdict(float)
+    deployment_state = deployment.state.value if deployment.state else "UNKNOWN"
+    counters[f"deployments:solution_type:{deployment.solution_type}"] += 1
+    counters[f"deployments:state:{deployment_state}"] += 1
+
+    active_nodes = 0
+    farms = set()
+    for node in deployment.nodes:
+        node_state = node.state.value if node.state else "UNKNOWN"
+        counters[f"nodes:state:{node_state}"] += 1
+        if node.state == State.DELETED:
+            continue
+        farm_name = deployment.get_pool_farm(node.pool_id)
+        farms.add(farm_name)
+        counters[f"nodes:solution_type:{deployment.solution_type}"] += 1
+        counters[f"nodes:farm:{farm_name}"] += 1
+        if node.state in ACTIVE_STATES:
+            active_nodes += 1
+    # a deployment split across farms counts once in each of them
+    for farm_name in farms or [deployment.farm_name]:
+        counters[f"deployments:farm:{farm_name}"] += 1
+
+    if active_nodes and deployment.state in ACTIVE_STATES and deployment.cpu:
+        cloud_units = utils.calculate_required_units(
+            cpu=deployment.cpu,
+            memory=deployment.memory,
+            disk_size=deployment.disk_size,
+            duration_seconds=1,
+            number_of_containers=active_nodes,
+        )
+        counters["cu"] += cloud_units["cu"]
+        counters["su"] += cloud_units["su"]
+    return dict(counters)
+
+
+def _apply(instance_name, new_contribution, expiration=None):
+    db = j.core.db
+    with _lock:
+        old_contribution = db.hget(CONTRIBUTIONS_KEY, instance_name)
+        old_contribution = j.data.serializers.json.loads(old_contribution) if old_contribution else {}
+
+        pipeline = db.pipeline()
+        for key in set(old_contribution) | set(new_contribution):
+            diff = new_contribution.get(key, 0) - old_contribution.get(key, 0)
+            if diff:
+                pipeline.hincrbyfloat(STATS_KEY, key, diff)
+        if new_contribution:
+            pipeline.hset(CONTRIBUTIONS_KEY, instance_name, j.data.serializers.json.dumps(new_contribution))
+        else:
+            pipeline.hdel(CONTRIBUTIONS_KEY, instance_name)
+        if expiration:
+            pipeline.zadd(EXPIRATIONS_KEY, {instance_name: expiration})
+        else:
+            pipeline.zrem(EXPIRATIONS_KEY, instance_name)
+        pipeline.execute()
+
+
+def update(deployment):
+    """Apply the changes of a saved deployment to the aggregates
+
+    Args:
+        deployment (JukeboxDeployment): saved deployment
+    """
+    expiration = None
+    if deployment.state in ACTIVE_STATES and deployment.expiration_date:
+        expiration = deployment.expiration_date.timestamp()
+    _apply(deployment.instance_name, _contribution(deployment), expiration)
+
+
+def remove(instance_name):
+    """Remove a deleted deployment from the aggregates
+
+    Args:
+        instance_name (str): deployment instance name
+    """
+    _apply(instance_name, {})
+
+
+def rebuild():
+    """Recompute the aggregates from all stored deployments (used once to backfill existing deployments)"""
+    db = j.core.db
+    db.delete(STATS_KEY, CONTRIBUTIONS_KEY, EXPIRATIONS_KEY)
+    for instance_name in j.sals.jukebox.list_all():
+        deployment = j.sals.jukebox.find(instance_name)
+        if deployment:
+            update(deployment)
+    db.hset(STATS_KEY, "rebuilt_at", j.data.time.utcnow().timestamp)
+
+
+def get_stats(expiring_within_days=7):
+    """Get the fleet aggregates
+
+    Args:
+        expiring_within_days (int): count active deployments expiring in that many days
+
+    Returns:
+        dict: deployments and nodes counts per solution_type, state and farm, committed cu/su and expiring count
+    """
+    db = j.core.db
+    if not db.exists(STATS_KEY):
+        rebuild()
+
+    result = {
+        "deployments": {"solution_type": {}, "state": {}, "farm": {}},
+        "nodes": {"solution_type": {}, "state": {}, "farm": {}},
+        "cu": 0,
+        "su": 0,
+    }
+    for key, value in db.hgetall(STATS_KEY).items():
+        key = key.decode() if isinstance(key, bytes) else key
+        value = float(value)
+        if key in ["cu", "su"]:
+            result[key] = round(value, 6)
+            continue
+        parts = key.split(":", 2)
+        if len(parts) != 3:
+            continue
+        kind, group, name = parts
+        if round(value):
+            result[kind][group][name] = round(value)
+
+    now = j.data.time.utcnow().timestamp
+    result["expiring"] = {
+        "days": expiring_within_days,
+        "deployments": db.zcount(EXPIRATIONS_KEY, now, now + expiring_within_days * 60 * 60 * 24),
+    }
+    return result
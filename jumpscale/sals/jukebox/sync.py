@@ -0,0 +1,311 @@
+"""
+Blockchain sync progress of the deployed nodes.
+
+A collector per solution type queries the RPC endpoint of a node for its block height, the height it is syncing to
+and its number of peers:
+
+- dash, digibyte: one batched JSON-RPC call of getblockchaininfo (blocks, headers) and getconnectioncount, with the
+  RPC credentials of the deployment
+- casperlabs: info_get_status of the node JSON-RPC, its target is the highest height seen in the fleet this cycle
+
+Presearch and ubuntu nodes expose no chain RPC and are not collected. Collectors are registered with `register`.
+
+A cycle queries the fleet `concurrency` nodes at a time through one HTTP session, so the connections to a node are
+reused, and skips the nodes failing the liveness probes. Every node keeps its last RING_SIZE samples in a ring buffer,
+persisted as one compact string per node in a redis hash per deployment; the rings of at most RINGS_CACHE_SIZE
+deployments are kept in memory between cycles.
+"""
+import abc
+from collections import deque, namedtuple
+
+from gevent.pool import Pool
+from jumpscale.loader import j
+import requests
+from requests.adapters import HTTPAdapter
+
+from jumpscale.sals.jukebox import metrics, probe, utils
+from jumpscale.sals.jukebox.cache import TTLCache
+from jumpscale.sals.jukebox.models import State
+
+SYNC_KEY = "jukebox:sync:{}"
+RING_SIZE = 48  # 12 hours of samples at the default interval
+SYNCED_LAG = 2  # blocks behind the target still taken as synced
+DEFAULT_TIMEOUT = 5
+DEFAULT_CONCURRENCY = 200
+MAX_HOSTS = 5000  # connection pools kept by the session, one per node
+RINGS_CACHE_TTL = 60 * 60
+RINGS_CACHE_SIZE = 10000  # deployments whose rings are kept in memory
+
+Sample = namedtuple("Sample", ["timestamp", "height", "target", "peers"])
+Reading = namedtuple("Reading", ["height", "target", "peers"])
+
+COLLECTIONS = metrics.counter("jukebox_sync_collections_total", "Sync progress queries", ["solution_type", "result"])
+
+
+class Collector(abc.ABC):
+    port = None
+
+    def prepare(self, deployment):
+        """Get what `collect` needs from the deployment, called once per deployment per cycle"""
+        return None
+
+    @abc.abstractmethod
+    def collect(self, session, address, context, timeout):
+        """Query a node
+
+        Args:
+            session (requests.Session): shared session
+            address (str): ipv6 or ipv4 address of the node
+            context: what `prepare` returned for the deployment of the node
+            timeout (float): request timeout in seconds
+
+        Returns:
+            Reading: height, target (None if the node doesn't know it) and peers
+        """
+
+    def url(self, address, path="/"):
+        host = f"[{address}]" if ":" in address else address
+        return f"http://{host}:{self.port}{path}"
+
+
+class BitcoinRPCCollector(Collector):
+    def __init__(self, port):
+        self.port = port
+
+    def prepare(self, deployment):
+        secret_env = utils.decrypt_secret_env(deployment) or {}
+        return secret_env.get("rpcuser", ""), secret_env.get("rpcpasswd", "")
+
+    def collect(self, session, address, context, timeout):
+        calls = [
+            {"jsonrpc": "1.0", "id": 0, "method": "getblockchaininfo", "params": []},
+            {"jsonrpc": "1.0", "id": 1, "method": "getconnectioncount", "params": []},
+        ]
+        response = session.post(
+            self.url(address),
+            json=calls,
+            auth=context,
+            timeout=timeout,
+        )
+        response.raise_for_status()
+        results = {item["id"]: item["result"] for item in response.json()}
+        return Reading(results[0]["blocks"], results[0]["headers"], results[1])
+
+
+class CasperCollector(Collector):
+    port = 7777
+
+    def collect(self, session, address, context, timeout):
+        call = {"jsonrpc": "2.0", "id": 0, "method": "info_get_status", "params": []}
+        response = session.post(self.url(address, "/rpc"), json=call, timeout=timeout)
+        response.raise_for_status()
+        status = response.json()["result"]
+        return Reading((status.get("last_added_block_info") or {}).get("height"), None, len(status.get("peers", [])))
+
+
+COLLECTORS = {
+    "dash": BitcoinRPCCollector(9998),
+    "digibyte": BitcoinRPCCollector(14022),
+    "casperlabs": CasperCollector(),
+}
+
+
+def register(solution_type, collector):
+    """Collect the sync progress of the nodes of `solution_type` with `collector`"""
+    COLLECTORS[solution_type] = collector
+
+
+def _pack(ring):
+    return ";".join(",".join("" if value is None else str(value) for value in sample) for sample in ring)
+
+
+def _unpack(data):
+    data = data.decode() if isinstance(data, bytes) else data
+    ring = deque(maxlen=RING_SIZE)
+    for item in (data or "").split(";"):
+        if item:
+            ring.append(Sample(*(int(value) if value else None for value in item.split(","))))
+    return ring
+
+
+class SyncStore:
+    def __init__(self):
+        """Ring buffers of the samples of each node, loaded from redis once per deployment"""
+        self._rings = TTLCache(RINGS_CACHE_TTL, maxsize=RINGS_CACHE_SIZE)  # {instance_name: {wid: deque of Sample}}
+
+    def load(self, instance_names):
+        """Get the rings of deployments, loading the ones that are not cached in one round trip
+
+        Returns:
+            dict: {instance_name: {wid: deque of Sample}}
+        """
+        loaded = {}
+        missing = []
+        for instance_name in instance_names:
+            rings = self._rings.get(instance_name)
+            if rings is None:
+                missing.append(instance_name)
+            else:
+                loaded[instance_name] = rings
+        if not missing:
+            return loaded
+        pipeline = j.core.db.pipeline()
+        for instance_name in missing:
+            pipeline.hgetall(SYNC_KEY.format(instance_name))
+        for instance_name, rings in zip(missing, pipeline.execute()):
+            loaded[instance_name] = {int(wid): _unpack(data) for wid, data in (rings or {}).items()}
+            self._rings.set(instance_name, loaded[instance_name])
+        return loaded
+
+    def append(self, samples):
+        """Append samples to the rings of their nodes and persist them
+
+        Args:
+            samples (dict): {(instance_name, wid): Sample}
+        """
+        instance_names = {instance_name for instance_name, _ in samples}
+        loaded = self.load(instance_names)
+        for (instance_name, wid), sample in samples.items():
+            loaded[instance_name].setdefault(wid, deque(maxlen=RING_SIZE)).append(sample)
+        pipeline = j.core.db.pipeline()
+        for instance_name in instance_names:
+            pipeline.hset(
+                SYNC_KEY.format(instance_name),
+                mapping={wid: _pack(ring) for wid, ring in loaded[instance_name].items()},
+            )
+        pipeline.execute()
+
+    def prune(self, instance_name, wids):
+        """Drop the rings of the nodes of a deployment that are not in `wids` anymore"""
+        rings = self.load([instance_name])[instance_name]
+        removed = set(rings) - set(wids)
+        if removed:
+            for wid in removed:
+                rings.pop(wid)
+            j.core.db.hdel(SYNC_KEY.format(instance_name), *removed)
+
+    def get(self, instance_names):
+        """Get the samples of the nodes of deployments
+
+        Returns:
+            dict: {instance_name: {wid: [Sample]}} oldest sample first
+        """
+        loaded = self.load(instance_names)
+        return {
+            instance_name: {wid: list(ring) for wid, ring in loaded[instance_name].items()}
+            for instance_name in instance_names
+        }
+
+    def remove(self, instance_name):
+        self._rings.invalidate(instance_name)
+        j.core.db.delete(SYNC_KEY.format(instance_name))
+
+
+STORE = SyncStore()
+
+
+class SyncCollector:
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT):
+        """
+        Arguments:
+            concurrency (int): max nodes queried at once
+            timeout (float): timeout of each RPC request in seconds
+        """
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=MAX_HOSTS, pool_maxsize=1, max_retries=0)
+        self.session.mount("http://", adapter)
+
+    def _collect(self, item):
+        key, deployment, context, address = item
+        collector = COLLECTORS[deployment.solution_type]
+        try:
+            reading = collector.collect(self.session, address, context, self.timeout)
+        except Exception as e:
+            COLLECTIONS.inc(solution_type=deployment.solution_type, result="error")
+            j.logger.debug(f"Failed to collect the sync progress of {key}: {e}")
+            return key, deployment.solution_type, None
+        COLLECTIONS.inc(solution_type=deployment.solution_type, result="ok")
+        return key, deployment.solution_type, reading
+
+    def run(self, deployments):
+        """Collect the sync progress of the deployed nodes of `deployments` and store it
+
+        Returns:
+            int: number of nodes that answered
+        """
+        deployments = [deployment for deployment in deployments if deployment.solution_type in COLLECTORS]
+        STORE.load([deployment.instance_name for deployment in deployments])
+        items = []
+        for deployment in deployments:
+            STORE.prune(deployment.instance_name, [node.wid for node in deployment.nodes])
+            addresses = []
+            for node in deployment.nodes:
+                address = node.ipv6_address or node.ipv4_address
+                if node.state != State.DEPLOYED or not address:
+                    continue
+                if probe.TRACKER.failures(deployment.instance_name, node.wid):
+                    continue  # not answering the liveness probes, don't wait for its RPC to time out
+                addresses.append((node.wid, str(address)))
+            if not addresses:
+                continue
+            context = COLLECTORS[deployment.solution_type].prepare(deployment)
+            for wid, address in addresses:
+                items.append(((deployment.instance_name, wid), deployment, context, address))
+
+        readings = {}
+        fleet_heights = {}  # {solution_type: highest height}, the target of the nodes that don't report one
+        for key, solution_type, reading in Pool(self.concurrency).imap_unordered(self._collect, items):
+            if reading and reading.height is not None:
+                readings[key] = (solution_type, reading)
+                fleet_heights[solution_type] = max(fleet_heights.get(solution_type, 0), reading.height)
+
+        now = int(j.data.time.utcnow().timestamp)
+        samples = {
+            key: Sample(
+                now,
+                reading.height,
+                reading.target if reading.target is not None else fleet_heights[solution_type],
+                reading.peers,
+            )
+            for key, (solution_type, reading) in readings.items()
+        }
+        if samples:
+            STORE.append(samples)
+        return len(samples)
+
+
+def progress(samples):
+    """Summarize the samples of a node, oldest first, for the deployments API"""
+    if not samples:
+        return None
+    latest = samples[-1]
+    behind = max(latest.target - latest.height, 0) if latest.target is not None else None
+    return {
+        "height": latest.height,
+        "target": latest.target,
+        "peers": latest.peers,
+        "behind": behind,
+        "synced": behind is not None and behind <= SYNCED_LAG,
+        "updated": latest.timestamp,
+        "history": [list(sample) for sample in samples],
+    }
+
+
+def to_dicts(deployments):
+    """Serialize deployments with `to_dict`, adding the sync progress of each node as `sync`"""
+    samples = STORE.get([deployment.instance_name for deployment in deployments])
+    deployment_dicts = []
+    for deployment in deployments:
+        deployment_dict = deployment.to_dict()
+        rings = samples[deployment.instance_name]
+        for node in deployment_dict.get("nodes", []):
+            node["sync"] = progress(rings.get(node.get("wid")))
+        deployment_dicts.append(deployment_dict)
+    return deployment_dicts
+
+
+def remove(instance_name):
+    """Remove the sync progress of a deleted deployment"""
+    STORE.remove(instance_name)
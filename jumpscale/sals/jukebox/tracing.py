@@ -0,0 +1,173 @@
+"""
+Per-stage timing of deployments.
+
+A trace is opened around a deployment operation with `trace`, and its stages are timed with `span`. The active
+trace is looked up on the current greenlet then on the greenlets that spawned it, so the spans recorded in the
+greenlets of `create_farm_pools`, `deploy_farm_batches` or the batch submit pools land on the trace of the deploy
+that started them. Outside of a trace, `span` only costs that lookup.
+
+A finished trace is stored as a compact breakdown: count, total, max and errors per stage, the same per farm, and
+the slowest spans with their attributes (farm, node, pool). The last TRACES_PER_DEPLOYMENT traces of each
+deployment and the last RECENT_TRACES of the fleet are kept in redis.
+"""
+from contextlib import contextmanager
+import heapq
+import itertools
+import time
+
+from jumpscale.loader import j
+
+from jumpscale.sals.jukebox import context
+
+TRACES_KEY = "jukebox:traces:{}"
+RECENT_TRACES_KEY = "jukebox:traces:recent"
+TRACES_PER_DEPLOYMENT = 10
+RECENT_TRACES = 200
+SLOWEST_SPANS = 10
+
+_TRACE_ATTRIBUTE = "_jukebox_trace"
+_sequence = itertools.count()
+
+
+def _add(stages, stage, duration, failed):
+    count, total, maximum, errors = stages.get(stage, (0, 0, 0, 0))
+    stages[stage] = (count + 1, total + duration, max(maximum, duration), errors + int(failed))
+
+
+def _stages_dict(stages):
+    return {
+        stage: {"count": count, "total": round(total, 3), "max": round(maximum, 3), "errors": errors}
+        for stage, (count, total, maximum, errors) in stages.items()
+    }
+
+
+class Trace:
+    def __init__(self, instance_name, operation):
+        self.instance_name = instance_name
+        self.operation = operation
+        self.started_at = j.data.time.utcnow().timestamp
+        self.duration = None
+        self.error = None
+        self.stages = {}  # {stage: (count, total, max, errors)}
+        self.farms = {}  # {farm_name: {stage: (count, total, max, errors)}}
+        self._slowest = []  # min heap of (duration, sequence, stage, attrs)
+        self._start = time.monotonic()
+
+    def record(self, stage, duration, attrs, failed=False):
+        if self.duration is not None:
+            return  # span of a greenlet that outlived its trace
+        _add(self.stages, stage, duration, failed)
+        farm_name = attrs.get("farm")
+        if farm_name:
+            _add(self.farms.setdefault(farm_name, {}), stage, duration, failed)
+        item = (duration, next(_sequence), stage, attrs)
+        if len(self._slowest) < SLOWEST_SPANS:
+            heapq.heappush(self._slowest, item)
+        else:
+            heapq.heappushpop(self._slowest, item)
+
+    def finish(self, error=None):
+        self.duration = time.monotonic() - self._start
+        self.error = error
+
+    def to_dict(self):
+        return {
+            "deployment": self.instance_name,
+            "operation": self.operation,
+            "started_at": self.started_at,
+            "duration": round(self.duration or time.monotonic() - self._start, 3),
+            "error": self.error,
+            "stages": _stages_dict(self.stages),
+            "farms": {farm_name: _stages_dict(stages) for farm_name, stages in self.farms.items()},
+            "slowest": [
+                {"stage": stage, "duration": round(duration, 3), **attrs}
+                for duration, _, stage, attrs in sorted(self._slowest, reverse=True)
+            ],
+        }
+
+
+def current_trace():
+    """Get the trace of the current greenlet or of the greenlets that spawned it, None outside of a trace"""
+    return context.get(_TRACE_ATTRIBUTE)
+
+
+@contextmanager
+def span(stage, **attrs):
+    """Time a stage of the current trace
+
+    Args:
+        stage (str): stage name, e.g. "deploy_network" or "wait_workload"
+        attrs: details kept with the slowest spans, `farm` also groups the stage per farm
+    """
+    active_trace = current_trace()
+    if not active_trace:
+        yield
+        return
+    start = time.monotonic()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        active_trace.record(stage, time.monotonic() - start, attrs, failed)
+
+
+@contextmanager
+def trace(instance_name, operation="deploy"):
+    """Open a trace around a deployment operation and store its breakdown when it ends
+
+    A trace opened inside another one is merged into the outer trace.
+
+    Args:
+        instance_name (str): deployment instance name
+        operation (str): traced operation, e.g. "deploy", "redeploy" or "extend"
+    """
+    outer_trace = current_trace()
+    if outer_trace:
+        yield outer_trace
+        return
+
+    active_trace = Trace(instance_name, operation)
+    error = None
+    try:
+        with context.bind(_TRACE_ATTRIBUTE, active_trace):
+            yield active_trace
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"[:200]
+        raise
+    finally:
+        active_trace.finish(error)
+        try:
+            save(active_trace)
+        except Exception as e:
+            j.logger.exception(f"Failed to save the trace of {instance_name}", exception=e)
+
+
+def save(finished_trace):
+    data = j.data.serializers.json.dumps(finished_trace.to_dict())
+    key = TRACES_KEY.format(finished_trace.instance_name)
+    pipeline = j.core.db.pipeline()
+    pipeline.lpush(key, data)
+    pipeline.ltrim(key, 0, TRACES_PER_DEPLOYMENT - 1)
+    pipeline.lpush(RECENT_TRACES_KEY, data)
+    pipeline.ltrim(RECENT_TRACES_KEY, 0, RECENT_TRACES - 1)
+    pipeline.execute()
+
+
+def get_traces(instance_name=None, limit=RECENT_TRACES):
+    """Get the stored traces, newest first
+
+    Args:
+        instance_name (str): traces of this deployment, defaults to the recent traces of the whole fleet
+        limit (int): max number of traces
+
+    Returns:
+        list: trace breakdowns
+    """
+    key = TRACES_KEY.format(instance_name) if instance_name else RECENT_TRACES_KEY
+    return [j.data.serializers.json.loads(data) for data in j.core.db.lrange(key, 0, limit - 1)]
+
+
+def remove(instance_name):
+    """Remove the traces of a deleted deployment"""
+    j.core.db.delete(TRACES_KEY.format(instance_name))
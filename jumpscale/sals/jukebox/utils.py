@@ -1,11 +1,25 @@
 from collections import defaultdict
+import copy
+from functools import lru_cache
+import hashlib
 
 from jumpscale.clients.stellar import TRANSACTION_FEES
-from jumpscale.clients.explorer.models import DiskType, Container
+from jumpscale.clients.explorer.models import DiskType
 from jumpscale.loader import j
 
 from jumpscale.sals.vdc.scheduler import GlobalCapacityChecker
 
+from jumpscale.sals.jukebox import capacity, explorer, health, pricing
+from jumpscale.sals.jukebox.cache import TTLCache, wipe
+
+TEMPLATE_CACHE_TTL = 10 * 60
+BALANCE_CACHE_TTL = 30
+BALANCE_ASSETS = ["TFT", "XLM"]
+# decrypted secrets are kept in memory only, and wiped when they expire or get invalidated
+_template_cache = TTLCache(ttl=TEMPLATE_CACHE_TTL, maxsize=256, on_evict=wipe)  # {instance_name: template}
+_secret_env_cache = TTLCache(ttl=TEMPLATE_CACHE_TTL, maxsize=1024, on_evict=wipe)
+_balance_cache = TTLCache(ttl=BALANCE_CACHE_TTL, maxsize=4096)  # {(wallet_name, asset): balance}
+
 
 def get_or_create_user_wallet(wallet_name):
     # Create a wallet for the user to be used in extending his pool
@@ -34,35 +48,18 @@ def get_or_create_user_wallet(wallet_name):
 def calculate_payment_from_container_resources(
     cpu, memory, disk_size, duration, farm_id=None, farm_name="freefarm", disk_type=DiskType.HDD
 ):
-    if farm_name and not farm_id:
-        zos = j.sals.zos.get()
-        farm_id = zos._explorer.farms.get(farm_name=farm_name).id
-    empty_container = Container()
-    empty_container.capacity.cpu = cpu
-    empty_container.capacity.memory = memory
-    empty_container.capacity.disk_size = disk_size
-    empty_container.capacity.disk_type = disk_type
-    cost = j.tools.zos.consumption.cost(empty_container, duration=duration, farm_id=farm_id)
-    return cost
+    return pricing.container_cost(
+        cpu, memory, disk_size, duration, farm_id=farm_id, farm_name=farm_name, disk_type=disk_type
+    )
 
 
 def calculate_required_units(cpu, memory, disk_size, duration_seconds, number_of_containers=1):
-    cont = Container()
-    cont.capacity.cpu = cpu
-    cont.capacity.memory = memory
-    cont.capacity.disk_size = disk_size
-    cont.capacity.disk_type = DiskType.HDD
-
-    cloud_units = {"cu": 0, "su": 0, "ipv4u": 0}
-    cont_units = cont.resource_units().cloud_units()
-    cloud_units["cu"] += cont_units.cu * number_of_containers
-    cloud_units["su"] += cont_units.su * number_of_containers
-    cloud_units["cu"] *= duration_seconds
-    cloud_units["su"] *= duration_seconds
-    return cloud_units
+    return pricing.required_units(cpu, memory, disk_size, duration_seconds, number_of_containers)
 
 
 def get_possible_farms(cru, hru, mru, number_of_deployments):
+    if capacity.INDEX.is_fresh():
+        return capacity.INDEX.available_farms(cru=cru, mru=mru, hru=hru, number_of_deployments=number_of_deployments)
     gcc = GlobalCapacityChecker()
     farm_names = gcc.get_available_farms(
         cru=cru, mru=mru, hru=hru, accessnodes=True, no_deployments=number_of_deployments
@@ -70,6 +67,40 @@ def get_possible_farms(cru, hru, mru, number_of_deployments):
     return farm_names
 
 
+def split_nodes_across_farms(cru, hru, mru, number_of_deployments, farm_names=None):
+    """Spread containers over the farms of the capacity index, filling the farms with the most room first
+
+    Returns:
+        dict: {farm_name: number of containers}, empty if the farms can't fit all the containers
+    """
+    if not capacity.INDEX.is_fresh():
+        return {}
+    fits = {}
+    for farm_name in farm_names or capacity.INDEX.available_farms(cru=cru, mru=mru, hru=hru, number_of_deployments=1):
+        farm = capacity.INDEX.get_farm(farm_name)
+        if farm and farm.access_nodes:
+            fits[farm_name] = farm.containers_fit(cru=cru, mru=mru, hru=hru)
+    split = {}
+    remaining = number_of_deployments
+    # healthy farms first, then the ones with most room
+    for farm_name in health.REGISTRY.rank_farms(sorted(fits, key=fits.get, reverse=True)):
+        if not remaining:
+            break
+        split[farm_name] = min(fits[farm_name], remaining)
+        remaining -= split[farm_name]
+    return {} if remaining else split
+
+
+def validate_farm_capacity(farm_name, cru, hru, mru, number_of_deployments):
+    """Check against the explorer that a farm still fits the deployment, as the capacity index may be outdated"""
+    try:
+        farm = capacity.INDEX.refresh_farm(farm_name)
+    except Exception as e:
+        j.logger.exception(f"Failed to validate capacity of farm {farm_name}", exception=e)
+        return True  # let the deployment itself fail if the farm is really out of capacity
+    return farm.fits(cru=cru, mru=mru, hru=hru, number_of_deployments=number_of_deployments)
+
+
 def get_network_ip_range():
     return j.sals.reservation_chatflow.reservation_chatflow.get_ip_range()
 
@@ -79,7 +110,7 @@ def show_payment(bot, amount, wallet_name, expiry=5, description=None):
     if not wallet:
         raise j.exceptions.NotFound(f"Couldn't find wallet {wallet_name}")
 
-    balance = wallet.get_balance_by_asset("TFT")
+    balance = explorer.wallet_call(wallet, "get_balance_by_asset", "TFT")
     if balance >= amount:
         if bot:
             result = bot.single_choice(
@@ -98,60 +129,72 @@ def show_payment(bot, amount, wallet_name, expiry=5, description=None):
     payment_id, _ = j.sals.billing.submit_payment(
         amount=amount, wallet_name=wallet_name, refund_extra=False, expiry=expiry, description=description
     )
+    invalidate_wallet_balance(wallet_name)
     if amount > 0:
         notes = []
-        return j.sals.billing.wait_payment(payment_id, bot=bot, notes=notes), amount, payment_id
+        payment_success = j.sals.billing.wait_payment(payment_id, bot=bot, notes=notes)
+        invalidate_wallet_balance(wallet_name)
+        return payment_success, amount, payment_id
     else:
         return True, amount, payment_id
 
 
 def calculate_funding_amount(identity_name):
     identity = j.core.identity.find(identity_name)
-    zos = j.sals.zos.get(identity_name)
+    zos = explorer.get_zos(identity_name)
     if not identity:
         return 0, None
     total_price = 0
     details = defaultdict(lambda: {})
-    deployments = j.sals.jukebox.list(identity_name=identity_name)
-    for deployment in deployments:
-        price = 0
+    deployments = []
+    for deployment in j.sals.jukebox.list(identity_name=identity_name):
         if not deployment.auto_extend:
             continue
         if deployment.expiration_date.timestamp() > j.data.time.utcnow().timestamp + 60 * 60 * 24 * 2:
             continue
-        cloud_units = calculate_required_units(
-            cpu=deployment.cpu,
-            memory=deployment.memory,
-            disk_size=deployment.disk_size,
-            duration_seconds=60 * 60 * 24 * 30,
-            number_of_containers=deployment.nodes_count,
-        )
-        farm_id = zos._explorer.farms.get(farm_name=deployment.farm_name).id
-        farm_prices = zos._explorer.farms.get_deal_for_threebot(farm_id, j.core.identity.me.tid)[
-            "custom_cloudunits_price"
-        ]
-        price += zos._explorer.prices.calculate(
-            cus=cloud_units["cu"], sus=cloud_units["su"], ipv4us=cloud_units["ipv4u"], farm_prices=farm_prices
-        )
-        price += TRANSACTION_FEES
+        deployments.append(deployment)
+
+    deployments_items = [pricing.extension_items(deployment) for deployment in deployments]
+    prices = iter(pricing.price_batch([item for items in deployments_items for item in items], zos=zos))
+    for deployment, items in zip(deployments, deployments_items):
+        # each pool is extended with its own transaction
+        price = sum(next(prices) + TRANSACTION_FEES for _ in items)
         total_price += price
         details[deployment.solution_type.capitalize()][deployment.deployment_name] = round(price, 6)
     return total_price, details
 
 
+def get_wallet_balance(wallet, asset="TFT"):
+    """Get the wallet balance of `asset`, cached for BALANCE_CACHE_TTL to avoid hitting horizon on every call"""
+    return _balance_cache.get_or_set(
+        (wallet.instance_name, asset), lambda: explorer.wallet_call(wallet, "get_balance_by_asset", asset)
+    )
+
+
+def invalidate_wallet_balance(wallet_name):
+    """Drop the cached balances of a wallet, to be called after any transfer or payout from/to it"""
+    for asset in BALANCE_ASSETS:
+        _balance_cache.invalidate((wallet_name, asset))
+
+
+@lru_cache(maxsize=1024)
+def get_topup_qrcode(address, amount):
+    qrcode_data = f"TFT:{address}?amount={amount}&message=topup&sender=me"
+    return j.tools.qrcode.base64_get(qrcode_data, scale=3)
+
+
 def get_wallet_funding_info(identity_name):
     wallet = j.clients.stellar.find(identity_name)
     if not wallet:
         return {}
 
     asset = "TFT"
-    current_balance = wallet.get_balance_by_asset(asset)
+    current_balance = get_wallet_balance(wallet, asset)
     calculated_funding_amount, amount_detials = calculate_funding_amount(identity_name)
     amount = calculated_funding_amount - current_balance
     amount = 0 if amount < 0 else round(amount, 6)
 
-    qrcode_data = f"TFT:{wallet.address}?amount={amount}&message=topup&sender=me"
-    qrcode_image = j.tools.qrcode.base64_get(qrcode_data, scale=3)
+    qrcode_image = get_topup_qrcode(wallet.address, amount)
 
     data = {
         "address": wallet.address,
@@ -164,11 +207,62 @@ def get_wallet_funding_info(identity_name):
     return data
 
 
+def _secret_env_revision(deployment):
+    return hashlib.sha256((deployment.secret_env or "").encode()).hexdigest()
+
+
+def _get_secret_env(deployment):
+    key = (deployment.identity_name, _secret_env_revision(deployment))
+    secret_env = _secret_env_cache.get(key)
+    if secret_env is None:
+        secret_env = {}
+        secret_env_json = j.sals.reservation_chatflow.deployer.decrypt_metadata(
+            deployment.secret_env, deployment.identity_name
+        )
+        if secret_env_json:
+            secret_env = j.data.serializers.json.loads(secret_env_json)
+        _secret_env_cache.set(key, secret_env)
+    return copy.deepcopy(secret_env)
+
+
 def decrypt_secret_env(deployment):
-    secret_env = ""
-    secret_env_json = j.sals.reservation_chatflow.deployer.decrypt_metadata(
-        deployment.secret_env, deployment.identity_name
-    )
-    if secret_env_json:
-        secret_env = j.data.serializers.json.loads(secret_env_json)
-    return secret_env
+    return _get_secret_env(deployment) or ""
+
+
+def get_deployment_template(deployment):
+    """Get the decrypted template used to redeploy the containers of a deployment
+
+    The template is built from the first node workload and cached per deployment revision
+    (first node wid and encrypted secret_env), so repeated heals and extensions do not fetch and decrypt it again.
+
+    Args:
+        deployment (JukeboxDeployment): deployment with at least one node
+
+    Returns:
+        dict: {"env", "secret_env", "metadata", "flist", "entrypoint"}
+    """
+    revision = (deployment.nodes[0].wid, _secret_env_revision(deployment))
+    template = _template_cache.get(deployment.instance_name)
+    if not template or template["revision"] != revision:
+        workload = deployment.zos.workloads.get(deployment.nodes[0].wid)
+        metadata = j.sals.reservation_chatflow.deployer.decrypt_metadata(
+            workload.info.metadata, deployment.identity_name
+        )
+        metadata_dict = j.data.serializers.json.loads(metadata)
+        metadata_dict.pop("solution_uuid", None)
+        template = {
+            "revision": revision,
+            "env": dict(workload.environment),
+            "secret_env": _get_secret_env(deployment),
+            "metadata": metadata_dict,
+            "flist": workload.flist,
+            "entrypoint": workload.entrypoint,
+        }
+        _template_cache.set(deployment.instance_name, template)
+    template = copy.deepcopy(template)
+    template.pop("revision")
+    return template
+
+
+def evict_deployment_cache(instance_name):
+    _template_cache.invalidate(instance_name)
@@ -0,0 +1,239 @@
+"""
+Optional stock of pre-paid capacity pools with a ready network, handed over to new deployments.
+
+The explorer only accepts workloads on a pool from the pool owner, and jukebox signs every workload with the
+user intermediate identity, so the stock is kept per identity, farm and flavor (the cru, mru and hru of a node).
+Identities are added to the stock targets when their owner opens a deploy chat, and the warm_capacity service
+refills the stock of recently active identities on the configured farms and flavors. Pools are paid from the
+init_wallet, like the first hour pool of a deployment, for `containers` nodes of their flavor during `hours`.
+
+A deployment only gets a warm pool of its flavor holding at least the first hour of all its nodes, the deploy step
+then extends the pool by what is missing for the full expiration.
+
+Configuration (`JUKEBOX_WARM_CAPACITY` in the jumpscale config), disabled by default:
+
+    {"enabled": true, "farms": {"freefarm": 1}, "flavors": [{"cru": 4, "mru": 8, "hru": 100}], "containers": 1,
+     "hours": 1}
+"""
+import gevent
+from jumpscale.loader import j
+
+from jumpscale.sals.jukebox import explorer, utils
+from jumpscale.sals.jukebox.explorer import deployer
+
+STOCK_KEY = "jukebox:warm:{}:{}:{}"  # identity_name, farm_name, flavor
+TARGETS_KEY = "jukebox:warm:targets"
+TARGET_TTL = 60 * 60 * 24  # identities without activity for that long are not refilled
+INIT_WALLET = "init_wallet"
+DEFAULT_CONFIG = {
+    "enabled": False,
+    "farms": {},  # {farm_name: number of warm pools per identity and flavor}
+    "flavors": [{"cru": 4, "mru": 8, "hru": 100}],  # nodes to keep pools for, mru and hru in GB
+    "containers": 1,  # size the pools for this many nodes of their flavor
+    "hours": 1,
+    "max_identities": 50,
+}
+
+_refilling = set()  # (identity_name, farm_name, flavor) being refilled by this process
+
+
+def get_config():
+    config = dict(DEFAULT_CONFIG)
+    config.update(j.core.config.get("JUKEBOX_WARM_CAPACITY", {}) or {})
+    if "profile" in config:
+        config["flavors"] = [config.pop("profile")]  # single profile of the previous configuration format
+    return config
+
+
+def flavor_of(query):
+    """Get the flavor of the nodes of a query {"cru", "mru", "hru"}, e.g. 4-8-100"""
+    return f"{query['cru']}-{query['mru']}-{query['hru']}"
+
+
+def pool_units(query, number_of_containers, duration_seconds):
+    """Get the units of a pool for `number_of_containers` nodes of `query` during `duration_seconds`"""
+    return utils.calculate_required_units(
+        cpu=query["cru"],
+        memory=query["mru"] * 1024,
+        disk_size=query["hru"] * 1024,
+        duration_seconds=duration_seconds,
+        number_of_containers=number_of_containers,
+    )
+
+
+def is_enabled():
+    return bool(get_config()["enabled"])
+
+
+def touch(identity_name):
+    """Mark an identity as active so its stock gets refilled"""
+    if is_enabled():
+        j.core.db.zadd(TARGETS_KEY, {identity_name: j.data.time.utcnow().timestamp})
+
+
+def _stock_key(identity_name, farm_name, flavor):
+    return STOCK_KEY.format(identity_name, farm_name, flavor)
+
+
+def stock_size(identity_name, farm_name, flavor):
+    return j.core.db.llen(_stock_key(identity_name, farm_name, flavor))
+
+
+def _is_usable(entry):
+    zos = explorer.get_zos(entry["identity_name"])
+    try:
+        zos.pools.get(entry["pool_id"])
+        network_view = deployer.get_network_view(entry["network_name"], identity_name=entry["identity_name"])
+        if not network_view:
+            return False
+    except Exception as e:
+        j.logger.warning(f"Warm pool {entry['pool_id']} is not usable: {e}")
+        return False
+    return True
+
+
+def acquire(identity_name, farm_name, query, cu, su):
+    """Take a warm pool of the flavor of `query` holding at least `cu` and `su` out of the stock, and refill the
+    stock in the background
+
+    Returns:
+        dict: {"pool_id", "network_name", "wg_quick", "identity_name", "farm_name", "flavor", "cu", "su", "created"}
+            or None
+    """
+    if not is_enabled():
+        return None
+    flavor = flavor_of(query)
+    key = _stock_key(identity_name, farm_name, flavor)
+    entry = None
+    too_small = []
+    while True:
+        raw_entry = j.core.db.lpop(key)
+        if not raw_entry:
+            break
+        candidate = j.data.serializers.json.loads(raw_entry)
+        if candidate["cu"] < cu or candidate["su"] < su:
+            too_small.append(raw_entry)  # still good for a deployment with fewer nodes
+            continue
+        if _is_usable(candidate):
+            entry = candidate
+            break
+    if too_small:
+        j.core.db.rpush(key, *too_small)
+    config = get_config()
+    if farm_name in config["farms"] and flavor in {flavor_of(flavor_query) for flavor_query in config["flavors"]}:
+        gevent.spawn(refill, identity_name, farm_name, query)
+    if entry:
+        j.logger.info(f"Handing over warm pool {entry['pool_id']} on farm {farm_name} to {identity_name}")
+    return entry
+
+
+def provision(identity_name, farm_name, cu, su, flavor):
+    """Create a pool paid from the init_wallet and a network on it for an identity
+
+    Arguments:
+        flavor (str): flavor of the nodes the pool is sized for, see `flavor_of`
+
+    Returns:
+        dict: {"pool_id", "network_name", "wg_quick", "identity_name", "farm_name", "flavor", "cu", "su", "created"}
+    """
+    # imported here as the deployment module imports utils which this module depends on
+    from jumpscale.sals.jukebox.jukebox import JukeboxDeployment
+
+    # transient deployment object, never saved, used to reuse the pool payment and network logic
+    deployment = JukeboxDeployment(
+        solution_type="warm", identity_name=identity_name, deployment_name=farm_name, nodes_count=0
+    )
+    init_wallet = j.clients.stellar.find(INIT_WALLET)
+    payment_detail = deployment.zos.pools.create(cu=cu, su=su, ipv4us=0, farm=farm_name)
+    try:
+        deployment.zos.billing.payout_farmers(init_wallet, payment_detail)
+    finally:
+        utils.invalidate_wallet_balance(INIT_WALLET)
+    pool_id = payment_detail.reservation_id
+    if not deployment.wait_pool_payment(pool_id):
+        raise j.exceptions.Runtime(f"Failed to pay pool {pool_id}")
+
+    deployment.pool_ids = [pool_id]
+    network_name = f"{identity_name}_{pool_id}"
+    result = deployment.deploy_network(network_name=network_name)
+    if not result:
+        raise j.exceptions.Runtime(f"Failed to deploy network {network_name} on pool {pool_id}")
+    _, wg_quick = result
+
+    return {
+        "pool_id": pool_id,
+        "network_name": network_name,
+        "wg_quick": wg_quick,
+        "identity_name": identity_name,
+        "farm_name": farm_name,
+        "flavor": flavor,
+        "cu": cu,
+        "su": su,
+        "created": j.data.time.utcnow().timestamp,
+    }
+
+
+def add_to_stock(entry):
+    key = _stock_key(entry["identity_name"], entry["farm_name"], entry["flavor"])
+    j.core.db.rpush(key, j.data.serializers.json.dumps(entry))
+    j.logger.info(
+        f"Warm pool {entry['pool_id']} with network {entry['network_name']} is ready for "
+        f"{entry['identity_name']} on {entry['farm_name']}"
+    )
+
+
+def release(entry):
+    """Give back a provisioned pool that will not be used
+
+    The pool goes to the stock when it is enabled, otherwise its network is decommissioned. Pools can't be
+    deleted, the remaining capacity stays on the pool as no workload consumes it.
+    """
+    if is_enabled():
+        add_to_stock(entry)
+        return
+    j.logger.info(f"Releasing unused pool {entry['pool_id']} of {entry['identity_name']}")
+    zos = explorer.get_zos(entry["identity_name"])
+    network_view = deployer.get_network_view(entry["network_name"], identity_name=entry["identity_name"])
+    if network_view:
+        for workload in network_view.network_workloads:
+            zos.workloads.decomission(workload.id)
+
+
+def create_entry(identity_name, farm_name, query):
+    """Create a pre-paid pool for nodes of `query` and a network for an identity on a farm and add them to the stock"""
+    config = get_config()
+    cloud_units = pool_units(query, config["containers"], config["hours"] * 60 * 60)
+    entry = provision(identity_name, farm_name, cu=cloud_units["cu"], su=cloud_units["su"], flavor=flavor_of(query))
+    add_to_stock(entry)
+    return entry
+
+
+def refill(identity_name, farm_name, query):
+    """Fill the stock of an identity on a farm for the flavor of `query` up to the configured size"""
+    flavor = flavor_of(query)
+    if (identity_name, farm_name, flavor) in _refilling:
+        return
+    _refilling.add((identity_name, farm_name, flavor))
+    try:
+        wanted = get_config()["farms"].get(farm_name, 0)
+        for _ in range(wanted - stock_size(identity_name, farm_name, flavor)):
+            create_entry(identity_name, farm_name, query)
+    except Exception as e:
+        j.logger.exception(f"Failed to create {flavor} warm pool for {identity_name} on {farm_name}", exception=e)
+    finally:
+        _refilling.discard((identity_name, farm_name, flavor))
+
+
+def refill_all():
+    """Refill the stock of the recently active identities on all configured farms and flavors"""
+    config = get_config()
+    if not config["enabled"]:
+        return
+    now = j.data.time.utcnow().timestamp
+    j.core.db.zremrangebyscore(TARGETS_KEY, 0, now - TARGET_TTL)
+    identities = j.core.db.zrevrange(TARGETS_KEY, 0, config["max_identities"] - 1)
+    for identity_name in identities:
+        identity_name = identity_name.decode() if isinstance(identity_name, bytes) else identity_name
+        for farm_name in config["farms"]:
+            for query in config["flavors"]:
+                refill(identity_name, farm_name, query)
@@ -0,0 +1,170 @@
+import datetime
+import socket
+import time
+from types import SimpleNamespace
+
+import gevent
+from gevent.pywsgi import WSGIServer
+from gevent.server import StreamServer
+import pytest
+
+from jumpscale.sals.jukebox import probe
+from jumpscale.sals.jukebox.models import State
+
+LOCALHOST = "127.0.0.1"
+
+
+def _serve(handle):
+    server = StreamServer((LOCALHOST, 0), handle)
+    server.start()
+    return server
+
+
+@pytest.fixture
+def open_port():
+    server = _serve(lambda sock, address: sock.close())
+    yield server.server_port
+    server.stop()
+
+
+@pytest.fixture
+def closed_port():
+    sock = socket.socket()
+    sock.bind((LOCALHOST, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@pytest.fixture
+def silent_port():
+    """Accepts connections and never answers"""
+    server = _serve(lambda sock, address: gevent.sleep(10))
+    yield server.server_port
+    server.stop(timeout=0)
+
+
+@pytest.fixture
+def banner_port():
+    """Answers with a non HTTP banner, like an ssh daemon"""
+    server = _serve(lambda sock, address: sock.sendall(b"SSH-2.0-OpenSSH_8.2\r\n"))
+    yield server.server_port
+    server.stop()
+
+
+@pytest.fixture
+def rpc_port():
+    """JSON-RPC server rejecting the unauthenticated calls, like the dash and digibyte daemons"""
+
+    def app(environ, start_response):
+        start_response("401 Unauthorized", [("Content-Length", "0")])
+        return [b""]
+
+    server = WSGIServer((LOCALHOST, 0), app, log=None)
+    server.start()
+    yield server.server_port
+    server.stop()
+
+
+def _target(port, kind=probe.TCP, addresses=(LOCALHOST,)):
+    return probe.ProbeTarget(("deployment", port), list(addresses), port, kind)
+
+
+def test_open_port_is_alive(open_port):
+    result = probe.probe(_target(open_port), timeout=1)
+    assert result.alive
+    assert result.address == LOCALHOST
+    assert result.latency < 1
+
+
+def test_closed_port_is_dead(closed_port):
+    result = probe.probe(_target(closed_port), timeout=1)
+    assert not result.alive
+    assert result.error.startswith("ConnectionRefusedError")
+
+
+def test_silent_daemon_times_out(silent_port):
+    start = time.monotonic()
+    result = probe.probe(_target(silent_port, probe.HTTP), timeout=0.2)
+    assert not result.alive
+    assert result.error == "timeout"
+    assert time.monotonic() - start < 1
+
+
+def test_rpc_responder_is_alive(rpc_port):
+    result = probe.probe(_target(rpc_port, probe.HTTP), timeout=1)
+    assert result.alive
+
+
+def test_non_http_daemon_fails_http_probe(banner_port):
+    assert probe.probe(_target(banner_port), timeout=1).alive
+    result = probe.probe(_target(banner_port, probe.HTTP), timeout=1)
+    assert not result.alive
+
+
+def test_next_address_is_tried(open_port):
+    # the listener is bound to 127.0.0.1 only, the connection to 127.0.0.2 is refused
+    result = probe.probe(_target(open_port, addresses=["127.0.0.2", LOCALHOST]), timeout=1)
+    assert result.alive
+    assert result.address == LOCALHOST
+
+
+def test_engine_runs_targets_concurrently(open_port, closed_port, silent_port, rpc_port):
+    targets = [_target(port, kind) for port, kind in [(open_port, probe.TCP), (rpc_port, probe.HTTP)]]
+    targets += [probe.ProbeTarget(("dead", index), [LOCALHOST], closed_port, probe.TCP) for index in range(50)]
+    targets += [probe.ProbeTarget(("silent", index), [LOCALHOST], silent_port, probe.HTTP) for index in range(50)]
+    results = probe.ProbeEngine(concurrency=200, timeout=0.5).run(targets)
+    assert len(results) == len(targets)
+    summary = probe.summarize(results)
+    assert summary["alive"] == 2
+    assert summary["errors"]["timeout"] == 50
+    assert summary["errors"]["ConnectionRefusedError"] == 50
+
+
+def _deployment(node):
+    return SimpleNamespace(
+        instance_name="deployment", solution_type="dash", get_pool_farm=lambda pool_id: "farm", nodes=[node]
+    )
+
+
+def _node(state=State.DEPLOYED, ipv4_address=LOCALHOST, ipv6_address=None):
+    return SimpleNamespace(
+        wid=1,
+        state=state,
+        ipv4_address=ipv4_address,
+        ipv6_address=ipv6_address,
+        pool_id=1,
+        creation_time=datetime.datetime.utcnow() - datetime.timedelta(seconds=probe.GRACE_PERIOD + 60),
+    )
+
+
+def test_node_target_address_filter(rpc_port):
+    probes = {"dash": (probe.HTTP, rpc_port)}
+    node = _node()
+    assert probe.node_target(_deployment(node), node, probes) is None  # private address
+    target = probe.node_target(_deployment(node), node, probes, address_filter=lambda address: True)
+    assert target.addresses == [LOCALHOST]
+    assert target.farm == "farm"
+    assert probe.probe(target, timeout=1).alive
+
+
+def test_node_target_states():
+    probes = {"dash": (probe.HTTP, 9998)}
+    for state, probed in [(State.DEPLOYED, True), (State.NOT_RESPONDING, True), (State.ERROR, False)]:
+        node = _node(state)
+        target = probe.node_target(_deployment(node), node, probes, address_filter=lambda address: True)
+        assert (target is not None) == probed
+
+
+def test_tracker_confirms_suspects_over_rounds(open_port, closed_port):
+    tracker = probe.LivenessTracker(down_threshold=3)
+    alive = probe.ProbeTarget(("deployment", 1), [LOCALHOST], open_port, probe.TCP)
+    dead = probe.ProbeTarget(("deployment", 2), [LOCALHOST], closed_port, probe.TCP)
+    engine = probe.ProbeEngine(timeout=1)
+    for _ in range(2):
+        assert tracker.update(engine.run([alive, dead])) == {}
+    assert tracker.update(engine.run([alive, dead])) == {"deployment": [2]}
+    assert tracker.failures("deployment", 2) == 3
+
+    tracker.update(engine.run([alive, probe.ProbeTarget(("deployment", 2), [LOCALHOST], open_port, probe.TCP)]))
+    assert tracker.failures("deployment", 2) == 0